@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the nc_particles Writer and Reader
+
+Synthetic runs are generated, with particles released and removed over
+the course of the run, so the number of particles varies from timestep to
+timestep, as it does in a real model run. Each run is written, then read
+back with get_timestep, get_all_timesteps and get_individual_trajectory.
+
+Each case (number of particles, number of timesteps, netcdf version) is
+run in a fresh process, so the peak memory use (RSS) is its own. The
+results are written as JSON, so they can be compared between commits:
+
+    python bench_nc_particles.py --preset small --output before.json
+    (change the code)
+    python bench_nc_particles.py --preset small --output after.json --compare before.json
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+import netCDF4
+import nc_particles
+
+## (particles, timesteps) of the cases in each preset
+PRESETS = {'small': [(1000, 100), (10000, 100), (1000, 1000)],
+           'medium': [(100000, 100), (10000, 1000), (1000, 10000)],
+           'large': [(1000000, 1000), (10000000, 100), (1000, 100000), (100000, 10000)],
+           }
+
+## the number of timesteps and particles sampled for the per-timestep and
+## per-particle reads
+NUM_SAMPLES = 100
+
+REF_TIME = datetime.datetime(2010, 1, 1)
+TIMESTEP = datetime.timedelta(minutes=15)
+
+
+class SyntheticRun(object):
+    """
+    A run of num_particles particles over num_timesteps
+
+    Particles are released over the first half of the run, and each one
+    lasts between a quarter of the run and the rest of it -- so the number
+    of particles goes up, then down.
+    """
+    def __init__(self, num_particles, num_timesteps, seed=42):
+        self.num_particles = num_particles
+        self.num_timesteps = num_timesteps
+        rng = np.random.default_rng(seed)
+        self.release = rng.integers(0, max(num_timesteps // 2, 1), num_particles)
+        lifetime = rng.integers(max(num_timesteps // 4, 1), num_timesteps + 1, num_particles)
+        self.end = self.release + lifetime
+        # sorted by release time, so the particles released so far are a prefix
+        order = np.argsort(self.release, kind='stable')
+        self.release = self.release[order]
+        self.end = self.end[order]
+        self.ids = np.arange(num_particles, dtype=np.int32)
+        self.start_lon = rng.uniform(-90.0, -80.0, num_particles)
+        self.start_lat = rng.uniform(25.0, 30.0, num_particles)
+        self.mass = rng.uniform(0.0, 1.0, num_particles)
+
+    def timestep(self, t):
+        """
+        the (time, data) of timestep t
+        """
+        released = np.searchsorted(self.release, t, side='right')
+        alive = np.flatnonzero(self.end[:released] > t)
+        age = t - self.release[alive]
+        data = {'longitude': self.start_lon[alive] + 0.001 * age,
+                'latitude': self.start_lat[alive] + 0.0005 * age,
+                'mass': self.mass[alive] * np.exp(-0.001 * age),
+                'id': self.ids[alive],
+                }
+        return REF_TIME + t * TIMESTEP, data
+
+    @property
+    def num_rows(self):
+        """
+        the total length of the data dimension
+        """
+        return int(np.minimum(self.end, self.num_timesteps).sum() - self.release.sum())
+
+
+def peak_rss_mb():
+    """
+    the peak resident set size of this process so far, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+
+def bench_write(run, filename, nc_version, writer_kwargs):
+    writer = nc_particles.Writer(filename,
+                                 num_timesteps=run.num_timesteps,
+                                 ref_time=REF_TIME,
+                                 nc_version=nc_version,
+                                 **writer_kwargs)
+    seconds = 0.0
+    nbytes = 0
+    for t in range(run.num_timesteps):
+        timestamp, data = run.timestep(t)  # not timed
+        nbytes += sum(values.nbytes for values in data.values())
+        start = perf_counter()
+        writer.write_timestep(timestamp, data)
+        seconds += perf_counter() - start
+    start = perf_counter()
+    writer.close()
+    seconds += perf_counter() - start
+    return {'seconds': seconds,
+            'rows_per_second': rate(writer.num_data, seconds),
+            'mb_per_second': rate(nbytes / 2**20, seconds),
+            'timesteps_per_second': rate(run.num_timesteps, seconds),
+            }
+
+
+def bench_get_timestep(reader, variables):
+    timesteps = np.unique(np.linspace(0, reader.num_timesteps - 1, NUM_SAMPLES).astype(int))
+    rows = 0
+    start = perf_counter()
+    for timestep in timesteps:
+        rows += len(reader.get_timestep(timestep, variables)[variables[0]])
+    seconds = perf_counter() - start
+    return {'seconds': seconds,
+            'calls': len(timesteps),
+            'calls_per_second': rate(len(timesteps), seconds),
+            'rows_per_second': rate(rows, seconds),
+            }
+
+
+def bench_get_all_timesteps(reader, variables, mode):
+    start = perf_counter()
+    reader.get_all_timesteps(variables, mode=mode)
+    seconds = perf_counter() - start
+    return {'seconds': seconds,
+            'rows_per_second': rate(int(reader.data_index[-1]), seconds),
+            }
+
+
+def bench_get_individual_trajectory(reader, run, variables):
+    start = perf_counter()
+    reader.get_id_index()
+    index_seconds = perf_counter() - start
+
+    ids = np.random.default_rng(0).choice(run.ids, min(NUM_SAMPLES, run.num_particles), replace=False)
+    rows = 0
+    start = perf_counter()
+    for particle_id in ids:
+        rows += len(reader.get_individual_trajectory(particle_id, variables)[variables[0]])
+    seconds = perf_counter() - start
+    return {'index_seconds': index_seconds,
+            'seconds': seconds,
+            'calls': len(ids),
+            'calls_per_second': rate(len(ids), seconds),
+            'rows_per_second': rate(rows, seconds),
+            }
+
+
+def run_case(num_particles, num_timesteps, nc_version, workdir, writer_kwargs, modes):
+    """
+    run one case -- in this process
+    """
+    variables = ['longitude', 'latitude']
+    run = SyntheticRun(num_particles, num_timesteps)
+    filename = os.path.join(workdir, 'bench_{}_{}_nc{}.nc'.format(num_particles,
+                                                                 num_timesteps,
+                                                                 nc_version))
+    result = {'num_particles': num_particles,
+              'num_timesteps': num_timesteps,
+              'nc_version': nc_version,
+              'writer_kwargs': writer_kwargs,
+              }
+    try:
+        result['write_timestep'] = bench_write(run, filename, nc_version, writer_kwargs)
+        result['num_rows'] = run.num_rows
+        result['file_size_mb'] = os.path.getsize(filename) / 2**20
+
+        start = perf_counter()
+        reader = nc_particles.Reader(filename)
+        result['open_seconds'] = perf_counter() - start
+        result['get_timestep'] = bench_get_timestep(reader, variables)
+        result['get_all_timesteps'] = {mode: bench_get_all_timesteps(reader, variables, mode)
+                                       for mode in modes}
+        result['get_individual_trajectory'] = bench_get_individual_trajectory(reader, run, variables)
+        reader.close()
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_case_subprocess(num_particles, num_timesteps, nc_version, workdir, writer_kwargs, modes):
+    """
+    run one case in a fresh python process, so its peak RSS is its own
+    """
+    case = {'num_particles': num_particles,
+            'num_timesteps': num_timesteps,
+            'nc_version': nc_version,
+            'workdir': workdir,
+            'writer_kwargs': writer_kwargs,
+            'modes': modes,
+            }
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+                          stdout=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return dict(case, error="exit status {}".format(proc.returncode))
+    # the result is the last line -- anything else printed comes first
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'netCDF4': netCDF4.__version__,
+            'netcdf_lib': netCDF4.__netcdf4libversion__,
+            'hdf5_lib': netCDF4.__hdf5libversion__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            }
+
+
+## the metrics compared -- bigger is better for all but the last two
+COMPARED = [('write_timestep', 'rows_per_second'),
+            ('get_timestep', 'calls_per_second'),
+            ('get_all_timesteps', 'flat', 'rows_per_second'),
+            ('get_all_timesteps', 'rows', 'rows_per_second'),
+            ('get_individual_trajectory', 'calls_per_second'),
+            ('get_individual_trajectory', 'index_seconds'),
+            ('peak_rss_mb',),
+            ('file_size_mb',),
+            ]
+
+
+def _lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+def compare(old, new, outfile=sys.stdout):
+    """
+    print the ratio (new / old) of the main metrics of the matching cases
+    """
+    def key(result):
+        return result['num_particles'], result['num_timesteps'], result['nc_version']
+    old_results = {key(result): result for result in old['results']}
+    for result in new['results']:
+        previous = old_results.get(key(result))
+        if previous is None:
+            continue
+        print("{} particles, {} timesteps, netcdf{}:".format(*key(result)), file=outfile)
+        for path in COMPARED:
+            before, after = _lookup(previous, path), _lookup(result, path)
+            if before and after is not None:
+                print("    {:45s} {:10.4g} -> {:10.4g}  ({:.2f}x)".format(
+                      '.'.join(path), before, after, after / before), file=outfile)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small',
+                        help="the set of sizes to run (default: small)")
+    parser.add_argument('--particles', type=int, nargs='+',
+                        help="numbers of particles -- run with each of --timesteps, in place of the preset")
+    parser.add_argument('--timesteps', type=int, nargs='+',
+                        help="numbers of timesteps -- run with each of --particles")
+    parser.add_argument('--nc-version', type=int, nargs='+', choices=[3, 4], default=[3, 4],
+                        help="netcdf versions to write (default: both)")
+    parser.add_argument('--modes', nargs='+', choices=['rows', 'split', 'flat'], default=['flat', 'rows'],
+                        help="get_all_timesteps modes to time (default: flat rows)")
+    parser.add_argument('--flush-rows', type=int,
+                        help="Writer flush_rows -- default is to write every timestep")
+    parser.add_argument('--compression', action='store_true',
+                        help="use the Writer default compression (netcdf4 only)")
+    parser.add_argument('--max-rows', type=float, default=1e9,
+                        help="skip cases with more than this many rows in total (default: 1e9)")
+    parser.add_argument('--workdir', help="directory for the files (default: a temporary directory)")
+    parser.add_argument('--output', '-o', help="file to write the JSON results to (default: stdout)")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        # running a single case, for run_case_subprocess
+        case = json.loads(args.case)
+        print(json.dumps(run_case(**case)))
+        return
+
+    if args.particles or args.timesteps:
+        cases = [(p, t) for p in (args.particles or [1000]) for t in (args.timesteps or [100])]
+    else:
+        cases = PRESETS[args.preset]
+
+    writer_kwargs = {}
+    if args.flush_rows:
+        writer_kwargs['flush_rows'] = args.flush_rows
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='nc_particles_bench')
+    results = []
+    for num_particles, num_timesteps in cases:
+        run = SyntheticRun(num_particles, num_timesteps)
+        for nc_version in args.nc_version:
+            kwargs = dict(writer_kwargs)
+            if args.compression and nc_version == 4:
+                kwargs['compression'] = True
+            if run.num_rows > args.max_rows:
+                results.append({'num_particles': num_particles,
+                                'num_timesteps': num_timesteps,
+                                'nc_version': nc_version,
+                                'skipped': "{} rows is more than --max-rows".format(run.num_rows),
+                                })
+                continue
+            print("running: {} particles, {} timesteps, netcdf{}".format(num_particles,
+                                                                       num_timesteps,
+                                                                       nc_version),
+                  file=sys.stderr)
+            results.append(run_case_subprocess(num_particles, num_timesteps, nc_version,
+                                               workdir, kwargs, args.modes))
+        del run
+    if not args.workdir:
+        os.rmdir(workdir)
+
+    output = {'metadata': metadata(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(output, outfile, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(json.load(infile), output, sys.stdout if args.output else sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
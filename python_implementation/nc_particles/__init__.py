@@ -1,2 +1,7 @@
-from .nc_particles import Writer, Reader
-
+from .nc_particles import (Writer, AsyncWriter, Reader, IDIndex,
+                           add_id_index, add_bbox_index, add_lod_levels, compact)
+from .classic import MemmapReader
+from .ensemble import MultiReader
+from .iostats import IOStats
+from .relayout import write_trajectory_file
+from .shared_cache import SharedCache, CachedReader
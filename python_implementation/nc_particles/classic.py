@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+Memory-mapped reading of netcdf3 ("classic") nc_particle files
+
+In the classic format, the layout of the data in the file is fully defined
+by the header, so the variables can be accessed as numpy arrays directly on
+a memory map of the file -- no reading, copying or masking by the netcdf
+library. The record (data dimension) variables are interleaved, so they are
+strided views.
+
+See the netcdf classic format specification:
+
+https://docs.unidata.ucar.edu/netcdf-c/current/file_format_specifications.html
+"""
+
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from .nc_particles import Reader
+
+## header tags
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+STREAMING = 0xFFFFFFFF
+
+## netcdf types -> numpy dtypes (always big-endian in the file)
+NC_TYPES = {1: np.dtype('>i1'),
+            2: np.dtype('S1'),
+            3: np.dtype('>i2'),
+            4: np.dtype('>i4'),
+            5: np.dtype('>f4'),
+            6: np.dtype('>f8'),
+            # CDF-5 only
+            7: np.dtype('>u1'),
+            8: np.dtype('>u2'),
+            9: np.dtype('>u4'),
+            10: np.dtype('>i8'),
+            11: np.dtype('>u8'),
+            }
+
+
+class ClassicHeader(object):
+    """
+    The layout of a netcdf classic file, as read from its header
+
+    Attributes are skipped -- use the netcdf library for those.
+
+    dimensions: list of (name, length) -- length is None for the record dimension
+    variables: dict of name: (dimension names, dtype, begin)
+    """
+    def __init__(self, buf, file_size):
+        """
+        :param buf: the contents of the file (at least the whole header)
+        :param file_size: the size of the file in bytes
+        """
+        if buf[:3] != b'CDF' or buf[3] not in (1, 2, 5):
+            raise ValueError("not a netcdf classic format file")
+        self.version = buf[3]
+        self._buf = buf
+        self._pos = 4
+        # CDF-5 uses 64 bit counts, CDF-2 and CDF-5 use 64 bit offsets
+        self._count_format = '>Q' if self.version == 5 else '>I'
+        self._offset_format = '>I' if self.version == 1 else '>Q'
+
+        numrecs = self._unpack(self._count_format)
+        self._vsizes = {}
+        self.dimensions = self._read_list(NC_DIMENSION, self._read_dimension)
+        self._read_list(NC_ATTRIBUTE, self._read_attribute)
+        self.variables = dict(self._read_list(NC_VARIABLE, self._read_variable))
+        del self._buf
+
+        self.record_variables = [name for name, (dims, dtype, begin) in self.variables.items()
+                                 if dims and self.dimension_length(dims[0]) is None]
+        self.record_size = sum(self._vsizes[name] for name in self.record_variables)
+        if len(self.record_variables) == 1:
+            # special case: a single record variable is not padded
+            dims, dtype, begin = self.variables[self.record_variables[0]]
+            self.record_size = dtype.itemsize * int(np.prod(self._shape(dims[1:])))
+
+        if numrecs == STREAMING or numrecs == 0xFFFFFFFFFFFFFFFF:
+            numrecs = 0
+            if self.record_variables and self.record_size:
+                begin = min(self.variables[name][2] for name in self.record_variables)
+                numrecs = (file_size - begin) // self.record_size
+        self.numrecs = numrecs
+
+    def dimension_length(self, name):
+        for dim_name, length in self.dimensions:
+            if dim_name == name:
+                return length
+        raise KeyError(name)
+
+    def _shape(self, dims):
+        return tuple(self.numrecs if self.dimension_length(dim) is None
+                     else self.dimension_length(dim) for dim in dims)
+
+    def _unpack(self, fmt):
+        value, = struct.unpack_from(fmt, self._buf, self._pos)
+        self._pos += struct.calcsize(fmt)
+        return value
+
+    def _read_list(self, tag, read_item):
+        list_tag = self._unpack('>I')
+        num = self._unpack(self._count_format)
+        if list_tag == 0 and num == 0:  # ABSENT
+            return []
+        if list_tag != tag:
+            raise ValueError("corrupt netcdf header")
+        return [read_item() for i in range(num)]
+
+    def _read_name(self):
+        length = self._unpack(self._count_format)
+        name = bytes(self._buf[self._pos:self._pos + length]).decode('utf-8')
+        self._pos += -(-length // 4) * 4  # padded to 4 bytes
+        return name
+
+    def _read_dimension(self):
+        name = self._read_name()
+        length = self._unpack(self._count_format)
+        return name, (length if length != 0 else None)
+
+    def _read_attribute(self):
+        self._read_name()
+        nc_type = self._unpack('>I')
+        num = self._unpack(self._count_format)
+        self._pos += -(-num * NC_TYPES[nc_type].itemsize // 4) * 4
+
+    def _read_variable(self):
+        name = self._read_name()
+        num_dims = self._unpack(self._count_format)
+        dimids = [self._unpack(self._count_format) for i in range(num_dims)]
+        self._read_list(NC_ATTRIBUTE, self._read_attribute)
+        dtype = NC_TYPES[self._unpack('>I')]
+        self._vsizes[name] = self._unpack(self._count_format)
+        begin = self._unpack(self._offset_format)
+        dims = tuple(self.dimensions[i][0] for i in dimids)
+        return name, (dims, dtype, begin)
+
+
+class MemmapReader(Reader):
+    """
+    Reader for netcdf3 ("classic") nc_particle files that memory maps the file
+
+    The data are returned as (read-only) numpy views into the file, rather
+    than being read with the netcdf library, so there is no copying, and
+    no masking of missing values. Unless they are copied, the arrays
+    returned are only valid until the Reader is closed.
+
+    The netcdf library is still used for the metadata (attributes, etc).
+    """
+    _mmap = None
+    def __init__(self, nc_file, lazy=False, auto_mask=True, stats=None):
+        """
+        initialize a memory mapped file reader.
+
+        :param nc_file: name of the netcdf3 file to read.
+        :type nc_file: string
+
+        :param lazy=False, auto_mask=True: as for Reader -- auto_mask only
+                                           applies to what is still read
+                                           with the netcdf library.
+        :type lazy: bool
+
+        :param stats=None: as for Reader -- the reads from the memory
+                           mapped arrays are counted too.
+        :type stats: bool, IOStats or callable
+        """
+        self._map_file(nc_file)
+        Reader.__init__(self, nc_file, lazy, auto_mask, stats)
+
+    def _map_file(self, nc_file):
+        """
+        memory map the file, and set up the arrays
+        """
+        self._close_mmap()
+        with open(nc_file, 'rb') as infile:
+            file_size = os.fstat(infile.fileno()).st_size
+            self._mmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = ClassicHeader(self._mmap, file_size)
+        self.arrays = {name: self._make_array(name) for name in self.header.variables}
+
+    def _close_mmap(self):
+        self.arrays = {}
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # arrays handed out are still using it -- it will be
+                # closed when they are gone.
+                pass
+            self._mmap = None
+
+    def refresh(self):
+        """
+        pick up any new timesteps written to the file since it was opened
+
+        The file is mapped again -- see Reader.refresh
+        """
+        with self._lock:
+            self._map_file(self._filename)
+            return Reader.refresh(self)
+
+    def _make_array(self, name):
+        """
+        a numpy view of a variable, on the memory map
+        """
+        header = self.header
+        dims, dtype, begin = header.variables[name]
+        shape = header._shape(dims)
+        if name in header.record_variables:
+            # one record apart along the data dimension, contiguous within a record
+            inner_strides = []
+            step = dtype.itemsize
+            for length in reversed(shape[1:]):
+                inner_strides.insert(0, step)
+                step *= length
+            strides = (header.record_size,) + tuple(inner_strides)
+            if header.numrecs == 0:
+                begin = 0
+        else:
+            strides = None
+        return np.ndarray(shape, dtype=dtype, buffer=self._mmap, offset=begin, strides=strides)
+
+    def get_array(self, variable):
+        """
+        returns the full array of a variable as a view on the file
+        """
+        return self.arrays[variable]
+
+    def _read_data_slice(self, variable, start, stop):
+        return self.arrays[variable][start:stop]
+
+    def _read_data_points(self, variable, positions):
+        return self.arrays[variable][positions]
+
+    def _read_block(self, variable, start, stop):
+        return self.arrays[variable][start:stop]
+
+    def close(self):
+        """
+        close the file
+        """
+        Reader.close(self)
+        self._close_mmap()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+Export to and import from columnar (Apache Arrow / Parquet) tables
+
+The flattened ragged arrays of an nc_particles file are already columns --
+a table has one row per particle per timestep, with the data variables,
+plus a "timestep" column and a "time" column, which are expanded from the
+per-timestep values with the data_index.
+
+Requires the pyarrow package.
+"""
+
+import os
+from datetime import datetime
+
+import numpy as np
+
+import netCDF4
+
+from .nc_particles import Reader, Writer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def _check_pyarrow():
+    if pyarrow is None:
+        raise ImportError("the pyarrow package is required for columnar export and import")
+
+
+def _to_arrow(values):
+    """
+    a numpy (masked) array as an arrow array -- masked values are null
+
+    Not copied, if it doesn't have to be.
+    """
+    data = np.ma.getdata(values)
+    if not data.dtype.isnative:
+        data = data.astype(data.dtype.newbyteorder('='))
+    if np.ma.is_masked(values):
+        return pyarrow.array(data, mask=np.ma.getmaskarray(values))
+    return pyarrow.array(data)
+
+
+def iter_tables(reader,
+                variables=None,
+                time_range=None,
+                ids=None,
+                batch=100):
+    """
+    iterate over the data of a Reader as arrow tables -- one per block of timesteps
+
+    :param reader: the Reader of the file
+    :type reader: nc_particles.Reader
+
+    :param variables=None: the variables desired as a list string names.
+                           Defaults to all the variables
+    :type variables: list of strings
+
+    :param time_range=None: (start_time, end_time) -- only timesteps in
+                            this time window are read.
+    :type time_range: tuple of datetime objects
+
+    :param ids=None: only these particles are included
+    :type ids: sequence of integers
+
+    :param batch=100: number of timesteps to read at a time
+    :type batch: integer
+    """
+    _check_pyarrow()
+    if variables is None:
+        variables = reader.variables
+    to_read = list(variables)
+    if ids is not None:
+        ids = np.asarray(ids)
+        if 'id' not in to_read:
+            to_read.append('id')
+    if time_range is None:
+        start, stop = 0, reader.num_timesteps
+    else:
+        start, stop = reader.timestep_range(*time_range)
+
+    for first, last, data, data_index in reader.iter_timesteps(to_read,
+                                                               batch=batch,
+                                                               blocks=True,
+                                                               start=start,
+                                                               stop=stop):
+        counts = np.diff(data_index)
+        times = netCDF4.num2date(reader.time_values[first:last],
+                                 reader.time_units,
+                                 reader.calendar,
+                                 only_use_cftime_datetimes=False,
+                                 only_use_python_datetimes=True)
+        times = np.array(times, dtype='datetime64[us]')
+        columns = {'time': np.repeat(times, counts),
+                   'timestep': np.repeat(np.arange(first, last, dtype=np.int32), counts),
+                   }
+        columns.update((var, data[var]) for var in variables)
+        if ids is not None:
+            keep = np.isin(np.ma.getdata(data['id']), ids)
+            columns = {name: values[keep] for name, values in columns.items()}
+        yield pyarrow.table({name: _to_arrow(values) for name, values in columns.items()})
+
+
+def to_arrow(reader, variables=None, time_range=None, ids=None, batch=100):
+    """
+    returns the data of a Reader as a single arrow Table
+
+    See iter_tables() for the parameters.
+    """
+    _check_pyarrow()
+    tables = list(iter_tables(reader, variables, time_range, ids, batch))
+    if not tables:
+        return None
+    return pyarrow.concat_tables(tables)
+
+
+def to_parquet(reader,
+               path,
+               variables=None,
+               time_range=None,
+               ids=None,
+               batch=100,
+               partitioned=False,
+               compression='snappy'):
+    """
+    write the data of a Reader to parquet
+
+    The file is streamed through a block of timesteps at a time.
+
+    :param reader: the Reader of the file -- or the filename
+    :type reader: nc_particles.Reader or string
+
+    :param path: the parquet file to write, or, if partitioned, the
+                 directory to write the files into.
+
+    :param partitioned=False: if True, each block of timesteps is written
+                              to a separate file in the path directory.
+                              Otherwise, each block is a row group in a
+                              single file.
+    :type partitioned: bool
+
+    :param compression='snappy': the parquet compression to use
+
+    See iter_tables() for the other parameters.
+    """
+    _check_pyarrow()
+    own_reader = not isinstance(reader, Reader)
+    if own_reader:
+        reader = Reader(reader, lazy=True)
+    try:
+        if partitioned:
+            os.makedirs(path, exist_ok=True)
+        writer = None
+        for table in iter_tables(reader, variables, time_range, ids, batch):
+            if partitioned:
+                first = table.column('timestep')[0].as_py() if len(table) else None
+                if first is None:
+                    continue
+                filename = os.path.join(path, "part-{:08d}.parquet".format(first))
+                pyarrow.parquet.write_table(table, filename, compression=compression)
+            else:
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(path, table.schema, compression=compression)
+                writer.write_table(table)
+        if writer is not None:
+            writer.close()
+    finally:
+        if own_reader:
+            reader.close()
+
+
+def from_table(table, filename, time_column='time', timestep_column='timestep', **kwargs):
+    """
+    write an nc_particles file from a columnar table
+
+    Each column (other than time and timestep) becomes a data variable.
+
+    :param table: the table -- or the name of a parquet file or directory.
+                  The rows for each timestep must be together, in order.
+    :type table: pyarrow.Table or string
+
+    :param filename: name of the netcdf file to write.
+
+    :param time_column='time': name of the column with the time of each row
+    :type time_column: string
+
+    :param timestep_column='timestep': name of the column with the timestep
+                                       of each row, as written by
+                                       iter_tables(). If the table has it,
+                                       the rows are grouped by it (the
+                                       first becoming timestep 0), and any
+                                       timesteps missing from the table
+                                       (with no particles) are written as
+                                       empty timesteps, with their times
+                                       interpolated from the others. If not,
+                                       the rows are grouped by time -- and
+                                       timesteps with no particles are lost.
+                                       Either way, empty timesteps after the
+                                       last row can't be known about.
+    :type timestep_column: string
+
+    All other keyword arguments are passed on to Writer -- by default, the
+    Writer buffers a million rows at a time.
+    """
+    _check_pyarrow()
+    if not isinstance(table, pyarrow.Table):
+        table = pyarrow.parquet.read_table(table)
+    times = table.column(time_column).to_numpy().astype('datetime64[us]')
+    by_timestep = timestep_column is not None and timestep_column in table.column_names
+    keys = table.column(timestep_column).to_numpy() if by_timestep else times
+    names = [name for name in table.column_names if name not in (time_column, timestep_column)]
+    columns = {name: table.column(name).to_numpy() for name in names}
+
+    # the start of each group of rows
+    starts = np.flatnonzero(np.r_[len(keys) > 0, keys[1:] != keys[:-1]])
+    if np.any(keys[starts][1:] <= keys[starts][:-1]):
+        raise ValueError("the rows must be grouped by {}, in order".format(
+                         'timestep' if by_timestep else 'time'))
+    # the timestep of each group
+    if by_timestep:
+        group_steps = (keys[starts] - keys[starts[0]]).astype(np.int64) if len(starts) else starts
+    else:
+        group_steps = np.arange(len(starts))
+    num_timesteps = int(group_steps[-1]) + 1 if len(starts) else 0
+    counts = np.zeros((num_timesteps,), dtype=np.int64)
+    counts[group_steps] = np.diff(np.r_[starts, len(keys)])
+    bounds = np.r_[0, np.cumsum(counts)]
+    group_times = times[starts].astype(np.int64)
+    step_times = np.round(np.interp(np.arange(num_timesteps), group_steps, group_times)).astype(np.int64)
+    step_times[group_steps] = group_times
+
+    kwargs.setdefault('flush_rows', 2**20)
+    if int(kwargs.get('nc_version', 4)) == 3:
+        kwargs.setdefault('num_timesteps', num_timesteps)
+    writer = Writer(filename, **kwargs)
+    try:
+        for step in range(num_timesteps):
+            ind1, ind2 = bounds[step], bounds[step + 1]
+            timestamp = np.datetime64(int(step_times[step]), 'us').astype(datetime)
+            writer.write_timestep(timestamp, {name: values[ind1:ind2]
+                                              for name, values in columns.items()})
+    finally:
+        writer.close()
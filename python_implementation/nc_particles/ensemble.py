@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+Reading ensembles of nc_particle files
+
+An ensemble is a set of runs (members) of the same model setup -- one
+file per member, all with the same variables and timesteps. The members
+are read in parallel, by a pool of worker processes. The pool is started
+on first use, and kept until the MultiReader is closed, and each worker
+keeps a Reader open for each file it has read, so the files are only
+opened (and their indexes built) once:
+
+    with MultiReader(filenames) as ensemble:
+        for timestep in range(ensemble.num_timesteps):
+            data = ensemble.get_timestep(timestep)
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import netCDF4
+
+from .nc_particles import Reader
+
+
+## the open Readers of this process, keyed by (process ID, filename) -- a
+## forked worker must not use the Readers of the process it was forked from
+_readers = {}
+
+
+def _get_reader(filename):
+    """
+    the Reader for a file in this process -- opened on first use
+    """
+    key = (os.getpid(), filename)
+    reader = _readers.get(key)
+    if reader is None:
+        reader = _readers[key] = Reader(filename, lazy=True)
+    return reader
+
+
+def _close_readers(filenames):
+    """
+    close the Readers of this process for the files
+    """
+    for filename in filenames:
+        reader = _readers.pop((os.getpid(), filename), None)
+        if reader is not None:
+            reader.close()
+
+
+def _apply(filename, func, args):
+    """
+    call func(reader, *args) on the Reader for the file -- runs in the workers
+    """
+    return func(_get_reader(filename), *args)
+
+
+def _get_timestep(reader, timestep, variables):
+    return reader.get_timestep(timestep, variables)
+
+
+def _runs(timesteps):
+    """
+    the (start, stop) of each run of consecutive timesteps in a sorted list
+    """
+    timesteps = np.asarray(timesteps, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(timesteps) != 1) + 1
+    starts = np.concatenate([timesteps[:1], timesteps[breaks]])
+    stops = np.concatenate([timesteps[breaks - 1], timesteps[-1:]]) + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _map_timesteps(reader, func, variables, timesteps, batch):
+    """
+    func(data) for the timesteps (a sorted list, or None for all) -- only
+    the runs of timesteps asked for are read
+    """
+    num_times = reader.num_timesteps
+    if timesteps is None:
+        runs = [(0, num_times)]
+    else:
+        runs = _runs([t for t in timesteps if 0 <= t < num_times])
+    results = []
+    for start, stop in runs:
+        for timestep, data in reader.iter_timesteps(variables,
+                                                    batch=batch,
+                                                    prefetch=stop - start > batch,
+                                                    start=start,
+                                                    stop=stop):
+            results.append(func(data))
+    return results
+
+
+class MultiReader(object):
+    """
+    Class to read an ensemble of nc_particle files in parallel
+    """
+    _executor = None
+    def __init__(self, filenames, processes=None, check=True):
+        """
+        initialize an ensemble reader.
+
+        :param filenames: names of the netcdf files of the ensemble members
+        :type filenames: list of strings
+
+        :param processes=None: number of worker processes to use. None
+                               means one per CPU. If 1, everything is done
+                               in this process. The workers are started on
+                               first use, and kept until close().
+        :type processes: integer
+
+        :param check=True: if True, make sure all the members have the
+                           same variables and times -- a ValueError is
+                           raised if they don't.
+        :type check: bool
+        """
+        self.filenames = [str(filename) for filename in filenames]
+        if not self.filenames:
+            raise ValueError("an ensemble needs at least one file")
+        self.processes = processes
+
+        first = Reader(self.filenames[0], lazy=True)
+        self.variables = first.variables
+        self.time_units = first.time_units
+        self.calendar = first.calendar
+        self.time_values = first.time_values
+        self.times = first.times
+        first.close()
+        if check:
+            for filename in self.filenames[1:]:
+                self._check_member(filename)
+
+    def _check_member(self, filename):
+        reader = Reader(filename, lazy=True)
+        try:
+            if set(reader.variables) != set(self.variables):
+                raise ValueError("{} has different variables: {}".format(filename, reader.variables))
+            values = reader.time_values
+            if reader.time_units != self.time_units:
+                values = netCDF4.date2num(reader.times, self.time_units, self.calendar)
+            if (len(values) != len(self.time_values) or
+                not np.array_equal(values, self.time_values)):
+                raise ValueError("{} has different times".format(filename))
+        finally:
+            reader.close()
+
+    @property
+    def num_members(self):
+        return len(self.filenames)
+
+    @property
+    def num_timesteps(self):
+        return len(self.time_values)
+
+    def __str__(self):
+        return ("nc_particles MultiReader object:\n"
+                "number of members: {}\n"
+                "variables: {}\n"
+                "number of timesteps: {}\n"
+                ).format(self.num_members, self.variables, self.num_timesteps)
+
+    def map(self, func, *args):
+        """
+        call func(reader, *args) for the Reader of each member, in parallel
+
+        func, args and the results must be picklable (i.e. func must be
+        defined at the top level of a module), unless processes is 1.
+
+        :returns results: list of the results, in the order of the files
+        """
+        if self.processes == 1:
+            return [_apply(filename, func, args) for filename in self.filenames]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes)
+        futures = [self._executor.submit(_apply, filename, func, args)
+                   for filename in self.filenames]
+        return [future.result() for future in futures]
+
+    def map_timesteps(self, func, variables=['latitude', 'longitude'], timesteps=None, batch=100):
+        """
+        call func(data) for each timestep of each member, in parallel
+
+        data is the dict returned by Reader.get_timestep. Each member is
+        streamed through in blocks of timesteps by a worker -- only the
+        timesteps asked for are read.
+
+        :param timesteps=None: the timesteps desired -- all of them if None
+        :type timesteps: sequence of integers
+
+        :returns results: list (by member) of lists (by timestep, in order)
+                          of the results
+        """
+        if timesteps is not None:
+            timesteps = sorted(set(timesteps))
+        return self.map(_map_timesteps, func, variables, timesteps, batch)
+
+    def get_timestep(self, timestep, variables=['latitude', 'longitude']):
+        """
+        returns the requested variables data from a given timestep of all
+        the members, concatenated, as a dictionary keyed by the variable names
+
+        An extra 'member' array gives the index of the member (in the order
+        of the files) each particle came from.
+        """
+        results = self.map(_get_timestep, timestep, variables)
+        data = {var: np.ma.concatenate([result[var] for result in results])
+                for var in variables}
+        data['member'] = np.repeat(np.arange(self.num_members),
+                                   [len(result[variables[0]]) for result in results])
+        return data
+
+    def close(self):
+        """
+        shut down the worker processes, and close the files
+        """
+        if self._executor is not None:
+            # the workers' Readers go with them
+            self._executor.shutdown()
+            self._executor = None
+        _close_readers(self.filenames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        """ make sure the workers are shut down """
+        self.close()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Gridding of particle data
+
+Binning of the flattened ragged arrays onto a regular longitude-latitude
+grid, for many timesteps at once, and writing the results to a CF
+gridded netcdf file.
+"""
+
+import numpy as np
+
+import netCDF4
+
+
+def grid_shape(grid):
+    """
+    the (ny, nx) shape of the cells of a grid
+
+    :param grid: (lon_edges, lat_edges) -- the cell edges in each direction
+    """
+    lon_edges, lat_edges = grid
+    return len(lat_edges) - 1, len(lon_edges) - 1
+
+
+def _cell_index(values, edges):
+    """
+    index of the cell each value is in -- -1 if outside the grid
+
+    As with numpy.histogram, the last cell includes its upper edge.
+    """
+    values = np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = len(edges) - 2
+    index[(index >= len(edges) - 1) | np.isnan(values)] = -1
+    return index
+
+
+def bin_ragged(lon, lat, data_index, grid, weights=None):
+    """
+    bin the particles of a block of timesteps onto a grid
+
+    All the timesteps are done at once, with a single bincount.
+
+    :param lon, lat: the positions -- flattened ragged arrays
+    :param data_index: start of each timestep in lon and lat (plus the end)
+    :param grid: (lon_edges, lat_edges) -- the cell edges in each direction
+    :param weights=None: the weight of each particle -- if None, the
+                         particles are counted.
+
+    :returns density: (num_timesteps, ny, nx) array of the sums of the
+                      weights in each cell.
+    """
+    lon_edges, lat_edges = grid
+    ny, nx = grid_shape(grid)
+    num_times = len(data_index) - 1
+    rows = np.repeat(np.arange(num_times), np.diff(data_index))
+    ix = _cell_index(lon, lon_edges)
+    iy = _cell_index(lat, lat_edges)
+    inside = (ix >= 0) & (iy >= 0)
+    cells = (rows[inside] * ny + iy[inside]) * nx + ix[inside]
+    if weights is not None:
+        weights = np.ma.filled(np.ma.asarray(weights, dtype=np.float64), 0.0)[inside]
+    density = np.bincount(cells, weights=weights, minlength=num_times * ny * nx)
+    return density.astype(np.float64).reshape((num_times, ny, nx))
+
+
+def write_density_grid(filename,
+                       grid,
+                       density,
+                       time_values,
+                       time_units,
+                       calendar='standard',
+                       name='density',
+                       units='1',
+                       nc_version=4):
+    """
+    write a gridded density to a CF netcdf file
+
+    :param filename: name of the netcdf file to create
+    :param grid: (lon_edges, lat_edges) -- the cell edges in each direction
+    :param density: (num_timesteps, ny, nx) array
+    :param time_values: the times of the timesteps, in time_units
+    :param time_units: CF time units, e.g. "seconds since 2010-01-01T00:00:00"
+    :param name='density': name of the density variable
+    :param units='1': units of the density variable
+    :param nc_version=4: version of netcdf to use -- must be 3 or 4
+    """
+    lon_edges, lat_edges = [np.asarray(edges, dtype=np.float64) for edges in grid]
+    ny, nx = grid_shape(grid)
+    format = 'NETCDF3_CLASSIC' if int(nc_version) == 3 else 'NETCDF4'
+    with netCDF4.Dataset(filename, 'w', format=format) as nc:
+        nc.Conventions = "CF-1.6"
+        nc.createDimension('time', None)
+        nc.createDimension('lat', ny)
+        nc.createDimension('lon', nx)
+        nc.createDimension('nv', 2)
+
+        time = nc.createVariable('time', np.float64, ('time',))
+        time.standard_name = 'time'
+        time.units = time_units
+        time.calendar = calendar
+        time[:] = time_values
+
+        for dim, edges, standard_name, axis_units in (('lat', lat_edges, 'latitude', 'degrees_north'),
+                                                      ('lon', lon_edges, 'longitude', 'degrees_east')):
+            var = nc.createVariable(dim, np.float64, (dim,))
+            var.standard_name = standard_name
+            var.units = axis_units
+            var.bounds = dim + '_bnds'
+            var[:] = (edges[:-1] + edges[1:]) / 2
+            bounds = nc.createVariable(dim + '_bnds', np.float64, (dim, 'nv'))
+            bounds[:] = np.column_stack((edges[:-1], edges[1:]))
+
+        var = nc.createVariable(name, np.float64, ('time', 'lat', 'lon'))
+        var.units = units
+        var.cell_methods = "time: point area: sum"
+        var[:] = density
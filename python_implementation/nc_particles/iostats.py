@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Instrumentation of the I/O done by the Reader and Writer
+
+An IOStats object counts the reads and writes made through the netcdf
+library (and the time conversions), with the bytes moved and the wall
+time, by the public method that was called and by variable:
+
+    reader = Reader(filename, stats=True)
+    reader.get_all_timesteps(['latitude'])
+    print(reader.stats)
+
+shows, for instance, the number of reads get_all_timesteps made. When
+stats is None (the default), the only cost is a check of that.
+"""
+
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class IOCounter(object):
+    """
+    The count, bytes and wall time of a set of calls
+    """
+    __slots__ = ('calls', 'nbytes', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    def add(self, nbytes, seconds):
+        self.calls += 1
+        self.nbytes += nbytes
+        self.seconds += seconds
+
+    def as_dict(self):
+        return {'calls': self.calls, 'nbytes': self.nbytes, 'seconds': self.seconds}
+
+    def __repr__(self):
+        return "IOCounter(calls={}, nbytes={}, seconds={:.6g})".format(self.calls,
+                                                                      self.nbytes,
+                                                                      self.seconds)
+
+
+class IOStats(object):
+    """
+    Counters of the I/O operations of a Reader or Writer
+
+    operations are counted by (method, operation, variable):
+
+    method: the public method the operation was done for -- the outermost
+            one, if they are nested. None for operations done outside any
+            (e.g. on a prefetching thread).
+    operation: 'read', 'write' or 'num2date'. Reads include the masking of
+               missing values -- compare with auto_mask off to see that.
+    variable: name of the netcdf variable
+
+    The public methods themselves are counted (calls and wall time) in
+    method_counts -- the difference between that and the I/O of the method
+    is the time spent in numpy and python.
+    """
+    def __init__(self, callback=None):
+        """
+        :param callback=None: function called with (method, operation,
+                              variable, nbytes, seconds) for every
+                              operation, as it is done.
+        :type callback: callable
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        zero all the counters
+        """
+        with self._lock:
+            self.counts = {}
+            self.method_counts = {}
+
+    @property
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    @property
+    def current_method(self):
+        """
+        the (outermost) public method being run on this thread
+        """
+        stack = self._stack
+        return stack[0] if stack else None
+
+    @contextmanager
+    def method(self, name):
+        """
+        context manager for running a public method
+        """
+        stack = self._stack
+        stack.append(name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            stack.pop()
+            with self._lock:
+                counter = self.method_counts.get(name)
+                if counter is None:
+                    counter = self.method_counts[name] = IOCounter()
+                counter.add(0, seconds)
+
+    def record(self, operation, variable, nbytes, seconds):
+        """
+        count an operation
+        """
+        method = self.current_method
+        key = (method, operation, variable)
+        with self._lock:
+            counter = self.counts.get(key)
+            if counter is None:
+                counter = self.counts[key] = IOCounter()
+            counter.add(nbytes, seconds)
+        if self.callback is not None:
+            self.callback(method, operation, variable, nbytes, seconds)
+
+    def _total(self, index, value, operation=None):
+        total = IOCounter()
+        with self._lock:
+            for key, counter in self.counts.items():
+                if key[index] == value and (operation is None or key[1] == operation):
+                    total.calls += counter.calls
+                    total.nbytes += counter.nbytes
+                    total.seconds += counter.seconds
+        return total
+
+    def for_method(self, method, operation=None):
+        """
+        the total of the operations done for a method
+
+        :param operation=None: only count this operation -- e.g. 'read'
+        """
+        return self._total(0, method, operation)
+
+    def for_variable(self, variable, operation=None):
+        """
+        the total of the operations done on a variable
+        """
+        return self._total(2, variable, operation)
+
+    def as_dict(self):
+        """
+        the counters as a (JSON friendly) dict
+        """
+        with self._lock:
+            return {'io': [dict(method=method, operation=operation, variable=variable,
+                                **counter.as_dict())
+                           for (method, operation, variable), counter in self.counts.items()],
+                    'methods': {name: counter.as_dict()
+                                for name, counter in self.method_counts.items()},
+                    }
+
+    def __str__(self):
+        lines = ["{:28s} {:9s} {:20s} {:>9s} {:>14s} {:>11s}".format(
+                 'method', 'operation', 'variable', 'calls', 'bytes', 'seconds')]
+        with self._lock:
+            for (method, operation, variable), counter in sorted(self.counts.items(),
+                                                                 key=lambda item: str(item[0])):
+                lines.append("{:28s} {:9s} {:20s} {:9d} {:14d} {:11.6f}".format(
+                             str(method), operation, variable,
+                             counter.calls, counter.nbytes, counter.seconds))
+            for name, counter in sorted(self.method_counts.items()):
+                lines.append("{:28s} {:9s} {:20s} {:9d} {:>14s} {:11.6f}".format(
+                             name, 'total', '', counter.calls, '', counter.seconds))
+        return "\n".join(lines)
+
+
+def make_stats(stats):
+    """
+    the IOStats for a stats argument: None, True, a callback, or an IOStats
+    """
+    if stats is None or stats is False:
+        return None
+    if stats is True:
+        return IOStats()
+    if isinstance(stats, IOStats):
+        return stats
+    if callable(stats):
+        return IOStats(callback=stats)
+    raise TypeError("stats must be None, True, a callable or an IOStats object")
+
+
+def instrumented(method):
+    """
+    decorator for the public methods of a class with a stats attribute
+
+    When stats is set, the method (and the I/O it does) is counted under
+    its name. Generators are counted while they are producing each item.
+    """
+    name = method.__name__
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            items = method(self, *args, **kwargs)
+            if self.stats is None:
+                return items
+            return _counted_items(self.stats, name, items)
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            stats = self.stats
+            if stats is None:
+                return method(self, *args, **kwargs)
+            with stats.method(name):
+                return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _counted_items(stats, name, items):
+    try:
+        while True:
+            with stats.method(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        items.close()
@@ -9,12 +9,38 @@ CF standard (or SOME standard..)
 
 """
 
+import functools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
+from time import monotonic, perf_counter, sleep
 
 import numpy as np
 
 import netCDF4
 
+from .gridding import grid_shape, bin_ragged, write_density_grid
+from .iostats import make_stats, instrumented
+
+## netCDF4 / HDF5 are not thread safe -- not even for different files, as
+## HDF5 has global state. Every call into the library from this package is
+## made holding this lock, whichever Reader or Writer it is for.
+NETCDF_LOCK = threading.RLock()
+
+
+def _netcdf_locked(method):
+    """
+    decorator for a function that uses netCDF4 throughout -- it is run
+    holding NETCDF_LOCK
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with NETCDF_LOCK:
+            return method(*args, **kwargs)
+    return wrapper
+
 ## default attributes -- can be updated by user later.
 
 file_attributes = {'conventions' : "CF-1.6",
@@ -76,11 +102,69 @@ var_attributes['lat'] = var_attributes['latitude']
 
 ## variables used to support the stucture of the file, rather than data
 ## used to remove them from the list of available data variables
-SPECIAL_VARIABLES = ['time','particle_count']
+SPECIAL_VARIABLES = ['time','particle_count','particle_id']
+
+## global attribute with the number of timesteps that have been completely
+## written -- readers should ignore any timesteps after that
+COMMITTED_ATTRIBUTE = 'committed_timesteps'
+
+## variables used to store a particle ID index in the file
+ID_INDEX_VARIABLES = ['id_index_ids', 'id_index_count', 'id_index_order']
+SPECIAL_VARIABLES.extend(ID_INDEX_VARIABLES)
+
+## storage settings for netcdf4 files
+
+## compression used when the Writer is asked for compression=True
+DEFAULT_COMPRESSION = {'zlib': True, 'complevel': 4, 'shuffle': True}
+
+## lossy quantization of the position variables -- can be passed in as
+## (or added to) the Writer's var_storage. Five decimal places of a degree
+## is about a meter.
+POSITION_QUANTIZATION = {'longitude': {'least_significant_digit': 5},
+                         'latitude': {'least_significant_digit': 5},
+                         'depth': {'least_significant_digit': 3},
+                         }
+POSITION_QUANTIZATION['lon'] = POSITION_QUANTIZATION['longitude']
+POSITION_QUANTIZATION['lat'] = POSITION_QUANTIZATION['latitude']
+
+## largest chunk of the data dimension, in bytes -- used when the data are
+## compressed, as bigger chunks compress better
+DATA_CHUNK_BYTES = 2**20
+## number of timesteps in a chunk of uncompressed data, when the Writer is
+## given expected_particles. Uncompressed chunks take their full size on
+## disk, however little is in them, so these are kept small.
+CHUNK_TIMESTEPS = 8
+## chunk size of the time dimension, when it is unlimited
+TIME_CHUNKSIZE = 1024
+
+## storage options that only apply to netcdf4 files
+NC4_STORAGE_OPTIONS = ('zlib', 'complevel', 'shuffle', 'chunksizes',
+                       'contiguous', 'fletcher32', 'compression')
+
+## when reading scattered points from the data dimension, read the whole
+## span in one go if it is less than this many times the number of points
+DENSE_READ_FACTOR = 100
+
+## variables holding the bounding box of each timestep
+BBOX_VARIABLES = ['longitude_min', 'longitude_max', 'latitude_min', 'latitude_max']
+SPECIAL_VARIABLES.extend(BBOX_VARIABLES)
+
+## extension for the ID index "sidecar" file
+ID_INDEX_EXTENSION = ".idindex.npz"
+
+## extension for the companion file laid out by particle (see relayout.py)
+TRAJECTORY_EXTENSION = ".traj.nc"
+
+## variables holding the levels of detail -- the number of particles in
+## each level at each timestep, and the fraction of the particles in each
+LOD_VARIABLES = ['lod_count', 'lod_fraction']
+SPECIAL_VARIABLES.extend(LOD_VARIABLES)
 
 
 class Writer(object):
     nc = None  # so the attribute will always be there.
+    stats = None
+    @_netcdf_locked
     def __init__ (self,
                   filename,
                   num_timesteps=None,
@@ -88,6 +172,17 @@ class Writer(object):
                   file_attributes=file_attributes,
                   var_attributes=var_attributes,
                   nc_version=4,
+                  flush_rows=None,
+                  flush_bytes=None,
+                  flush_interval=None,
+                  compression=None,
+                  var_storage=None,
+                  expected_particles=None,
+                  bbox_index=False,
+                  mode='w',
+                  sync=False,
+                  stats=None,
+                  lod_fractions=None,
                   ):
 
         """
@@ -97,7 +192,7 @@ class Writer(object):
         writes the global attributes, creates required variables etc.
 
         :param filename: name of netcdf file to open - if it exists,
-                         it will be written over!
+                         it will be written over! (unless mode is 'a')
 
         :param num_timesteps=None: number of timesteps that will be output. Must be defined for netcdf3.
                                    Can be None for netcdf4
@@ -119,14 +214,124 @@ class Writer(object):
         :param nc_version=3: version of netcdf to use -- must be 3 or 4. If 4, some extra
                              features are enabled.
         :type nc_version: integer
+
+        Timesteps can be buffered in memory, and written to the file in blocks,
+        which is much faster than many small writes. The buffer is written
+        when any of the following limits is reached, and when the file is
+        closed. If none are set, each timestep is written as it comes in.
+
+        :param flush_rows=None: number of particle records to buffer.
+        :type flush_rows: integer
+
+        :param flush_bytes=None: number of bytes of data to buffer.
+        :type flush_bytes: integer
+
+        :param flush_interval=None: time between writes of the buffer, in
+                                    seconds. It is only checked when a
+                                    timestep is written, so the data can be
+                                    held for longer -- until the next
+                                    write_timestep(), flush() or close().
+        :type flush_interval: float
+
+        :param compression=None: compression for all the data variables: the
+                                 storage keyword arguments to
+                                 netCDF4.Dataset.createVariable, e.g.
+                                 {'zlib': True, 'complevel': 4, 'shuffle': True}.
+                                 True means DEFAULT_COMPRESSION.
+        :type compression: dict or bool
+
+        :param var_storage=None: storage keyword arguments for individual
+                                 variables, keyed by variable name. These
+                                 override compression. POSITION_QUANTIZATION
+                                 can be used here to reduce the precision of
+                                 the positions.
+        :type var_storage: dict of dicts
+
+        :param expected_particles=None: typical number of particles in a
+                                        timestep -- used to pick the chunk
+                                        size of the data variables: a few
+                                        timesteps (CHUNK_TIMESTEPS) if they
+                                        are not compressed, as many as fit
+                                        in DATA_CHUNK_BYTES if they are.
+        :type expected_particles: integer
+
+        Chunking and compression are only available with netcdf4 -- those
+        settings are ignored for netcdf3 files.
+
+        :param bbox_index=False: if True, the bounding box of each timestep
+                                 is stored in the BBOX_VARIABLES, so that
+                                 Reader.query_bbox can skip timesteps.
+                                 Requires longitude and latitude data.
+        :type bbox_index: bool
+
+        :param mode='w': 'w' to create a new file. 'a' to re-open an existing
+                         file, and carry on writing after the last complete
+                         timestep in it (e.g. to restart a run). In that case
+                         num_timesteps, ref_time, file_attributes, nc_version,
+                         bbox_index and lod_fractions are taken from the file.
+        :type mode: string
+
+        :param sync=False: if True, the file is synced to disk every time
+                           the buffer is written, so that Readers in other
+                           processes can follow the file as it is written
+                           (see Reader.refresh).
+        :type sync: bool
+
+        After each write to the file, the number of complete timesteps is
+        stored in the COMMITTED_ATTRIBUTE global attribute. Readers only
+        use the timesteps up to that number, so they never see a partly
+        written one.
+
+        :param stats=None: if True, count the writes to the file -- see
+                           iostats.IOStats. Can also be an IOStats object
+                           (e.g. shared with a Reader), or a callback.
+        :type stats: bool, IOStats or callable
+
+        :param lod_fractions=None: fractions of the particles to keep in
+                                   each level of detail, e.g. [0.1, 0.01].
+                                   The particles of each timestep are
+                                   ordered so that each level is the first
+                                   lod_count of them -- see lod_rank() and
+                                   Reader.get_timestep(level=k). Requires id
+                                   data.
+        :type lod_fractions: sequence of decreasing floats
         """
 
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._buffered = not (flush_rows is None and
+                              flush_bytes is None and
+                              flush_interval is None)
+        self.bbox_index = bbox_index
+        self._buffer = {}
+        # buffer for the variables on the time dimension
+        self._timestep_buffer = {'time': [], 'particle_count': []}
+        self._buffer_bytes = 0
+        self._last_flush = monotonic()
+
         self.num_timesteps = num_timesteps
         self.ref_time = ref_time
 
         self.file_attributes = file_attributes
         self.var_attributes = var_attributes
 
+        if compression is True:
+            compression = DEFAULT_COMPRESSION
+        self.compression = {} if not compression else dict(compression)
+        self.var_storage = {} if var_storage is None else var_storage
+        self.expected_particles = expected_particles
+        self.sync = sync
+        self.stats = make_stats(stats)
+        self.lod_fractions = None if lod_fractions is None else _check_lod_fractions(lod_fractions)
+        self.num_static = 0
+
+        if mode == 'a':
+            self._resume(filename)
+            return
+        elif mode != 'w':
+            raise ValueError("mode must be 'w' or 'a'")
+
         try:
             nc_version = int(nc_version)
         except ValueError:
@@ -141,19 +346,26 @@ class Writer(object):
         if nc_version == 3 and self.num_timesteps is None:
             raise ValueError("You must specify num_timesteps when using netcdf3")
 
+        self.nc_version = nc_version
+
         nc = netCDF4.Dataset(filename, 'w', format=format)
         self.nc = nc
 
         # Global attributes
         for (name, value) in self.file_attributes.items():
             setattr(nc, name, value)
+        nc.setncattr(COMMITTED_ATTRIBUTE, np.int32(0))
 
         # Dimensions
         nc.createDimension('time', self.num_timesteps)
         nc.createDimension('data', None)
 
         # required variables
-        time = nc.createVariable('time', np.int32, ('time',))
+        if nc_version == 4 and self.num_timesteps is None:
+            time_storage = {'chunksizes': (TIME_CHUNKSIZE,)}
+        else:
+            time_storage = {}
+        time = nc.createVariable('time', np.int32, ('time',), **time_storage)
         for name, value in self.var_attributes['time'].items():
             time.setncattr(name, value)
         # make sure there are some units there
@@ -165,65 +377,450 @@ class Writer(object):
         else:
             time.units = 'seconds since {0}'.format(self.ref_time.isoformat())
 
-        pc = nc.createVariable('particle_count', np.int32, ('time',))
+        pc = nc.createVariable('particle_count', np.int32, ('time',), **time_storage)
         for name, value in self.var_attributes['particle_count'].items():
             pc.setncattr(name, value)
         self.time_var = time
 
+        if self.lod_fractions is not None:
+            _create_lod_variables(nc, self.lod_fractions)
+            self._timestep_buffer['lod_count'] = []
+
         self.num_data = 0
         self.current_timestep = 0
+        # what is actually in the file -- the rest is in the buffer
+        self.num_flushed_data = 0
+        self.num_flushed_timesteps = 0
+
+    def _resume(self, filename):
+        """
+        re-open an existing file for appending
 
-    def write_timestep(self, timestamp, data):
+        Everything is recovered from the time and particle_count variables
+        and the file metadata -- the data themselves are not read.
+        """
+        nc = netCDF4.Dataset(filename, 'a')
+        self.nc = nc
+        self.nc_version = 4 if nc.data_model == 'NETCDF4' else 3
+        time_dim = nc.dimensions['time']
+        self.num_timesteps = None if time_dim.isunlimited() else len(time_dim)
+
+        self.time_var = nc.variables['time']
+        units = self.time_var.units
+        if not units.startswith('seconds since'):
+            raise ValueError("can only append to files with time in seconds")
+        self.ref_time = netCDF4.num2date(0, units,
+                                         getattr(self.time_var, 'calendar', 'standard'),
+                                         only_use_cftime_datetimes=False,
+                                         only_use_python_datetimes=True)
+
+        self.current_timestep = complete_timesteps(nc)
+        counts = nc.variables['particle_count'][:self.current_timestep]
+        # anything after the last complete timestep gets written over
+        self.num_data = int(counts.sum()) if len(counts) else 0
+        self.num_flushed_data = self.num_data
+        self.num_flushed_timesteps = self.current_timestep
+        nc.setncattr(COMMITTED_ATTRIBUTE, np.int32(self.current_timestep))
+
+        self._buffer = {name: [] for name, var in nc.variables.items()
+                        if var.dimensions == ('data',) and name not in SPECIAL_VARIABLES}
+        self.bbox_index = all(name in nc.variables for name in BBOX_VARIABLES)
+        if self.bbox_index:
+            for name in BBOX_VARIABLES:
+                self._timestep_buffer[name] = []
+        if 'lod_fraction' in nc.variables:
+            self.lod_fractions = nc.variables['lod_fraction'][:]
+            self._timestep_buffer['lod_count'] = []
+        if 'num_particles' in nc.dimensions:
+            self.num_static = len(nc.dimensions['num_particles'])
+            self._static_variables = set(name for name, var in nc.variables.items()
+                                         if var.dimensions == ('num_particles',) and
+                                         name != 'particle_id')
+
+    @instrumented
+    @_netcdf_locked
+    def write_static(self, ids, data):
+        """
+        write data that do not vary with time
+
+        The data are stored once per particle, on the num_particles
+        dimension, rather than at every timestep. The particle_id variable
+        maps particle IDs to the data.
+
+        :param ids: the particle IDs
+        :type ids: sequence of integers
+
+        :param data: dict of data arrays -- one value per particle ID
+        :type data: dict
+
+        Can be called more than once (for particles released later), with
+        the same variables, but with netcdf3 the total number of particles
+        is fixed by the first call.
+        """
+        nc = self.nc
+        ids = np.asarray(ids)
+        arrays = {key: np.asarray(val) for key, val in data.items()}
+        for val in arrays.values():
+            if len(val) != len(ids):
+                raise ValueError("All static data arrays must be the same length as ids")
+
+        if self.num_static == 0:
+            for key in arrays:
+                if key in nc.variables:
+                    raise ValueError("{} is already a variable in the file".format(key))
+            nc.createDimension('num_particles', None if self.nc_version == 4 else len(ids))
+            var = nc.createVariable('particle_id', ids.dtype, ('num_particles',))
+            var.long_name = "particle ID of the static data"
+            for key, val in arrays.items():
+                var = nc.createVariable(key, val.dtype, ('num_particles',))
+                if key in self.var_attributes:
+                    for name, value in self.var_attributes[key].items():
+                        var.setncattr(name, value)
+            self._static_variables = set(arrays)
+        elif set(arrays) != self._static_variables:
+            raise ValueError("The same static variables must be written every time")
+        elif self.nc_version == 3:
+            raise ValueError("static data can only be written once with netcdf3")
+
+        start, stop = self.num_static, self.num_static + len(ids)
+        self._write('particle_id', start, stop, ids)
+        for key, val in arrays.items():
+            self._write(key, start, stop, val)
+        self.num_static = stop
+
+    @instrumented
+    @_netcdf_locked
+    def write_timestep(self, timestamp, data, field_map=None):
         """
         write the data for a timestep
 
         :param timestamp: the time stamp of the timestep
         :type timestamp: datetime object
 
-        :param data: dict of data arrays -- all parameters for a single time step
-        :type data: dict
+        :param data: dict of data arrays -- all parameters for a single time
+                     step -- or a structured array of records, one per particle
+                     (such as GNOME's LEtype). The fields of the records are
+                     written from views -- they are not split into separate
+                     arrays first.
+        :type data: dict or numpy structured array
+
+        :param field_map=None: which variable each field (or dict key) is
+                               written to -- see record_fields(). If None,
+                               each is written to a variable of the same name.
+        :type field_map: dict
 
         Note: it is assumed that the timesteps will be written sequentially,
               and that the variables will not change after the first timestep
               is written.
         """
+        if self.num_timesteps is not None and self.current_timestep >= self.num_timesteps:
+            raise ValueError("the file only has room for {} timesteps".format(self.num_timesteps))
+        if isinstance(data, np.ndarray):
+            data = record_fields(data, field_map)
+        elif field_map is not None:
+            data = _map_fields(data, field_map)
 
         nc = self.nc
-        if self.current_timestep == 0:
+        particle_count = len(next(iter(data.values())))  # length of an arbitrary array
+        arrays = {}
+        # the buffer needs its own copy -- the caller may re-use the arrays
+        # (re-ordering for the levels of detail makes one anyway)
+        copy = self._buffered and self.lod_fractions is None
+        for key, val in data.items():
+            val = np.array(val) if copy else np.asarray(val)
+            if len(val) != particle_count:
+                raise ValueError("All data arrays must be the same length")
+            arrays[key] = val
+        if self.lod_fractions is not None:
+            if 'id' not in arrays:
+                raise ValueError("lod_fractions requires id data")
+            arrays, lod_count = _lod_order(arrays, self.lod_fractions)
+
+        if not self._buffer:
             # create the variables and add attributes
             # set the time units:
             if self.ref_time is None:
                 self.ref_time = timestamp
             nc.variables['time'].units = 'seconds since {0}'.format(self.ref_time.isoformat())
-            for key, val in data.items():
-                val = np.asarray(val)
-                var = nc.createVariable(key, datatype=val.dtype, dimensions=('data'))
+            for key, val in arrays.items():
+                var = nc.createVariable(key,
+                                        datatype=val.dtype,
+                                        dimensions=('data'),
+                                        **self._storage_options(key, val.dtype))
                 # if it's a standard variable, add the attributes
                 if key in self.var_attributes:
                     for name, value in self.var_attributes[key].items():
                         var.setncattr(name, value)
-
-        particle_count = len(next(iter(data.values())))  # length of an arbitrary array
-        nc.variables['particle_count'][self.current_timestep] = particle_count
-        nc.variables['time'][self.current_timestep] = (timestamp - self.ref_time).total_seconds()
+                self._buffer[key] = []
+            if self.bbox_index:
+                self._create_bbox_variables()
+        elif arrays.keys() != self._buffer.keys():
+            raise ValueError("The same variables must be written at every timestep")
+
+        for key, val in arrays.items():
+            self._buffer[key].append(val)
+            self._buffer_bytes += val.nbytes
+        timestep_buffer = self._timestep_buffer
+        timestep_buffer['particle_count'].append(particle_count)
+        timestep_buffer['time'].append((timestamp - self.ref_time).total_seconds())
+        if self.lod_fractions is not None:
+            timestep_buffer['lod_count'].append(lod_count)
+        if self.bbox_index:
+            for name in ('longitude', 'latitude'):
+                mins, maxs = _row_bounds(arrays[name], np.array([0, particle_count]))
+                timestep_buffer[name + '_min'].append(mins[0])
+                timestep_buffer[name + '_max'].append(maxs[0])
         self.current_timestep += 1
-        for key, val in data.items():
-            var = nc.variables[key]
-            if len(val) != particle_count:
-                raise ValueError("All data arrays must be the same length")
-            var[self.num_data:] = val
         self.num_data += particle_count
 
+        if self._flush_needed():
+            self.flush()
+
+    def _create_bbox_variables(self):
+        """
+        create the per-timestep bounding box variables
+        """
+        if not ('longitude' in self._buffer and 'latitude' in self._buffer):
+            raise ValueError("bbox_index requires longitude and latitude data")
+        for name in BBOX_VARIABLES:
+            var = self.nc.createVariable(name, np.float64, ('time',), fill_value=np.nan)
+            var.long_name = "{} of the particles in a given timestep".format(name.replace('_', ' '))
+            self._timestep_buffer[name] = []
+
+    def _storage_options(self, key, dtype):
+        """
+        the createVariable storage keyword arguments for a data variable
+        """
+        options = dict(self.compression)
+        options.update(self.var_storage.get(key, {}))
+        if self.nc_version == 3:
+            for name in NC4_STORAGE_OPTIONS:
+                options.pop(name, None)
+        elif 'chunksizes' not in options and not options.get('contiguous', False):
+            # whole timesteps per chunk, up to about DATA_CHUNK_BYTES
+            max_chunksize = max(DATA_CHUNK_BYTES // np.dtype(dtype).itemsize, 1)
+            compressed = options.get('zlib') or options.get('compression')
+            if self.expected_particles:
+                per_step = min(int(self.expected_particles), max_chunksize)
+                num_steps = max_chunksize // per_step
+                if not compressed:
+                    num_steps = min(num_steps, CHUNK_TIMESTEPS)
+                options['chunksizes'] = (per_step * num_steps,)
+            elif compressed:
+                options['chunksizes'] = (max_chunksize,)
+            # otherwise the netcdf library's (small) default chunks are used
+        return options
+
+    def _flush_needed(self):
+        """
+        check the buffer against the flush limits
+        """
+        if not self._buffered:
+            return True
+        if (self.flush_rows is not None and
+            self.num_data - self.num_flushed_data >= self.flush_rows):
+            return True
+        if self.flush_bytes is not None and self._buffer_bytes >= self.flush_bytes:
+            return True
+        if (self.flush_interval is not None and
+            monotonic() - self._last_flush >= self.flush_interval):
+            return True
+        return False
+
+    @instrumented
+    @_netcdf_locked
+    def flush(self):
+        """
+        write all the buffered timesteps to the file
+        """
+        self._last_flush = monotonic()
+        if self.num_flushed_timesteps == self.current_timestep:
+            return
+        nc = self.nc
+        start, stop = self.num_flushed_data, self.num_data
+        if stop > start:
+            for key, blocks in self._buffer.items():
+                block = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+                self._write(key, start, stop, block)
+        t_start, t_stop = self.num_flushed_timesteps, self.current_timestep
+        for key, values in self._timestep_buffer.items():
+            self._write(key, t_start, t_stop, values)
+        # only now is it safe for readers to use the new timesteps
+        nc.setncattr(COMMITTED_ATTRIBUTE, np.int32(t_stop))
+        if self.sync:
+            nc.sync()
+        # the buffer is only emptied once it is all written -- if a write
+        # fails, the next flush tries it all again
+        for blocks in self._buffer.values():
+            del blocks[:]
+        for values in self._timestep_buffer.values():
+            del values[:]
+        self._buffer_bytes = 0
+        self.num_flushed_data = stop
+        self.num_flushed_timesteps = t_stop
+
+    def _write(self, variable, start, stop, values):
+        """
+        write a block of a variable -- all writes of data go through here
+        """
+        if self.stats is None:
+            self.nc.variables[variable][start:stop] = values
+            return
+        begin = perf_counter()
+        self.nc.variables[variable][start:stop] = values
+        self.stats.record('write', variable, np.asarray(values).nbytes, perf_counter() - begin)
+
+    @_netcdf_locked
     def close(self):
         """
         close the netcdf file
         """
-        if self.nc is not None:  # in case it hasn't been intialized properly
+        # in case it hasn't been intialized properly, or is already closed
+        # (a closed Dataset's id may have been reused by another open file)
+        if self.nc is not None and self.nc.isopen():
             try:
-                self.nc.close()
-            except RuntimeError:
-                # just in case it isn't still open
-                pass
+                self.flush()
+            finally:
+                try:
+                    self.nc.close()
+                except RuntimeError:
+                    # just in case it isn't still open
+                    pass
+
+    def __del__(self):
+        """ make sure to close the netcdf file """
+        self.close()
+
+
+class AsyncWriter(object):
+    """
+    A Writer that does the writing in a background thread
+
+    Has the same API as Writer -- write_timestep() copies the data and puts
+    them in a queue, and returns right away. A single thread writes the
+    queued timesteps, in order.
+
+    If the queue is full, write_timestep() waits for room, so a slow file
+    system will slow down the caller, rather than using up all the memory.
+
+    Any error in writing is raised by the next call to write_timestep()
+    or close().
+
+    WARNING: netCDF4 / HDF5 are not thread safe, even for different files.
+    The writing thread holds NETCDF_LOCK while it uses the library, as do
+    the Readers and everything else in nc_particles -- but netCDF4 used
+    directly (or by another package) knows nothing of it. While an
+    AsyncWriter is open, do not use netCDF4 anywhere else in the process,
+    except while holding NETCDF_LOCK:
+
+        with nc_particles.nc_particles.NETCDF_LOCK:
+            ...
+    """
+    _thread = None
+    def __init__(self, filename, *args, max_queued=16, **kwargs):
+        """
+        create a nc_particle file Writer that writes in the background
+
+        :param filename: name of netcdf file to open - if it exists,
+                         it will be written over!
+
+        :param max_queued=16: the maximum number of timesteps waiting to
+                              be written -- keyword only.
+        :type max_queued: integer
+
+        All other arguments are passed on to Writer.
+        """
+        # created here, so that errors in the arguments are raised here
+        self.writer = Writer(filename, *args, **kwargs)
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="nc_particles AsyncWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """
+        the writing thread
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # closing -- whatever happens, the thread ends here
+                try:
+                    self.writer.close()
+                except Exception as err:
+                    self._set_error(err)
+                finally:
+                    self._queue.task_done()
+                return
+            try:
+                if self._error is None:
+                    method, args = item
+                    method(*args)
+            except Exception as err:
+                self._set_error(err)
+            finally:
+                self._queue.task_done()
+
+    def _set_error(self, err):
+        # the first error is the one that matters -- later ones are
+        # usually caused by it
+        if self._error is None:
+            self._error = err
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _put(self, method, *args):
+        self._raise_error()
+        if self._closed:
+            raise ValueError("the AsyncWriter has been closed")
+        self._queue.put((method, args))
+
+    def write_timestep(self, timestamp, data, field_map=None):
+        """
+        queue the data for a timestep to be written
+
+        See Writer.write_timestep -- the data are copied, so the arrays
+        can be re-used as soon as this returns.
+        """
+        if isinstance(data, np.ndarray):
+            data = record_fields(data, field_map)
+        elif field_map is not None:
+            data = _map_fields(data, field_map)
+        data = {key: np.array(val) for key, val in data.items()}
+        particle_count = len(next(iter(data.values())))
+        if any(len(val) != particle_count for val in data.values()):
+            raise ValueError("All data arrays must be the same length")
+        self._put(self.writer.write_timestep, timestamp, data)
+
+    def write_static(self, ids, data):
+        """
+        queue static data to be written -- see Writer.write_static
+        """
+        data = {key: np.array(val) for key, val in data.items()}
+        self._put(self.writer.write_static, np.array(ids), data)
+
+    def flush(self):
+        """
+        wait for everything queued so far to be written to the file
+        """
+        self._put(self.writer.flush)
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        write everything still in the queue, and close the netcdf file
+        """
+        if self._thread is None or self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
 
     def __del__(self):
         """ make sure to close the netcdf file """
@@ -237,7 +834,20 @@ class Reader():
     (such as those written by GNOME or the Writer class above)
     """
     nc = None  # so the attribute will always be there.
-    def __init__(self, nc_file):
+    stats = None
+    _id_index = None
+    _time_values = None
+    _times = None
+    _data_index = None
+    _static_variables = None
+    _static_table = None
+    _lod_count = None
+    _trajectory_file = None
+    # all access to the file is done holding this -- see NETCDF_LOCK
+    _lock = NETCDF_LOCK
+    _auto_mask = True
+    @_netcdf_locked
+    def __init__(self, nc_file, lazy=False, auto_mask=True, stats=None):
         """
         initialize a file reader.
 
@@ -246,39 +856,321 @@ class Reader():
                         using that filename
         :type nc_file: string or netCDF4 Dataset object
 
+        :param lazy=False: if True, the time and particle_count variables are
+                           not read, and the times are not converted to
+                           datetimes, until they are needed. Useful for
+                           opening a file just to look at its metadata.
+        :type lazy: bool
+
+        :param auto_mask=True: if False, the data are returned as plain
+                               numpy arrays, with missing values left as the
+                               fill value -- see set_auto_mask()
+        :type auto_mask: bool
+
+        :param stats=None: if True, count the reads from the file, by
+                           method and variable -- see iostats.IOStats. Can
+                           also be an IOStats object, or a callback.
+        :type stats: bool, IOStats or callable
         """
 
+        self.stats = make_stats(stats)
+
         if type(nc_file) == netCDF4.Dataset:
             # already open -- just use it
             self.nc = nc_file
+            self._filename = None
         else:
             # open a new one
             self.nc = netCDF4.Dataset(nc_file)
+            self._filename = nc_file
+        if not auto_mask:
+            self.set_auto_mask(False)
 
         time = self.nc.variables['time']
-        units = time.getncattr('units')
-        self.times = netCDF4.num2date(time[:], units)
-        self.time_units = units
-
+        self.time_units = time.getncattr('units')
+        self.calendar = getattr(time, 'calendar', 'standard')
         self.particle_count = self.nc.variables['particle_count']
-        # build the index:
-        self.data_index = np.zeros((len(self.times) + 1,), dtype=np.int32)
-        self.data_index[1:] = np.cumsum(self.particle_count)
+
+        if not lazy:
+            # read the times and build the index now, rather than on first use
+            self.times
+            self.data_index
+
+    @property
+    def num_timesteps(self):
+        """
+        the number of timesteps in the file
+
+        If the file has a COMMITTED_ATTRIBUTE, only the timesteps that have
+        been completely written are counted.
+        """
+        with self._lock:
+            num_times = len(self.nc.dimensions['time'])
+            committed = getattr(self.nc, COMMITTED_ATTRIBUTE, None)
+        return num_times if committed is None else min(num_times, int(committed))
+
+    @property
+    def max_particle_count(self):
+        """
+        the largest number of particles in any timestep
+        """
+        if self.num_timesteps == 0:
+            return 0
+        return int(np.diff(self.data_index).max())
+
+    def set_auto_mask(self, value):
+        """
+        turn the masking of missing values on or off
+
+        With it off, the data are read as plain numpy arrays -- no masks are
+        made or checked, which saves time and memory in tight loops. Missing
+        values are then left as the fill value of the variable.
+        """
+        with self._lock:
+            self.nc.set_auto_mask(value)
+        # kept, to set again when the file is re-opened
+        self._auto_mask = value
+
+    def allocate_buffers(self, variables=['latitude', 'longitude'], size=None):
+        """
+        returns a dict of arrays to use as out= buffers for get_timestep
+
+        :param size=None: length of the arrays -- defaults to the
+                          max_particle_count, which is enough for any timestep
+        """
+        if size is None:
+            size = self.max_particle_count
+        return {var: np.empty((size,), dtype=self.nc.variables[var].dtype) for var in variables}
+
+    @property
+    @instrumented
+    def time_values(self):
+        """
+        the times as numbers, in time_units -- read on first use
+        """
+        if self._time_values is None:
+            self._time_values = self._read_variable('time', 0, self.num_timesteps)
+        return self._time_values
+
+    @property
+    @instrumented
+    def times(self):
+        """
+        the times as datetimes -- converted on first use
+        """
+        if self._times is None:
+            self._times = self._num2date(self.time_values)
+        return self._times
+
+    @property
+    @instrumented
+    def time_span(self):
+        """
+        the (first, last) times in the file, as datetimes
+
+        Only the two times are read and converted.
+        """
+        if self.num_timesteps == 0:
+            return None
+        if self._times is not None:
+            return self._times[0], self._times[-1]
+        first = self._read_variable('time', 0, 1)[0]
+        last = self._read_variable('time', self.num_timesteps - 1, self.num_timesteps)[0]
+        return tuple(self._num2date([first, last]))
+
+    def _num2date(self, values):
+        """
+        convert time values to datetimes
+        """
+        if self.stats is None:
+            return netCDF4.num2date(values, self.time_units, self.calendar)
+        begin = perf_counter()
+        times = netCDF4.num2date(values, self.time_units, self.calendar)
+        self.stats.record('num2date', 'time', np.asarray(values).nbytes, perf_counter() - begin)
+        return times
+
+    @property
+    @instrumented
+    def data_index(self):
+        """
+        the start of each timestep in the data dimension (plus the end of the last one)
+
+        timestep i is data[data_index[i]:data_index[i + 1]] -- built on first use
+        """
+        if self._data_index is None:
+            counts = self._read_variable('particle_count', 0, self.num_timesteps)
+            data_index = np.zeros((len(counts) + 1,), dtype=np.int64)
+            data_index[1:] = np.cumsum(counts)
+            self._data_index = data_index
+        return self._data_index
+
+    @instrumented
+    def refresh(self):
+        """
+        pick up any new timesteps written to the file since it was opened
+
+        For following a file while it is being written (by a Writer with
+        sync=True). The file is re-opened, and only the new part of
+        the time and particle_count variables is read.
+
+        Note: with netcdf4 (HDF5) files, the reading process may need the
+        HDF5_USE_FILE_LOCKING=FALSE environment variable set to open a file
+        that is open for writing.
+
+        :returns num_new: the number of new timesteps
+        """
+        with self._lock:
+            old_num = self.num_timesteps
+            if self._filename is not None:
+                self.nc.close()
+                self.nc = netCDF4.Dataset(self._filename)
+                self.nc.set_auto_mask(self._auto_mask)
+            self.particle_count = self.nc.variables['particle_count']
+            self._static_variables = None
+            self._static_table = None
+            self._lod_count = None
+            self._close_trajectory_file()
+            num = self.num_timesteps
+            if self._time_values is not None:
+                old = len(self._time_values)
+                new_values = self._read_variable('time', old, num)
+                self._time_values = np.ma.concatenate([self._time_values, new_values])
+                if self._times is not None:
+                    new_times = self._num2date(new_values)
+                    self._times = np.concatenate([self._times, new_times])
+            if self._data_index is not None:
+                old = len(self._data_index) - 1
+                counts = self._read_variable('particle_count', old, num)
+                self._data_index = np.concatenate([self._data_index,
+                                                   self._data_index[-1] + np.cumsum(counts)])
+            if (self._id_index is not None and
+                self._id_index.num_data != self.data_index[-1]):
+                self._id_index = None
+        return num - old_num
+
+    @instrumented
+    def follow(self, variables=['latitude', 'longitude'], start=None, poll_interval=1.0, timeout=None):
+        """
+        iterate over the timesteps as they are written to the file
+
+        Yields (timestep, data) tuples, like iter_timesteps(), calling
+        refresh() to look for new timesteps.
+
+        :param start=None: the first timestep -- if None, start with the
+                           next one to be written.
+        :type start: integer
+
+        :param poll_interval=1.0: time between checks for new timesteps, in seconds
+        :type poll_interval: float
+
+        :param timeout=None: stop if there are no new timesteps for this
+                             long, in seconds. If None, never stop.
+        :type timeout: float
+        """
+        timestep = self.num_timesteps if start is None else start
+        last_new = monotonic()
+        while True:
+            if timestep < self.num_timesteps:
+                yield timestep, self.get_timestep(timestep, variables)
+                timestep += 1
+                last_new = monotonic()
+                continue
+            if timeout is not None and monotonic() - last_new >= timeout:
+                return
+            sleep(poll_interval)
+            self.refresh()
 
     @property
     def variables(self):
         """
         return the names of all the variables associated with the particles
+
+        This includes the static variables.
         """
         return [var for var in self.nc.variables.keys() if var not in SPECIAL_VARIABLES]
 
+    @property
+    def lod_fractions(self):
+        """
+        the fraction of the particles in each level of detail -- empty if
+        the file doesn't have any (see add_lod_levels())
+        """
+        if 'lod_fraction' not in self.nc.variables:
+            return np.zeros((0,))
+        return np.ma.getdata(self._read_variable('lod_fraction'))
+
+    def lod_count(self, timestep, level):
+        """
+        the number of particles in a level of detail at a timestep
+        """
+        if 'lod_count' not in self.nc.variables:
+            raise ValueError("the file has no levels of detail -- see add_lod_levels()")
+        if self._lod_count is None or len(self._lod_count) < self.num_timesteps:
+            self._lod_count = self._read_variable('lod_count', 0, self.num_timesteps)
+        return int(self._lod_count[timestep, level])
+
+    @property
+    def static_variables(self):
+        """
+        return the names of the variables that are not time-varying
+
+        These are stored once per particle (see Writer.write_static), but
+        can be read like any other variable -- the values are looked up
+        by particle ID.
+        """
+        if self._static_variables is None:
+            self._static_variables = [name for name, var in self.nc.variables.items()
+                                      if var.dimensions == ('num_particles',) and
+                                      name not in SPECIAL_VARIABLES]
+        return self._static_variables
+
+    @instrumented
+    def get_static(self, variables=None):
+        """
+        returns the static (per particle) data as a dictionary keyed by the
+        variable names, plus 'particle_id' -- the ID of each particle
+
+        :param variables=None: the variables desired as a list string names.
+                               Defaults to all the static variables
+        :type variables: list of strings
+        """
+        if variables is None:
+            variables = self.static_variables
+        data = {var: self._read_variable(var) for var in variables}
+        data['particle_id'] = self._read_variable('particle_id')
+        return data
+
+    def _join_static(self, variable, ids):
+        """
+        the values of a static variable for an array of particle IDs
+
+        Particles that are not in the static table are masked.
+        """
+        if self._static_table is None:
+            particle_ids = self._read_variable('particle_id')
+            order = np.argsort(particle_ids, kind='stable')
+            self._static_table = (particle_ids[order], order, {})
+        sorted_ids, order, values = self._static_table
+        if variable not in values:
+            values[variable] = self._read_variable(variable)
+        if len(sorted_ids) == 0:
+            return np.ma.masked_all((len(ids),), dtype=values[variable].dtype)
+        i = np.searchsorted(sorted_ids, ids)
+        found = i < len(sorted_ids)
+        found[found] = sorted_ids[i[found]] == np.asarray(ids)[found]
+        i[~found] = 0
+        result = np.ma.asarray(values[variable][order[i]])
+        result[~found] = np.ma.masked
+        return result
+
     def __str__(self):
         return ("nc_particles Reader object:\n"
                 "variables: {}\n"
                 "number of timesteps: {}\n"
-                ).format(self.variables, len(self.times))
+                ).format(self.variables, self.num_timesteps)
 
-    def get_all_timesteps(self, variables=['latitude', 'longitude']):
+    @instrumented
+    def get_all_timesteps(self, variables=['latitude', 'longitude'], mode='rows', out=None):
         """
         returns the requested variables data from all timesteps as a
         dictionary keyed by the variable names
@@ -287,20 +1179,484 @@ class Reader():
                           Defaults to ['latitude','longitude']
         :type variables: list of strings
 
+        :param mode='rows': how the data are read and returned:
+
+            'rows': one read per timestep -- each value is a list of
+                    arrays, one per timestep.
+            'split': one read per variable -- each value is a list of
+                     views into the single array, one per timestep.
+            'flat': one read per variable -- returns a (data, data_index)
+                    tuple, where the values in data are the flattened
+                    ragged arrays, and data_index gives the start of each
+                    timestep (timestep i is data[var][data_index[i]:data_index[i+1]])
+        :type mode: string
+
+        :param out=None: dict of arrays, keyed by variable name, to copy the
+                         data into, rather than returning new arrays. They
+                         must be at least as long as the data dimension
+                         (data_index[-1]). The values returned are views of
+                         them -- in 'rows' mode too, which then reads each
+                         variable in one go, as 'split' does. See
+                         get_timestep about the temporary arrays.
+        :type out: dict of arrays
+
         :returns data: returns a dict of arrays -- the keys are the
-                       variable names, and the values are numpy arrays
-                        of the data. The arrays are the flattened ragged
-                        array of data.
+                       variable names, and the values are the data,
+                       as described for mode.
         """
+        if mode not in ('rows', 'split', 'flat'):
+            raise ValueError("mode must be one of 'rows', 'split' or 'flat'")
+        num_times = self.num_timesteps
         data = {}
+        if mode == 'rows' and out is None:
+            for var in variables:
+                data[var] = []
+                for i in range(num_times):
+                    ind1 = self.data_index[i]
+                    ind2 = self.data_index[i + 1]
+                    data[var].append(self._read_slice(var, ind1, ind2))
+            return data
+
+        data, data_index = self._read_rows(variables, 0, num_times, out)
+        if mode == 'flat':
+            return data, data_index
+        return {var: np.split(arr, data_index[1:-1]) for var, arr in data.items()}
+
+    @instrumented
+    def iter_timesteps(self,
+                       variables=['latitude', 'longitude'],
+                       batch=100,
+                       blocks=False,
+                       prefetch=True,
+                       start=0,
+                       stop=None):
+        """
+        iterate over the timesteps, reading them in blocks
+
+        Each block of timesteps is read with one read per variable, so it
+        is much faster than calling get_timestep for each timestep, but
+        only one block (two if prefetching) is in memory at a time.
+
+        :param variables: the variables desired as a list string names.
+                          Defaults to ['latitude','longitude']
+        :type variables: list of strings
+
+        :param batch=100: number of timesteps to read at a time
+        :type batch: integer
+
+        :param blocks=False: if True, yield each block, rather than each timestep
+        :type blocks: bool
+
+        :param prefetch=True: if True, the next block is read in a background
+                              thread while the current one is being used.
+                              The reads are made holding NETCDF_LOCK, so
+                              anything else using netCDF4 in the process
+                              while iterating must hold it too.
+        :type prefetch: bool
+
+        :param start=0, stop=None: only iterate over timesteps start:stop
+        :type start, stop: integer
+
+        :returns: an iterator. If blocks is False it yields
+                  (timestep, data) tuples, where data is as returned by
+                  get_timestep(). If blocks is True it yields
+                  (start, stop, data, data_index) tuples, where data holds the
+                  flattened ragged arrays for timesteps start:stop, and
+                  data_index the start of each timestep in them, as for
+                  get_all_timesteps(mode='flat').
+        """
+        batch = max(int(batch), 1)
+        num_times = self.num_timesteps if stop is None else min(stop, self.num_timesteps)
+        starts = range(start, num_times, batch)
+
+        def read(first):
+            last = min(first + batch, num_times)
+            return (first, last) + self._read_rows(variables, first, last)
+
+        def iter_blocks():
+            if not prefetch:
+                for first in starts:
+                    yield read(first)
+                return
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                next_block = None
+                for first in starts:
+                    block = executor.submit(read, first) if next_block is None else next_block
+                    next_first = first + batch
+                    next_block = (executor.submit(read, next_first)
+                                  if next_first < num_times else None)
+                    yield block.result()
+
+        for first, last, data, data_index in iter_blocks():
+            if blocks:
+                yield first, last, data, data_index
+            else:
+                for i in range(last - first):
+                    ind1, ind2 = data_index[i:i + 2]
+                    yield first + i, {var: arr[ind1:ind2] for var, arr in data.items()}
+
+    def _read_rows(self, variables, start, stop, out=None):
+        """
+        read the data for timesteps start:stop -- one read per variable
+
+        :param out=None: dict of arrays to read the data into
+        :returns (data, data_index): the flattened ragged arrays, and the
+                                     start of each timestep in them.
+        """
+        ind1, ind2 = self.data_index[start], self.data_index[stop]
+        if out is None:
+            data = {var: self._read_slice(var, ind1, ind2) for var in variables}
+        else:
+            data = {var: self._out_view(out[var], ind2 - ind1) for var in variables}
+            for var, view in data.items():
+                self._read_into(var, ind1, ind2, view)
+        return data, self.data_index[start:stop + 1] - ind1
+
+    def _time_value(self, t):
+        """
+        convert a datetime to the numeric units of the time variable
+        """
+        return netCDF4.date2num(t, self.time_units, self.calendar)
+
+    @instrumented
+    def time_index(self, t, method='nearest'):
+        """
+        returns the index of the timestep for a given time
+
+        The numeric time axis is binary searched -- there is no scan of the times.
+
+        :param t: the time desired
+        :type t: datetime object
+
+        :param method='nearest': how to choose the timestep:
+                                 'nearest': the closest timestep
+                                 'before': the last timestep at or before t
+                                 'exact': the timestep exactly at t
+        :type method: string
+
+        Raises a ValueError if there is no such timestep.
+        """
+        value = self._time_value(t)
+        values = self.time_values
+        num_times = len(values)
+        i = np.searchsorted(values, value, side='right')
+        if method == 'before':
+            if i == 0:
+                raise ValueError("{} is before the first timestep".format(t))
+            return int(i - 1)
+        elif method == 'exact':
+            if i == 0 or values[i - 1] != value:
+                raise ValueError("there is no timestep at {}".format(t))
+            return int(i - 1)
+        elif method == 'nearest':
+            if num_times == 0:
+                raise ValueError("there are no timesteps in the file")
+            if i == num_times or (i > 0 and value - values[i - 1] <= values[i] - value):
+                return int(max(i - 1, 0))
+            return int(i)
+        raise ValueError("method must be one of 'nearest', 'before', or 'exact'")
+
+    @instrumented
+    def timestep_range(self, start_time, end_time):
+        """
+        returns (start, stop): the timesteps from start_time to end_time
+        (inclusive) are range(start, stop)
+
+        :param start_time: beginning of the time window
+        :type start_time: datetime object
+
+        :param end_time: end of the time window
+        :type end_time: datetime object
+        """
+        start = np.searchsorted(self.time_values, self._time_value(start_time), side='left')
+        stop = np.searchsorted(self.time_values, self._time_value(end_time), side='right')
+        return int(start), int(max(start, stop))
+
+    @instrumented
+    def get_at_time(self, t, variables=['latitude', 'longitude'], method='nearest'):
+        """
+        returns the requested variables data from the timestep at a
+        given time as a dictionary keyed by the variable names
+
+        :param t: the time desired
+        :type t: datetime object
+
+        :param variables: The variables desired as a list string names.
+                          Defaults to ['latitude','longitude']
+        :type variables: list of strings
+
+        :param method='nearest': how to choose the timestep -- see time_index()
+        :type method: string
+        """
+        return self.get_timestep(self.time_index(t, method), variables)
+
+    @instrumented
+    def get_time_range(self, start_time, end_time, variables=['latitude', 'longitude']):
+        """
+        returns the requested variables data for all the timesteps from
+        start_time to end_time (inclusive)
+
+        The whole time window is read with one read per variable.
+
+        :param start_time: beginning of the time window
+        :type start_time: datetime object
+
+        :param end_time: end of the time window
+        :type end_time: datetime object
+
+        :param variables: The variables desired as a list string names.
+                          Defaults to ['latitude','longitude']
+        :type variables: list of strings
+
+        :returns (start, stop, data, data_index): the timesteps are
+                 range(start, stop). data holds the flattened ragged arrays
+                 for those timesteps, and data_index the start of each
+                 timestep in them, as for get_all_timesteps(mode='flat').
+        """
+        start, stop = self.timestep_range(start_time, end_time)
+        return (start, stop) + self._read_rows(variables, start, stop)
+
+    @instrumented
+    def query_bbox(self,
+                   lon_min,
+                   lon_max,
+                   lat_min,
+                   lat_max,
+                   time_range=None,
+                   variables=['longitude', 'latitude', 'id'],
+                   batch=100):
+        """
+        returns the particles inside a longitude-latitude box
+
+        If the file has a bounding box index (see Writer(bbox_index=True) and
+        add_bbox_index()), timesteps that don't overlap the box are not read.
+
+        :param lon_min, lon_max, lat_min, lat_max: the box (inclusive)
+        :type lon_min, lon_max, lat_min, lat_max: float
+
+        :param time_range=None: (start_time, end_time) of the timesteps to search.
+                                If None, all timesteps are searched.
+        :type time_range: tuple of datetime objects
+
+        :param variables: the variables desired as a list string names.
+                          Defaults to ['longitude', 'latitude', 'id']
+        :type variables: list of strings
+
+        :param batch=100: maximum number of timesteps to read at a time
+        :type batch: integer
+
+        :returns data: dict of arrays, keyed by variable name, of the data for
+                       the particles in the box, plus a 'timestep' array with
+                       the timestep index of each.
+        """
+        if time_range is None:
+            start, stop = 0, self.num_timesteps
+        else:
+            start, stop = self.timestep_range(*time_range)
+        counts = np.diff(self.data_index[start:stop + 1])
+        candidates = counts > 0
+        if all(name in self.nc.variables for name in BBOX_VARIABLES):
+            bbox = {name: self._read_variable(name, start, stop)
+                    for name in BBOX_VARIABLES}
+            candidates &= np.ma.filled((bbox['longitude_max'] >= lon_min) &
+                                       (bbox['longitude_min'] <= lon_max) &
+                                       (bbox['latitude_max'] >= lat_min) &
+                                       (bbox['latitude_min'] <= lat_max), False)
+        rows = np.flatnonzero(candidates) + start
+
+        # read runs of consecutive timesteps together
+        runs = np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1)
+        positions = []
+        for run in runs:
+            for first in range(0, len(run), batch):
+                row1, row2 = run[first], run[min(first + batch, len(run)) - 1] + 1
+                data, data_index = self._read_rows(['longitude', 'latitude'], row1, row2)
+                lon, lat = data['longitude'], data['latitude']
+                inside = ((lon >= lon_min) & (lon <= lon_max) &
+                          (lat >= lat_min) & (lat <= lat_max))
+                positions.append(np.flatnonzero(np.ma.filled(inside, False)) + self.data_index[row1])
+        positions = np.concatenate(positions) if positions else np.zeros((0,), dtype=np.int64)
+
+        data = {'timestep': np.searchsorted(self.data_index, positions, side='right') - 1}
         for var in variables:
-            data[var] = []
-            for i in range(len(self.times)):
-                ind1 = self.data_index[i]
-                ind2 = self.data_index[i + 1]
-                data[var].append(self.nc.variables[var][ind1:ind2])
+            data[var] = self._read_points(var, positions)
         return data
 
+    @instrumented
+    def density_grid(self,
+                     grid,
+                     weights='mass',
+                     times=None,
+                     batch=100,
+                     workers=None,
+                     processes=None,
+                     filename=None):
+        """
+        returns the particles binned onto a regular longitude-latitude grid
+        for each timestep
+
+        The data are read in blocks of timesteps, and each block is binned
+        all at once.
+
+        :param grid: (lon_edges, lat_edges) -- the cell edges in each direction
+        :type grid: tuple of two 1-d arrays
+
+        :param weights='mass': name of the variable to sum in each cell. If
+                               None, the particles are counted.
+        :type weights: string
+
+        :param times=None: (start_time, end_time) of the timesteps to grid.
+                           If None, all timesteps are gridded.
+        :type times: tuple of datetime objects
+
+        :param batch=100: number of timesteps to read and bin at a time
+        :type batch: integer
+
+        :param workers=None: if set, the number of threads to bin with
+        :type workers: integer
+
+        :param processes=None: if set, the number of processes to bin with.
+                               Each process opens the file itself, so the
+                               Reader must have been opened from a file.
+        :type processes: integer
+
+        :param filename=None: if set, the grid is also written to a CF
+                              netcdf file with this name.
+        :type filename: string
+
+        :returns density: (num_timesteps, ny, nx) array
+        """
+        if times is None:
+            start, stop = 0, self.num_timesteps
+        else:
+            start, stop = self.timestep_range(*times)
+        ny, nx = grid_shape(grid)
+        density = np.zeros((stop - start, ny, nx), dtype=np.float64)
+        blocks = [(first, min(first + batch, stop)) for first in range(start, stop, batch)]
+
+        if processes is not None:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(_density_block, self.nc.filepath(), grid, weights, first, last)
+                           for first, last in blocks]
+                for (first, last), future in zip(blocks, futures):
+                    density[first - start:last - start] = future.result()
+        else:
+            def bin_block(block):
+                first, last = block
+                density[first - start:last - start] = self._density_block(grid, weights, first, last)
+            if workers is not None:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(bin_block, blocks))
+            else:
+                for block in blocks:
+                    bin_block(block)
+
+        if filename is not None:
+            with self._lock:
+                write_density_grid(filename,
+                                   grid,
+                                   density,
+                                   self.time_values[start:stop],
+                                   self.time_units,
+                                   calendar=self.calendar,
+                                   units='1' if weights is None else self.get_units(weights))
+        return density
+
+    def _density_block(self, grid, weights, start, stop):
+        """
+        the gridded density for timesteps start:stop
+        """
+        variables = ['longitude', 'latitude'] + ([] if weights is None else [weights])
+        data, data_index = self._read_rows(variables, start, stop)
+        return bin_ragged(data['longitude'],
+                          data['latitude'],
+                          data_index,
+                          grid,
+                          None if weights is None else data[weights])
+
+    @instrumented
+    def particle_ids(self, batch=1000):
+        """
+        returns the sorted unique particle IDs in the file
+
+        Taken from the ID index if it has been loaded, otherwise the id
+        variable is streamed through in blocks.
+        """
+        if self._id_index is not None:
+            return self._id_index.ids
+        ids = np.zeros((0,), dtype=self.nc.variables['id'].dtype)
+        for start, stop, data, data_index in self.iter_timesteps(['id'], batch=batch, blocks=True):
+            ids = np.union1d(ids, np.ma.compressed(data['id']))
+        return ids
+
+    @instrumented
+    def to_coo(self, variable):
+        """
+        returns a variable in sparse (coordinate) form, as a
+        (num_timesteps, num_particles) matrix indexed by timestep and particle
+
+        :param variable: name of the variable
+        :type variable: string
+
+        :returns (values, timesteps, columns, ids): the values, with the
+                 timestep and column of each. Column j is for particle ids[j].
+                 e.g. scipy.sparse.coo_matrix((values, (timesteps, columns)))
+        """
+        data, data_index = self.get_all_timesteps(['id', variable], mode='flat')
+        ids = np.unique(np.ma.compressed(data['id']))
+        timesteps = np.repeat(np.arange(self.num_timesteps), np.diff(data_index))
+        columns = np.searchsorted(ids, data['id'])
+        return data[variable], timesteps, columns, ids
+
+    @instrumented
+    def to_dense(self, variable, fill=np.nan, filename=None, batch=100):
+        """
+        returns a variable as a dense (num_timesteps, num_particles) array,
+        indexed by timestep and particle
+
+        Particles that don't exist at a timestep get the fill value.
+
+        :param variable: name of the variable
+        :type variable: string
+
+        :param fill=np.nan: value for the missing entries
+        :type fill: scalar
+
+        :param filename=None: if set, the array is created as a memory-mapped
+                              .npy file with this name, and filled a block
+                              of timesteps at a time, so the whole array is
+                              never in memory.
+        :type filename: string
+
+        :param batch=100: number of timesteps per block, when using a file
+        :type batch: integer
+
+        :returns (dense, ids): the array, and the particle IDs -- column j
+                               is for particle ids[j].
+        """
+        dtype = np.result_type(self.nc.variables[variable].dtype, np.min_scalar_type(fill))
+        if filename is None:
+            values, timesteps, columns, ids = self.to_coo(variable)
+            dense = np.full((self.num_timesteps, len(ids)), fill, dtype=dtype)
+            dense[timesteps, columns] = np.ma.filled(values, fill)
+            return dense, ids
+
+        ids = self.particle_ids()
+        dense = np.lib.format.open_memmap(filename,
+                                          mode='w+',
+                                          dtype=dtype,
+                                          shape=(self.num_timesteps, len(ids)))
+        for start, stop, data, data_index in self.iter_timesteps(['id', variable],
+                                                                 batch=batch,
+                                                                 blocks=True):
+            block = dense[start:stop]
+            block[...] = fill
+            timesteps = np.repeat(np.arange(stop - start), np.diff(data_index))
+            block[timesteps, np.searchsorted(ids, data['id'])] = np.ma.filled(data[variable], fill)
+        dense.flush()
+        return dense, ids
+
+    @_netcdf_locked
     def get_units(self, variable):
         """
         return the units of the given variable
@@ -310,6 +1666,7 @@ class Reader():
         """
         return self.nc.variables[variable].units
 
+    @_netcdf_locked
     def get_attributes(self, variable):
         """
         return all the attributes of the given variable
@@ -320,7 +1677,14 @@ class Reader():
         var = self.nc.variables[variable]
         return {name: var.getncattr(name) for name in var.ncattrs()}
 
-    def get_timestep(self, timestep, variables=['latitude', 'longitude']):
+    @instrumented
+    def get_timestep(self,
+                     timestep,
+                     variables=['latitude', 'longitude'],
+                     as_records=False,
+                     out=None,
+                     field_map=None,
+                     level=None):
         """
         returns the requested variables data from a given timestep as a
         dictionary keyed by the variable names
@@ -329,30 +1693,330 @@ class Reader():
                           Defaults to ['latitude','longitude']
         :type variables: list of strings
 
+        :param as_records=False: if True, the data are returned as a
+                                 structured array -- one record per particle,
+                                 with a field for each variable.
+        :type as_records: bool
+
+        :param out=None: buffers to copy the data into, rather than
+                         returning new arrays -- either a dict of arrays
+                         keyed by variable name (see allocate_buffers()), or
+                         a structured array for the records. They must be at
+                         least as long as the timestep -- max_particle_count
+                         is enough for any timestep. Missing values are left
+                         as the fill value (they are not masked).
+                         Note: the netcdf library can't read into an
+                         existing array, so a temporary one is still made
+                         for each variable, and copied into the buffer (with
+                         auto_mask off, it is at least not masked). Only a
+                         MemmapReader (or the variables cached by a
+                         CachedReader) copies straight from the file into
+                         the buffer.
+        :type out: dict of arrays or numpy structured array
+
+        :param field_map=None: which variable goes in each field of the
+                               records -- see record_fields(). Replaces
+                               variables.
+        :type field_map: dict
+
+        :param level=None: only read level of detail number level -- a
+                           subset of lod_fractions[level] of the particles.
+                           It is the same particles at every timestep (for
+                           as long as they are in the run), and is read
+                           from the start of the timestep in one go.
+        :type level: integer
+
         :returns data: returns a dict of arrays -- the keys are the
                        variable names, and the values are numpy arrays
-                       of the data.
+                       of the data. If out was passed in, the arrays are
+                       views of the start of the buffers. If as_records, a
+                       structured array of the records of the timestep.
         """
         ind1, ind2 = self.data_index[timestep:timestep + 2]
-        return {var: self.nc.variables[var][ind1:ind2] for var in variables}
+        if level is not None:
+            ind2 = ind1 + self.lod_count(timestep, level)
+        count = ind2 - ind1
+        if isinstance(out, dict):
+            data = {}
+            for var in variables:
+                data[var] = self._out_view(out[var], count)
+                self._read_into(var, ind1, ind2, data[var])
+            return data
+        if not (as_records or out is not None):
+            return {var: self._read_slice(var, ind1, ind2) for var in variables}
+
+        if field_map is None:
+            field_map = {var: var for var in variables}
+        if out is None:
+            dtype = []
+            for field, names in field_map.items():
+                if isinstance(names, str):
+                    dtype.append((field, self.nc.variables[names].dtype))
+                else:
+                    dtype.append((field, self.nc.variables[names[0]].dtype, (len(names),)))
+            out = np.empty((count,), dtype=dtype)
+        records = self._out_view(out, count)
+        for var, view in record_fields(records, field_map).items():
+            self._read_into(var, ind1, ind2, view)
+        return records
+
+    @staticmethod
+    def _out_view(buffer, count):
+        """
+        the first count values of an out= buffer
+        """
+        if len(buffer) < count:
+            raise ValueError("out has room for {} values -- {} are needed"
+                             .format(len(buffer), count))
+        return buffer[:count]
 
+    @instrumented
     def get_individual_trajectory(self, particle_id, variables=['latitude', 'longitude']):
         """
         returns the requested variables from trajectory of an individual particle
 
-        note: this is inefficient -- it has to read the entire file to get it.
+        If there is a companion file laid out by particle (see
+        get_trajectory_file()), the trajectory is read from that, in one
+        contiguous read per variable. Otherwise, the first call builds (or
+        loads) the particle ID index -- see get_id_index() -- after that,
+        only the particle's own data are read.
         """
-        indexes = np.where(self.nc.variables['id'][:] == particle_id)
+        if self.get_trajectory_file(variables) is not None:
+            data = self._read_trajectories([particle_id], variables)[particle_id]
+            del data['timestep']
+            return data
+        positions = self.get_id_index().positions(particle_id)
         data = {}
         for var in variables:
-            data[var] = self.nc.variables[var][indexes]
+            data[var] = self._read_points(var, positions)
         return data
 
+    @instrumented
+    def get_trajectories(self, particle_ids, variables=['latitude', 'longitude']):
+        """
+        returns the requested variables for the trajectories of a set of particles
+
+        All the particles are extracted together, so each variable is read
+        only once, rather than once per particle.
+
+        :param particle_ids: the IDs of the particles desired
+        :type particle_ids: sequence of integers
+
+        :param variables: the variables desired as a list string names.
+                          Defaults to ['latitude','longitude']
+        :type variables: list of strings
+
+        :returns trajectories: a dict keyed by particle ID. Each value is a
+                               dict of arrays keyed by variable name, with an
+                               extra 'timestep' array holding the timestep
+                               index of each point. Particles not in the file
+                               get empty arrays.
+
+        As for get_individual_trajectory, a companion file laid out by
+        particle is used if there is one.
+        """
+        particle_ids = np.atleast_1d(particle_ids)
+        if self.get_trajectory_file(variables) is not None:
+            return self._read_trajectories(particle_ids, variables)
+        index = self.get_id_index()
+        bounds, ranges = _csr_ranges(index.ids, index.offsets, particle_ids)
+        positions = index.order[ranges]
+        # read in sorted order, then put back
+        read_positions, inverse = np.unique(positions, return_inverse=True)
+
+        data = {'timestep': np.searchsorted(self.data_index, positions, side='right') - 1}
+        for var in variables:
+            data[var] = self._read_points(var, read_positions)[inverse]
+        return _split_trajectories(particle_ids, bounds, data)
+
+    @property
+    def trajectory_filename(self):
+        """
+        name of the companion file laid out by particle
+        """
+        return self.nc.filepath() + TRAJECTORY_EXTENSION
+
+    @_netcdf_locked
+    def get_trajectory_file(self, variables=()):
+        """
+        returns the companion file laid out by particle, as an open netCDF4
+        Dataset -- or None if there isn't one, it is out of date, or it
+        doesn't have all the variables.
+
+        The companion file is written by relayout.write_trajectory_file().
+        """
+        if self._trajectory_file is None:
+            self._trajectory_file = False
+            if os.path.isfile(self.trajectory_filename):
+                nc = netCDF4.Dataset(self.trajectory_filename)
+                stat = os.stat(self.nc.filepath())
+                if (getattr(nc, 'source_num_data', None) == self.data_index[-1] and
+                    getattr(nc, 'source_size', None) == stat.st_size and
+                    getattr(nc, 'source_mtime', None) == stat.st_mtime):
+                    ids = nc.variables['trajectory_id'][:]
+                    offsets = np.zeros((len(ids) + 1,), dtype=np.int64)
+                    offsets[1:] = np.cumsum(nc.variables['rowSize'][:])
+                    self._trajectory_file = (nc, ids, offsets)
+                else:
+                    nc.close()
+        if self._trajectory_file is False:
+            return None
+        nc = self._trajectory_file[0]
+        if not all(var in nc.variables or var in self.static_variables for var in variables):
+            return None
+        return nc
+
+    def _close_trajectory_file(self):
+        if self._trajectory_file:
+            self._trajectory_file[0].close()
+        self._trajectory_file = None
+
+    def _read_trajectories(self, particle_ids, variables):
+        """
+        the trajectories of the particles, from the companion file -- see
+        get_trajectories
+        """
+        nc, ids, offsets = self._trajectory_file
+        particle_ids = np.asarray(particle_ids)
+        bounds, positions = _csr_ranges(ids, offsets, particle_ids)
+        # the particles' rows are read together, in sorted order, then put back
+        read_positions, inverse = np.unique(positions, return_inverse=True)
+
+        def read(variable, positions):
+            with self._lock:
+                return _read_positions(nc.variables[variable], positions)
+
+        data = {'timestep': self._counted(read, 'timestep', read_positions)[inverse]}
+        for var in variables:
+            if var in self.static_variables:
+                data[var] = self._join_static(var, np.repeat(particle_ids, np.diff(bounds)))
+            else:
+                data[var] = self._counted(read, var, read_positions)[inverse]
+        return _split_trajectories(particle_ids, bounds, data)
+
+    @property
+    def id_index_filename(self):
+        """
+        name of the sidecar file the particle ID index is cached in
+        """
+        return self.nc.filepath() + ID_INDEX_EXTENSION
+
+    @instrumented
+    @_netcdf_locked
+    def get_id_index(self, save=False):
+        """
+        returns the particle ID index for this file
+
+        The index is taken from, in order: this Reader, the netcdf file
+        itself (see add_id_index()), the sidecar file, or built by reading
+        the full id variable.
+
+        :param save=False: if True, and the index had to be built, save
+                           it to the sidecar file for next time.
+        :type save: bool
+        """
+        if self._id_index is not None:
+            return self._id_index
+        # only the committed timesteps -- there may be more in the file
+        num_data = int(self.data_index[-1])
+        index = None
+        if 'id_index_order' in self.nc.variables:
+            order = self.nc.variables['id_index_order']
+            if getattr(order, 'num_data', None) == num_data:
+                num_ids = self.nc.variables['id_index_ids'].num_ids
+                counts = self._read_variable('id_index_count', 0, num_ids)
+                offsets = np.zeros((num_ids + 1,), dtype=np.int64)
+                offsets[1:] = np.cumsum(counts)
+                index = IDIndex(self._read_variable('id_index_ids', 0, num_ids),
+                                offsets,
+                                self._read_variable('id_index_order', 0, num_data),
+                                num_data)
+        if index is None and os.path.isfile(self.id_index_filename):
+            index = IDIndex.load(self.id_index_filename)
+            if (index.num_data != num_data or
+                index.source != IDIndex.source_stamp(self.nc.filepath())):
+                index = None
+        if index is None:
+            # taken before reading, so a change while reading makes it stale
+            source = IDIndex.source_stamp(self.nc.filepath())
+            index = IDIndex.from_ids(self._read_slice('id', 0, num_data))
+            index.source = source
+            if save:
+                index.save(self.id_index_filename)
+        self._id_index = index
+        return index
+
+    def _read_slice(self, variable, start, stop):
+        """
+        read a contiguous block of the data dimension for one variable
+
+        All reads of ragged data go through here. Static variables are
+        looked up by the particle IDs in the block.
+        """
+        if variable in self.static_variables:
+            return self._join_static(variable, self._read_slice('id', start, stop))
+        return self._counted(self._read_data_slice, variable, start, stop)
+
+    def _read_data_slice(self, variable, start, stop):
+        with self._lock:
+            return self.nc.variables[variable][start:stop]
+
+    def _read_into(self, variable, start, stop, out):
+        """
+        read a contiguous block of the data dimension into an existing array
+
+        netCDF4 has no way to read into an array, so this copies what it
+        returns -- but when _read_data_slice returns a view (of a memory
+        map), that is the only copy.
+        """
+        out[...] = np.ma.getdata(self._read_slice(variable, start, stop))
+
+    def _read_variable(self, variable, start=0, stop=None):
+        """
+        read a block of a variable that is not ragged data -- on the time
+        dimension, static data, the ID index
+        """
+        return self._counted(self._read_block, variable, start, stop)
+
+    def _read_block(self, variable, start, stop):
+        with self._lock:
+            return self.nc.variables[variable][start:stop]
+
+    def _counted(self, read, variable, *args):
+        """
+        call read(variable, *args) -- counting it in the stats, if there are any
+        """
+        if self.stats is None:
+            return read(variable, *args)
+        begin = perf_counter()
+        values = read(variable, *args)
+        self.stats.record('read', variable, values.nbytes, perf_counter() - begin)
+        return values
+
+    def _read_points(self, variable, positions):
+        """
+        read the values at an array of (sorted) positions in the data dimension
+        """
+        if variable in self.static_variables:
+            return self._join_static(variable, self._read_points('id', positions))
+        return self._counted(self._read_data_points, variable, positions)
+
+    def _read_data_points(self, variable, positions):
+        """
+        see _read_positions
+        """
+        with self._lock:
+            return _read_positions(self.nc.variables[variable], positions)
+
+    @_netcdf_locked
     def close(self):
         """
         close the netcdf file
         """
-        if self.nc is not None: # in case it hasn't been properly initialized
+        self._close_trajectory_file()
+        # in case it hasn't been properly initialized, or is already closed
+        # (a closed Dataset's id may have been reused by another open file)
+        if self.nc is not None and self.nc.isopen():
             try:
                 self.nc.close()
                 print ("netcdf file closed")
@@ -364,3 +2028,458 @@ class Reader():
         """ make sure to close the netcdf file """
         self.close()
 
+
+def _read_positions(var, positions):
+    """
+    read the values of a netcdf variable at an array of sorted positions
+
+    Sparse positions are read individually -- dense ones are read as one
+    contiguous block, and picked out of that.
+    """
+    if len(positions) == 0:
+        return np.ma.zeros((0,), dtype=var.dtype)
+    start, stop = positions[0], positions[-1] + 1
+    if (stop - start) <= DENSE_READ_FACTOR * len(positions):
+        return var[start:stop][positions - start]
+    return var[positions]
+
+
+def _csr_ranges(ids, offsets, particle_ids):
+    """
+    the rows of a set of particles, in an index stored in CSR form (see
+    IDIndex)
+
+    :returns bounds, rows: the rows of all the particles, end to end, and
+                           where each particle's start in them. Particles
+                           not in the index have no rows.
+    """
+    i = np.searchsorted(ids, particle_ids)
+    found = i < len(ids)
+    found[found] = ids[i[found]] == particle_ids[found]
+    i[~found] = 0
+    starts = offsets[i]
+    lengths = np.where(found, offsets[i + 1] - starts, 0)
+    bounds = np.zeros((len(lengths) + 1,), dtype=np.int64)
+    bounds[1:] = np.cumsum(lengths)
+    rows = np.arange(bounds[-1]) - np.repeat(bounds[:-1] - starts, lengths)
+    return bounds, rows
+
+
+def _split_trajectories(particle_ids, bounds, data):
+    """
+    split arrays holding the trajectories of particles, end to end, into a
+    dict of trajectories keyed by particle ID
+    """
+    trajectories = {}
+    for j, particle_id in enumerate(np.asarray(particle_ids).tolist()):
+        trajectories[particle_id] = {var: arr[bounds[j]:bounds[j + 1]]
+                                     for var, arr in data.items()}
+    return trajectories
+
+
+class IDIndex(object):
+    """
+    Index from particle ID to positions in the data dimension
+
+    Stored in CSR form: the positions of all the particles, sorted by ID
+    (and by position within an ID, so in time order), and the offsets
+    into that for each unique ID.
+    """
+    def __init__(self, ids, offsets, order, num_data, source=None):
+        """
+        :param ids: sorted unique particle IDs
+        :param offsets: start of each ID in order -- len(ids) + 1 long
+        :param order: positions in the data dimension, grouped by ID
+        :param num_data: length of the data dimension the index was built from
+        :param source=None: (size, mtime_ns) of the file the index was built
+                            from, if known -- see source_stamp()
+        """
+        self.ids = ids
+        self.offsets = offsets
+        self.order = order
+        self.num_data = num_data
+        self.source = source
+
+    @classmethod
+    def from_ids(cls, id_array):
+        """
+        build the index from the full array of particle IDs
+        """
+        id_array = np.asarray(id_array)
+        order = np.argsort(id_array, kind='stable')
+        ids, counts = np.unique(id_array[order], return_counts=True)
+        offsets = np.zeros((len(ids) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return cls(ids, offsets, order, len(id_array))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        load an index saved with save()
+        """
+        with np.load(filename) as npz:
+            source = tuple(int(val) for val in npz['source']) if 'source' in npz else None
+            return cls(npz['ids'], npz['offsets'], npz['order'], int(npz['num_data']), source)
+
+    def save(self, filename):
+        """
+        save the index to a numpy npz file
+        """
+        arrays = {} if self.source is None else {'source': np.array(self.source, dtype=np.int64)}
+        with open(filename, 'wb') as outfile:
+            np.savez(outfile,
+                     ids=self.ids,
+                     offsets=self.offsets,
+                     order=self.order,
+                     num_data=self.num_data,
+                     **arrays)
+
+    @staticmethod
+    def source_stamp(filename):
+        """
+        the (size, mtime_ns) of a file -- a saved index is only used for
+        the file if they have not changed since it was built
+        """
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def positions(self, particle_id):
+        """
+        positions in the data dimension of the given particle, in time order
+
+        An empty array is returned if the ID is not in the index.
+        """
+        i = np.searchsorted(self.ids, particle_id)
+        if i == len(self.ids) or self.ids[i] != particle_id:
+            return self.order[:0]
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+
+def record_fields(records, field_map=None):
+    """
+    the fields of a structured array, as a dict of arrays keyed by variable name
+
+    The arrays are views of the records -- nothing is copied.
+
+    :param records: the records -- one per particle
+    :type records: numpy structured array
+
+    :param field_map=None: the variable name for each field. The value can
+                           also be a sequence of names, for a field that is
+                           itself an array (e.g. a position), to split it
+                           into a variable for each element. Fields not in
+                           the map are left out. If None, all the fields
+                           are used, with their own names.
+    :type field_map: dict
+    """
+    if records.dtype.names is None:
+        raise ValueError("records must be a structured array")
+    if field_map is None:
+        field_map = {name: name for name in records.dtype.names}
+    data = {}
+    for field, names in field_map.items():
+        values = records[field]
+        if isinstance(names, str):
+            data[names] = values
+        else:
+            for i, name in enumerate(names):
+                data[name] = values[..., i]
+    return data
+
+
+def _map_fields(data, field_map):
+    """
+    a dict of data arrays with its keys mapped to variable names, as record_fields()
+    """
+    mapped = {}
+    for key, names in field_map.items():
+        if isinstance(names, str):
+            mapped[names] = data[key]
+        else:
+            values = np.asarray(data[key])
+            for i, name in enumerate(names):
+                mapped[name] = values[..., i]
+    return mapped
+
+
+@_netcdf_locked
+def add_id_index(filename):
+    """
+    write a particle ID index into an existing nc_particles file
+
+    The index is stored in the id_index_* variables, and will be used by
+    the Reader in place of building one.
+
+    :param filename: name of the netcdf file -- it is opened for appending.
+
+    Only the committed timesteps are indexed.
+    """
+    with netCDF4.Dataset(filename, 'a') as nc:
+        reader = Reader(nc, lazy=True)
+        num_data = int(reader.data_index[-1])
+        # the reader must not close the file
+        reader.nc = None
+        index = IDIndex.from_ids(nc.variables['id'][:num_data])
+        if 'id_index' not in nc.dimensions:
+            nc.createDimension('id_index', None if nc.data_model == 'NETCDF4' else len(index.ids))
+            nc.createVariable('id_index_ids', nc.variables['id'].dtype, ('id_index',))
+            nc.createVariable('id_index_count', np.int32, ('id_index',))
+            nc.createVariable('id_index_order', np.int64 if nc.data_model == 'NETCDF4' else np.int32, ('data',))
+        elif (not nc.dimensions['id_index'].isunlimited()
+              and len(nc.dimensions['id_index']) != len(index.ids)):
+            raise ValueError("the number of particle IDs has changed -- can't update the index")
+        nc.variables['id_index_ids'][:] = index.ids
+        nc.variables['id_index_count'][:] = np.diff(index.offsets)
+        nc.variables['id_index_order'][:num_data] = index.order
+        nc.variables['id_index_ids'].num_ids = len(index.ids)
+        nc.variables['id_index_order'].num_data = index.num_data
+
+
+def _density_block(filename, grid, weights, start, stop):
+    """
+    the gridded density for timesteps start:stop of a file -- for worker processes
+    """
+    reader = Reader(filename, lazy=True)
+    try:
+        return reader._density_block(grid, weights, start, stop)
+    finally:
+        reader.close()
+
+
+def _row_bounds(values, data_index):
+    """
+    the minimum and maximum of each row of a flattened ragged array
+
+    NaN (and masked) values are ignored -- rows with no other values get NaN
+    """
+    counts = np.diff(data_index)
+    mins = np.full((len(counts),), np.nan)
+    maxs = np.full((len(counts),), np.nan)
+    not_empty = counts > 0
+    if not_empty.any():
+        starts = data_index[:-1][not_empty]
+        values = np.ma.filled(values.astype(np.float64), np.nan)
+        mins[not_empty] = np.fmin.reduceat(values, starts)
+        maxs[not_empty] = np.fmax.reduceat(values, starts)
+    return mins, maxs
+
+
+@_netcdf_locked
+def add_bbox_index(filename, batch=1000):
+    """
+    write the bounding box of each timestep into an existing nc_particles file
+
+    The bounding boxes are stored in the BBOX_VARIABLES, and used by
+    Reader.query_bbox to skip timesteps.
+
+    :param filename: name of the netcdf file -- it is opened for appending.
+
+    :param batch=1000: number of timesteps to read at a time
+    :type batch: integer
+    """
+    with netCDF4.Dataset(filename, 'a') as nc:
+        for name in BBOX_VARIABLES:
+            if name not in nc.variables:
+                var = nc.createVariable(name, np.float64, ('time',), fill_value=np.nan)
+                var.long_name = "{} of the particles in a given timestep".format(name.replace('_', ' '))
+        reader = Reader(nc, lazy=True)
+        for start, stop, data, data_index in reader.iter_timesteps(['longitude', 'latitude'],
+                                                                   batch=batch,
+                                                                   blocks=True,
+                                                                   prefetch=False):
+            for name in ('longitude', 'latitude'):
+                mins, maxs = _row_bounds(data[name], data_index)
+                nc.variables[name + '_min'][start:stop] = mins
+                nc.variables[name + '_max'][start:stop] = maxs
+        # the reader must not close the file
+        reader.nc = None
+
+
+def lod_rank(ids):
+    """
+    a pseudo-random rank in [0, 1) for each particle ID
+
+    The rank is a hash (splitmix64) of the ID, so it is the same for a
+    particle at every timestep, and in every run. The particles with a rank
+    below f are a random sample of a fraction f of the particles -- the
+    level of detail f.
+    """
+    z = np.ma.getdata(ids).astype(np.int64).view(np.uint64)
+    with np.errstate(over='ignore'):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def _check_lod_fractions(fractions):
+    fractions = np.asarray(fractions, dtype=np.float64)
+    if (fractions.ndim != 1 or len(fractions) == 0 or
+        np.any(fractions <= 0) or np.any(fractions > 1) or np.any(np.diff(fractions) >= 0)):
+        raise ValueError("lod_fractions must be decreasing fractions between 0 and 1")
+    return fractions
+
+
+def _create_lod_variables(nc, fractions):
+    """
+    create the LOD_VARIABLES in an open file
+    """
+    nc.createDimension('lod', len(fractions))
+    storage = {}
+    if nc.data_model == 'NETCDF4' and nc.dimensions['time'].isunlimited():
+        storage['chunksizes'] = (TIME_CHUNKSIZE, len(fractions))
+    var = nc.createVariable('lod_fraction', np.float64, ('lod',))
+    var.long_name = "fraction of the particles in each level of detail"
+    var[:] = fractions
+    var = nc.createVariable('lod_count', np.int32, ('time', 'lod'), **storage)
+    var.long_name = ("number of particles in each level of detail in a given timestep "
+                     "-- the first ones of the timestep")
+
+
+def _lod_order(arrays, fractions):
+    """
+    order the particles of a timestep by lod_rank(), so that each level of
+    detail is the first particles of the timestep
+
+    :returns (arrays, counts): the re-ordered arrays, and the number of
+                               particles in each level
+    """
+    rank = lod_rank(arrays['id'])
+    order = np.argsort(rank, kind='stable')
+    counts = np.searchsorted(rank[order], fractions, side='left')
+    return {key: val[order] for key, val in arrays.items()}, counts
+
+
+@_netcdf_locked
+def add_lod_levels(filename, fractions, batch=1000):
+    """
+    add levels of detail to an existing nc_particles file
+
+    The particles of each timestep are re-ordered in place, as the Writer
+    does with lod_fractions, and the LOD_VARIABLES are written. Any ID
+    index is rebuilt, as the positions of the particles change.
+
+    :param filename: name of the netcdf file -- it is opened for appending.
+
+    :param fractions: fractions of the particles in each level, e.g. [0.1, 0.01]
+    :type fractions: sequence of decreasing floats
+
+    :param batch=1000: number of timesteps to re-order at a time
+    :type batch: integer
+    """
+    fractions = _check_lod_fractions(fractions)
+    with netCDF4.Dataset(filename, 'a') as nc:
+        if 'lod' not in nc.dimensions:
+            _create_lod_variables(nc, fractions)
+        elif len(nc.dimensions['lod']) != len(fractions):
+            raise ValueError("the file already has {} levels of detail".format(len(nc.dimensions['lod'])))
+        else:
+            nc.variables['lod_fraction'][:] = fractions
+        variables = [name for name, var in nc.variables.items()
+                     if var.dimensions == ('data',) and name not in SPECIAL_VARIABLES]
+        if 'id' not in variables:
+            raise ValueError("levels of detail require id data")
+        reader = Reader(nc, lazy=True)
+        for start, stop, data, data_index in reader.iter_timesteps(variables,
+                                                                   batch=batch,
+                                                                   blocks=True,
+                                                                   prefetch=False):
+            # sort by timestep, then rank
+            rows = np.repeat(np.arange(stop - start), np.diff(data_index))
+            rank = lod_rank(data['id'])
+            order = np.lexsort((rank, rows))
+            counts = np.column_stack([np.bincount(rows[rank < fraction], minlength=stop - start)
+                                      for fraction in fractions])
+            ind1, ind2 = reader.data_index[start], reader.data_index[stop]
+            for name in variables:
+                nc.variables[name][ind1:ind2] = data[name][order]
+            nc.variables['lod_count'][start:stop] = counts
+        # the reader must not close the file
+        reader.nc = None
+        rebuild_index = 'id_index_order' in nc.variables
+    if rebuild_index:
+        add_id_index(filename)
+    if os.path.isfile(str(filename) + ID_INDEX_EXTENSION):
+        os.remove(str(filename) + ID_INDEX_EXTENSION)
+
+
+def complete_timesteps(nc):
+    """
+    the number of complete timesteps in an nc_particles file
+
+    A timestep is complete when its time and particle_count have been
+    written -- any unwritten or partly written timesteps at the end are
+    not counted.
+
+    :param nc: the open netcdf file
+    :type nc: netCDF4.Dataset
+    """
+    written = ~(np.ma.getmaskarray(nc.variables['particle_count'][:]) |
+                np.ma.getmaskarray(nc.variables['time'][:]))
+    return len(written) if written.all() else int(np.argmin(written))
+
+
+@_netcdf_locked
+def compact(filename, new_filename=None, batch_rows=2**20):
+    """
+    rewrite an nc_particles file without any unused timesteps
+
+    netcdf3 files need to be given the number of timesteps when they
+    are created -- this removes the slots that were never written to
+    (and any partial timestep left by a crashed run), by streaming the
+    data into a new file.
+
+    :param filename: name of the netcdf file
+
+    :param new_filename=None: name of the file to write -- if None, the
+                              original file is replaced.
+
+    :param batch_rows=2**20: number of data records to copy at a time
+    :type batch_rows: integer
+    """
+    out_filename = filename if new_filename is None else new_filename
+    tmp_filename = str(out_filename) + ".compact.tmp"
+    try:
+        with netCDF4.Dataset(filename) as src:
+            num_times = complete_timesteps(src)
+            num_data = int(src.variables['particle_count'][:num_times].sum()) if num_times else 0
+            with netCDF4.Dataset(tmp_filename, 'w', format=src.file_format) as dst:
+                dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+                dst.setncattr(COMMITTED_ATTRIBUTE, np.int32(num_times))
+                for name, dim in src.dimensions.items():
+                    if name == 'time':
+                        # a netcdf3 dimension of size 0 would be a second
+                        # unlimited one -- keep an (unwritten) slot
+                        size = None if dim.isunlimited() else max(num_times, 1)
+                    else:
+                        size = None if dim.isunlimited() else len(dim)
+                    dst.createDimension(name, size)
+                for name, var in src.variables.items():
+                    options = {}
+                    if src.data_model == 'NETCDF4':
+                        filters = var.filters() or {}
+                        options = {key: filters[key] for key in ('zlib', 'complevel', 'shuffle', 'fletcher32')
+                                   if key in filters}
+                        chunking = var.chunking()
+                        if chunking != 'contiguous':
+                            options['chunksizes'] = chunking
+                    attributes = {key: var.getncattr(key) for key in var.ncattrs()}
+                    fill_value = attributes.pop('_FillValue', None)
+                    new_var = dst.createVariable(name, var.dtype, var.dimensions,
+                                                 fill_value=fill_value, **options)
+                    new_var.setncatts(attributes)
+                    if var.dimensions[:1] == ('time',):
+                        if num_times:
+                            new_var[:num_times] = var[:num_times]
+                    elif var.dimensions == ('data',):
+                        for start in range(0, num_data, batch_rows):
+                            stop = min(start + batch_rows, num_data)
+                            new_var[start:stop] = var[start:stop]
+                    else:
+                        new_var[:] = var[:]
+        os.replace(tmp_filename, out_filename)
+    finally:
+        # anything left from a failure
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
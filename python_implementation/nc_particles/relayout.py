@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+Re-layout of an nc_particles file by particle
+
+nc_particles files are laid out by time: all the particles of a timestep
+are together, so reading a timestep is one contiguous read, but the
+trajectory of a particle is scattered through the whole file.
+
+This writes a companion file with the same data laid out by particle, as
+a CF "contiguous ragged array" trajectory file: the observations of each
+particle, in time order, are together on the obs dimension, and rowSize
+gives the number of observations of each particle:
+
+    dimensions: trajectory, obs
+    trajectory_id(trajectory), rowSize(trajectory)
+    time(obs), timestep(obs), and all the data variables (obs)
+
+http://cfconventions.org/cf-conventions/v1.6.0/cf-conventions.html#_contiguous_ragged_array_representation
+
+The Reader uses the companion file (if it is there, and up to date) for
+get_individual_trajectory and get_trajectories. It is up to date if the
+file has the same number of committed rows, size and modification time as
+when the companion was written.
+
+The data are re-ordered with a two pass counting sort, a block of
+timesteps at a time, through memory mapped scratch files -- so only the
+particle IDs and a block of data are held in memory, however big the file.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import netCDF4
+
+from .nc_particles import Reader, NETCDF_LOCK, SPECIAL_VARIABLES, TRAJECTORY_EXTENSION
+
+
+def _count_ids(reader, batch_rows):
+    """
+    the unique particle IDs in the file, and the number of observations of each
+    """
+    ids = np.zeros((0,), dtype=reader.nc.variables['id'].dtype)
+    counts = np.zeros((0,), dtype=np.int64)
+    for start in range(0, int(reader.data_index[-1]), batch_rows):
+        stop = min(start + batch_rows, int(reader.data_index[-1]))
+        block_ids, block_counts = np.unique(np.ma.getdata(reader._read_slice('id', start, stop)),
+                                            return_counts=True)
+        ids, inverse = np.unique(np.concatenate([ids, block_ids]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([counts, block_counts]),
+                             minlength=len(ids)).astype(np.int64)
+    return ids, counts
+
+
+def _block_starts(data_index, batch_rows):
+    """
+    the first timestep of each block of whole timesteps of about batch_rows
+    """
+    starts = [0]
+    num_times = len(data_index) - 1
+    while starts[-1] < num_times:
+        first = starts[-1]
+        last = np.searchsorted(data_index, data_index[first] + batch_rows, side='right') - 1
+        starts.append(max(last, first + 1))
+    starts[-1] = num_times
+    return starts
+
+
+def write_trajectory_file(filename,
+                          trajectory_filename=None,
+                          variables=None,
+                          batch_rows=2**20,
+                          scratch_dir=None):
+    """
+    write a companion file with the data of an nc_particles file laid out
+    by particle
+
+    :param filename: name of the nc_particles file
+
+    :param trajectory_filename=None: name of the file to write -- by default
+                                     the name of the file, plus
+                                     TRAJECTORY_EXTENSION, which is where the
+                                     Reader looks for it.
+
+    :param variables=None: the data variables to include -- all of them if None
+    :type variables: list of strings
+
+    :param batch_rows=2**20: about how many observations to handle at a time
+    :type batch_rows: integer
+
+    :param scratch_dir=None: directory for the scratch files -- they are the
+                             size of the data. Defaults to the system
+                             temporary directory.
+    """
+    if trajectory_filename is None:
+        trajectory_filename = str(filename) + TRAJECTORY_EXTENSION
+    # taken first, so that if the file changes while this runs, the
+    # companion is out of date
+    stat = os.stat(str(filename))
+    reader = Reader(filename, lazy=True)
+    scratch = tempfile.mkdtemp(prefix='nc_particles_relayout', dir=scratch_dir)
+    try:
+        src = reader.nc
+        if variables is None:
+            variables = [name for name, var in src.variables.items()
+                         if var.dimensions == ('data',) and name not in SPECIAL_VARIABLES]
+        num_data = int(reader.data_index[-1])
+
+        # first pass: where each particle goes
+        ids, counts = _count_ids(reader, batch_rows)
+        offsets = np.zeros((len(ids) + 1,), dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        # second pass: scatter the blocks into the scratch arrays
+        scratch_arrays = {}
+        for name in variables + ['timestep']:
+            dtype = np.int32 if name == 'timestep' else src.variables[name].dtype
+            scratch_arrays[name] = np.lib.format.open_memmap(os.path.join(scratch, name + '.npy'),
+                                                             mode='w+', dtype=dtype,
+                                                             shape=(num_data,))
+        filled = offsets[:-1].copy()
+        starts = _block_starts(reader.data_index, batch_rows)
+        for first, last in zip(starts[:-1], starts[1:]):
+            data, data_index = reader._read_rows(variables, first, last)
+            block_ids = np.ma.getdata(data['id'] if 'id' in data else
+                                      reader._read_slice('id', reader.data_index[first],
+                                                         reader.data_index[last]))
+            particle = np.searchsorted(ids, block_ids)
+            # the observations of a particle in the block, in time order
+            order = np.argsort(particle, kind='stable')
+            block_counts = np.bincount(particle, minlength=len(ids))
+            group_starts = np.cumsum(block_counts) - block_counts
+            sorted_particle = particle[order]
+            destination = np.empty_like(order)
+            destination[order] = (filled[sorted_particle] +
+                                  np.arange(len(order)) - group_starts[sorted_particle])
+            filled += block_counts
+
+            timesteps = np.repeat(np.arange(first, last, dtype=np.int32), np.diff(data_index))
+            scratch_arrays['timestep'][destination] = timesteps
+            for name in variables:
+                scratch_arrays[name][destination] = np.ma.getdata(data[name])
+
+        # write it out, streaming from the scratch arrays
+        tmp_filename = str(trajectory_filename) + ".tmp"
+        with NETCDF_LOCK, netCDF4.Dataset(tmp_filename, 'w', format=src.file_format) as dst:
+            dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+            dst.featureType = "trajectory"
+            dst.source_file = os.path.basename(str(filename))
+            dst.source_num_data = np.int64(num_data) if dst.data_model == 'NETCDF4' else np.int32(num_data)
+            # doubles, as netcdf3 has no 64 bit integer attributes
+            dst.source_size = np.float64(stat.st_size)
+            dst.source_mtime = np.float64(stat.st_mtime)
+            dst.createDimension('trajectory', len(ids))
+            dst.createDimension('obs', num_data)
+
+            var = dst.createVariable('trajectory_id', ids.dtype, ('trajectory',))
+            var.cf_role = "trajectory_id"
+            var.long_name = "particle ID"
+            var[:] = ids
+            var = dst.createVariable('rowSize', np.int32, ('trajectory',))
+            var.long_name = "number of observations of each particle"
+            var.sample_dimension = "obs"
+            var[:] = counts
+
+            time = src.variables['time']
+            var = dst.createVariable('time', time.dtype, ('obs',))
+            var.setncatts({key: time.getncattr(key) for key in time.ncattrs()
+                           if key != '_FillValue'})
+            var = dst.createVariable('timestep', np.int32, ('obs',))
+            var.long_name = "index of the timestep in the source file"
+            for name in variables:
+                src_var = src.variables[name]
+                attributes = {key: src_var.getncattr(key) for key in src_var.ncattrs()}
+                fill_value = attributes.pop('_FillValue', None)
+                var = dst.createVariable(name, src_var.dtype, ('obs',), fill_value=fill_value)
+                var.setncatts(attributes)
+
+            time_values = np.ma.getdata(reader.time_values)
+            for start in range(0, num_data, batch_rows):
+                stop = min(start + batch_rows, num_data)
+                timesteps = np.asarray(scratch_arrays['timestep'][start:stop])
+                dst.variables['timestep'][start:stop] = timesteps
+                dst.variables['time'][start:stop] = time_values[timesteps]
+                for name in variables:
+                    dst.variables[name][start:stop] = np.asarray(scratch_arrays[name][start:stop])
+        os.replace(tmp_filename, trajectory_filename)
+    finally:
+        reader.close()
+        scratch_arrays = None
+        shutil.rmtree(scratch, ignore_errors=True)
+    return trajectory_filename
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+A cache of Reader arrays shared between processes
+
+When many worker processes (e.g. of a web server) read the same files,
+each Reader reads the time and particle_count variables to build its
+index, and each keeps its own copies of the variables it uses most. The
+SharedCache stores those arrays once, as .npy files in a cache directory,
+and every process memory maps them -- so they are read from the netcdf
+file once, and the operating system keeps a single copy in memory,
+however many workers there are.
+
+Entries are keyed by the path, modification time and size of the netcdf
+file, so a file that changes gets a new entry, and the old one is never
+used again. When the cache is bigger than its limit, the least recently
+used entries (whole files) are removed.
+
+The .npy files are written to a temporary name and renamed into place, so
+a process never sees a partly written one. On POSIX systems an entry can be
+removed while other processes still have it mapped -- they keep their
+mapping until they are done with it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .nc_particles import Reader
+
+## default size limit of a cache directory
+DEFAULT_MAX_BYTES = 2**30
+
+## file in each entry directory holding the source file's details. Its
+## modification time is the last time the entry was used.
+SOURCE_FILENAME = "source.json"
+
+
+class SharedCache(object):
+    """
+    A directory of memory mapped arrays, shared between processes
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory=None: the cache directory -- all the processes
+                               sharing the cache must use the same one.
+                               Defaults to "nc_particles_cache" in the
+                               system temporary directory.
+        :type directory: string
+
+        :param max_bytes=DEFAULT_MAX_BYTES: size limit of the cache --
+                                            least recently used entries are
+                                            removed to keep it under this.
+        :type max_bytes: integer
+        """
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), "nc_particles_cache")
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry(self, filename):
+        """
+        the cache entry directory for the current version of a file
+
+        It is created (with its source details) if it isn't there.
+        """
+        path = os.path.abspath(str(filename))
+        stat = os.stat(path)
+        source = {'path': path, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        key = hashlib.sha1(json.dumps(source, sort_keys=True).encode('utf-8')).hexdigest()[:20]
+        entry = os.path.join(self.directory, key)
+        source_file = os.path.join(entry, SOURCE_FILENAME)
+        if not os.path.isfile(source_file):
+            os.makedirs(entry, exist_ok=True)
+            self._write_atomic(source_file, lambda outfile: outfile.write(json.dumps(source).encode('utf-8')))
+        return entry
+
+    def get_array(self, filename, name, load):
+        """
+        returns an array for a file, memory mapped (read-only) from the cache
+
+        :param filename: the netcdf file the array is from
+        :param name: name of the array
+        :param load: function to call (with no arguments) to get the array,
+                     if it isn't in the cache yet
+        """
+        entry = self.entry(filename)
+        array_file = os.path.join(entry, name + '.npy')
+        try:
+            array = np.load(array_file, mmap_mode='r')
+        except FileNotFoundError:
+            values = np.asarray(load())
+            save = lambda outfile: np.save(outfile, values)
+            try:
+                try:
+                    self._write_atomic(array_file, save)
+                except FileNotFoundError:
+                    # the entry was evicted by another process while the
+                    # array was loading -- re-create it
+                    entry = self.entry(filename)
+                    self._write_atomic(array_file, save)
+                self.evict(keep=entry)
+                array = np.load(array_file, mmap_mode='r')
+            except FileNotFoundError:
+                # evicted again -- use the array, uncached
+                return values
+        self._touch(entry)
+        return array
+
+    def get_masked_array(self, filename, name, load):
+        """
+        as get_array, for an array that may have missing values
+
+        The mask (if there is one) is cached as another array.
+        """
+        cached = {}
+
+        def load_values():
+            cached['values'] = np.ma.asarray(load())
+            return np.ma.getdata(cached['values'])
+
+        def load_mask():
+            if 'values' not in cached:
+                cached['values'] = np.ma.asarray(load())
+            mask = np.ma.getmask(cached['values'])
+            return np.zeros((0,), dtype=bool) if mask is np.ma.nomask else mask
+
+        data = self.get_array(filename, name, load_values)
+        mask = self.get_array(filename, name + '.mask', load_mask)
+        return data, (mask if len(mask) else None)
+
+    @staticmethod
+    def _write_atomic(filename, write):
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as outfile:
+            write(outfile)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def _touch(entry):
+        try:
+            os.utime(os.path.join(entry, SOURCE_FILENAME))
+        except FileNotFoundError:
+            # evicted by another process -- it will be re-created if needed
+            pass
+
+    def entries(self):
+        """
+        the entries in the cache, least recently used first
+
+        :returns entries: list of (entry directory, last used time, size in bytes)
+        """
+        entries = []
+        for item in os.scandir(self.directory):
+            if not item.is_dir():
+                continue
+            try:
+                last_used = os.stat(os.path.join(item.path, SOURCE_FILENAME)).st_mtime
+                size = sum(f.stat().st_size for f in os.scandir(item.path) if f.is_file())
+            except FileNotFoundError:
+                continue
+            entries.append((item.path, last_used, size))
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used entries, until the cache is no bigger
+        than max_bytes
+
+        :param keep=None: an entry directory not to remove
+        """
+        entries = self.entries()
+        total = sum(size for path, last_used, size in entries)
+        for path, last_used, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def invalidate(self, filename):
+        """
+        remove all the entries for a file -- whatever its version
+        """
+        path = os.path.abspath(str(filename))
+        for entry, last_used, size in self.entries():
+            try:
+                with open(os.path.join(entry, SOURCE_FILENAME)) as infile:
+                    source = json.load(infile)
+            except (FileNotFoundError, ValueError):
+                continue
+            if source['path'] == path:
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def clear(self):
+        """
+        remove everything in the cache
+        """
+        for entry, last_used, size in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+class CachedReader(Reader):
+    """
+    Reader that gets its index, and the variables most used, from a SharedCache
+
+    The time values and data_index are always cached. The cached variables
+    are read from the cache -- as views of the memory mapped arrays (masked
+    arrays if they have missing values) -- the others from the file as usual.
+    """
+    def __init__(self,
+                 nc_file,
+                 cache=None,
+                 variables=('longitude', 'latitude'),
+                 lazy=False,
+                 auto_mask=True,
+                 stats=None):
+        """
+        initialize a cached file reader.
+
+        :param nc_file: name of the netcdf file to read.
+        :type nc_file: string
+
+        :param cache=None: the cache to use -- if None, a SharedCache with the
+                           default directory.
+        :type cache: SharedCache
+
+        :param variables=('longitude', 'latitude'): the data variables to
+                                                    cache. Each is loaded
+                                                    into the cache in full,
+                                                    the first time it is used.
+        :type variables: sequence of strings
+
+        :param lazy, auto_mask, stats: as for Reader
+        """
+        self.cache = SharedCache() if cache is None else cache
+        self.cached_variables = list(variables)
+        self._cached = {}
+        Reader.__init__(self, nc_file, lazy=True, auto_mask=auto_mask, stats=stats)
+        if self._filename is None:
+            raise ValueError("a CachedReader needs a file name, not an open Dataset")
+        self._load_index()
+        if not lazy:
+            self.times
+
+    def _load_index(self):
+        num_timesteps = self.num_timesteps
+        self._time_values = self.cache.get_array(
+            self._filename, 'time_values',
+            lambda: np.ma.getdata(self._read_variable('time', 0, num_timesteps)))
+        self._data_index = self.cache.get_array(
+            self._filename, 'data_index', lambda: Reader.data_index.fget(self))
+
+    def refresh(self):
+        """
+        pick up any new timesteps written to the file since it was opened
+
+        The file has changed, so this uses (and fills) a new cache entry.
+        """
+        with self._lock:
+            num_new = Reader.refresh(self)
+            self._cached = {}
+            self._times = None
+            self._load_index()
+        return num_new
+
+    def _cached_variable(self, variable):
+        """
+        the (data, mask) of a whole cached variable
+        """
+        if variable not in self._cached:
+            num_data = int(self.data_index[-1])
+            self._cached[variable] = self.cache.get_masked_array(
+                self._filename, variable,
+                lambda: Reader._read_data_slice(self, variable, 0, num_data))
+        return self._cached[variable]
+
+    def _read_data_slice(self, variable, start, stop):
+        if variable not in self.cached_variables:
+            return Reader._read_data_slice(self, variable, start, stop)
+        data, mask = self._cached_variable(variable)
+        if mask is None:
+            return data[start:stop]
+        return np.ma.MaskedArray(data[start:stop], mask=mask[start:stop])
+
+    def _read_data_points(self, variable, positions):
+        if variable not in self.cached_variables:
+            return Reader._read_data_points(self, variable, positions)
+        data, mask = self._cached_variable(variable)
+        if mask is None:
+            return data[positions]
+        return np.ma.MaskedArray(data[positions], mask=mask[positions])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Tests of the memory mapped netcdf3 reader
+
+Designed to be run with pytest
+"""
+
+import datetime
+from pathlib import Path
+
+import pytest
+import numpy as np
+import netCDF4
+import nc_particles
+from nc_particles.classic import ClassicHeader, MemmapReader
+
+HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
+
+
+def write_classic_file(filename):
+    # the same data as sample.nc
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    w = nc_particles.Writer(filename, num_timesteps=3, nc_version=3)
+    for i, timestamp in enumerate(r.times):
+        data = r.get_timestep(i, ['longitude', 'latitude', 'depth', 'mass', 'id'])
+        w.write_timestep(datetime.datetime(*timestamp.timetuple()[:6]), data)
+    w.close()
+    r.close()
+
+
+@pytest.fixture(scope="module")
+def classic_file():
+    filename = OUTPUT / 'junk_classic.nc'
+    write_classic_file(filename)
+    return filename
+
+
+def test_header(classic_file):
+    with open(classic_file, 'rb') as infile:
+        buf = infile.read()
+    header = ClassicHeader(buf, len(buf))
+    assert header.version == 1
+    assert header.numrecs == 9
+    assert header.dimension_length('time') == 3
+    assert header.dimension_length('data') is None
+    assert set(header.record_variables) == {'longitude', 'latitude', 'depth', 'mass', 'id'}
+    # 4 doubles and an int
+    assert header.record_size == 36
+
+
+def test_header_not_classic():
+    with open(HERE / 'sample.nc', 'rb') as infile:
+        buf = infile.read()
+    with pytest.raises(ValueError):
+        ClassicHeader(buf, len(buf))
+
+
+def test_arrays_match_netcdf(classic_file):
+    r = MemmapReader(classic_file)
+    nc = netCDF4.Dataset(classic_file)
+    for name in ['time', 'particle_count', 'longitude', 'latitude', 'id']:
+        arr = r.get_array(name)
+        assert not isinstance(arr, np.ma.MaskedArray)
+        assert np.array_equal(arr, nc.variables[name][:])
+    nc.close()
+    r.close()
+
+
+def test_reader_api(classic_file):
+    r = MemmapReader(classic_file)
+    assert np.array_equal(r.data_index, [0, 3, 7, 9])
+    data = r.get_timestep(2, ['longitude', 'id'])
+    path = r.get_individual_trajectory(1)
+    data = {name: arr.copy() for name, arr in data.items()}
+    r.close()
+    assert np.array_equal(data['longitude'], [-88.3, -88.1])
+    assert np.array_equal(data['id'], [1, 3])
+    assert np.array_equal(path['latitude'], [28.0, 28.05, 28.1])
+
+
+def test_reader_stats(classic_file):
+    r = MemmapReader(classic_file, stats=True)
+    r.get_timestep(2, ['longitude'])
+    counter = r.stats.for_method('get_timestep', 'read')
+    r.close()
+    assert counter.calls == 1
+    assert counter.nbytes == 2 * 8
+
+
+def test_64bit_offset():
+    filename = OUTPUT / 'junk_classic_64.nc'
+    with netCDF4.Dataset(filename, 'w', format='NETCDF3_64BIT_OFFSET') as nc:
+        nc.createDimension('data', None)
+        nc.createDimension('xy', 2)
+        nc.createVariable('pos', np.float32, ('data', 'xy'))[:] = [[1, 2], [3, 4], [5, 6]]
+    with open(filename, 'rb') as infile:
+        buf = infile.read()
+    header = ClassicHeader(buf, len(buf))
+    assert header.version == 2
+    # single record variable -- not padded
+    assert header.record_size == 8
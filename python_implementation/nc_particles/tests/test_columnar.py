@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Tests of the columnar (Arrow / Parquet) export and import
+
+Designed to be run with pytest
+"""
+
+from pathlib import Path
+
+import pytest
+import numpy as np
+import nc_particles
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.compute
+import pyarrow.parquet
+from nc_particles import columnar
+
+HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
+
+
+def test_to_arrow():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    table = columnar.to_arrow(r, ['latitude', 'mass'], batch=2)
+    assert len(table) == r.data_index[-1]
+    assert table.column_names == ['time', 'timestep', 'latitude', 'mass']
+    data = r.get_timestep(2, ['latitude'])
+    rows = table.filter(pyarrow.compute.equal(table.column('timestep'), 2))
+    assert np.array_equal(rows.column('latitude').to_numpy(), data['latitude'])
+    assert rows.column('time')[0].as_py() == r.times[2]
+    r.close()
+
+
+def test_to_arrow_pushdown():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    times = r.times
+    table = columnar.to_arrow(r, ['latitude', 'id'], time_range=(times[1], times[2]), ids=[1, 3])
+    assert set(table.column('timestep').to_pylist()) == {1, 2}
+    assert set(table.column('id').to_pylist()) == {1, 3}
+    r.close()
+
+
+@pytest.mark.parametrize("partitioned", [False, True])
+def test_parquet_round_trip(partitioned):
+    path = OUTPUT / ('junk_parts' if partitioned else 'junk_file.parquet')
+    columnar.to_parquet(HERE / 'sample.nc', path, ['latitude', 'longitude', 'id'],
+                        batch=2, partitioned=partitioned)
+    if not partitioned:
+        assert pyarrow.parquet.ParquetFile(path).num_row_groups > 1
+
+    filename = OUTPUT / 'junk_from_parquet_{}.nc'.format(partitioned)
+    columnar.from_table(path, filename)
+    original = nc_particles.Reader(HERE / 'sample.nc')
+    r = nc_particles.Reader(filename)
+    assert r.num_timesteps == original.num_timesteps
+    assert list(r.times) == list(original.times)
+    for var in ['latitude', 'longitude', 'id']:
+        assert np.array_equal(r.get_all_timesteps([var], mode='flat')[0][var],
+                              original.get_all_timesteps([var], mode='flat')[0][var])
+    r.close()
+    original.close()
+
+
+def test_from_table_unsorted():
+    table = pyarrow.table({'time': np.array(['2010-01-02', '2010-01-01'], dtype='datetime64[us]'),
+                           'id': np.array([1, 2], dtype=np.int32)})
+    with pytest.raises(ValueError):
+        columnar.from_table(table, OUTPUT / 'junk_unsorted.nc')
+
+
+def test_from_table_empty_timesteps():
+    # timestep 1 has no particles, so no rows -- it is still written
+    times = np.array(['2010-01-01T00', '2010-01-01T02', '2010-01-01T02'], dtype='datetime64[us]')
+    table = pyarrow.table({'time': times,
+                           'timestep': np.array([0, 2, 2], dtype=np.int32),
+                           'id': np.array([1, 1, 2], dtype=np.int32)})
+    filename = OUTPUT / 'junk_from_table_gap.nc'
+    columnar.from_table(table, filename, nc_version=3)
+    r = nc_particles.Reader(filename)
+    assert r.num_timesteps == 3
+    assert [t.hour for t in r.times] == [0, 1, 2]
+    assert len(r.get_timestep(1, ['id'])['id']) == 0
+    assert np.array_equal(r.get_timestep(2, ['id'])['id'], [1, 2])
+    r.close()
+
+    # without the timestep column, the empty timestep is lost
+    columnar.from_table(table.drop(['timestep']), filename)
+    r = nc_particles.Reader(filename)
+    assert r.num_timesteps == 2
+    r.close()
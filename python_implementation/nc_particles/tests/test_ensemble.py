@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Tests of reading ensembles of files
+
+Designed to be run with pytest
+"""
+
+import datetime
+import shutil
+from pathlib import Path
+
+import pytest
+import numpy as np
+import nc_particles
+from nc_particles import ensemble
+
+HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
+
+
+@pytest.fixture(scope="module")
+def members():
+    filenames = []
+    for i in range(3):
+        filename = OUTPUT / 'junk_member_{}.nc'.format(i)
+        shutil.copy(HERE / 'sample.nc', filename)
+        filenames.append(filename)
+    return filenames
+
+
+def num_particles(reader):
+    return int(reader.data_index[-1])
+
+
+def max_mass(data):
+    return data['mass'].max()
+
+
+def test_init(members):
+    m = nc_particles.MultiReader(members)
+    assert m.num_members == 3
+    assert m.num_timesteps == 3
+    assert "number of members: 3" in str(m)
+
+
+def test_mismatched_times(members):
+    w = nc_particles.Writer(OUTPUT / 'junk_member_bad.nc')
+    w.write_timestep(datetime.datetime(2010, 11, 3, 12, 0),
+                     {'latitude': [28.0], 'longitude': [-88.0], 'depth': [0.0],
+                      'mass': [1.0], 'id': [0]})
+    w.close()
+    with pytest.raises(ValueError):
+        nc_particles.MultiReader(members + [OUTPUT / 'junk_member_bad.nc'])
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_map(members, processes):
+    m = nc_particles.MultiReader(members, processes=processes)
+    assert m.map(num_particles) == [9, 9, 9]
+
+
+def test_map_timesteps(members):
+    m = nc_particles.MultiReader(members, processes=2)
+    results = m.map_timesteps(max_mass, variables=['mass'], timesteps=[2, 0, 99])
+    m.close()
+    assert len(results) == 3
+    assert np.allclose(results[0], [0.1, 0.06])
+
+
+def test_map_timesteps_reads_only_requested(members):
+    r = nc_particles.Reader(members[0], stats=True)
+    results = ensemble._map_timesteps(r, lambda data: len(data['id']), ['id'], [2], 100)
+    nbytes = r.stats.for_variable('id', 'read').nbytes
+    r.close()
+    assert results == [2]
+    # the two ids of timestep 2, and nothing else
+    assert nbytes == 2 * 4
+
+
+def test_runs():
+    assert ensemble._runs([0, 1, 2, 5, 7, 8]) == [(0, 3), (5, 6), (7, 9)]
+    assert ensemble._runs([]) == []
+
+
+def test_pool_kept(members):
+    with nc_particles.MultiReader(members, processes=2) as m:
+        assert m.map(num_particles) == [9, 9, 9]
+        executor = m._executor
+        assert m.map(num_particles) == [9, 9, 9]
+        assert m._executor is executor
+    assert m._executor is None
+
+
+def test_get_timestep(members):
+    m = nc_particles.MultiReader(members, processes=2)
+    data = m.get_timestep(2, variables=['id', 'longitude'])
+    assert np.array_equal(data['id'], [1, 3, 1, 3, 1, 3])
+    assert np.array_equal(data['member'], [0, 0, 1, 1, 2, 2])
+
+
+def test_readers_kept(members):
+    m = nc_particles.MultiReader(members, processes=1)
+    m.get_timestep(0)
+    readers = dict(ensemble._readers)
+    m.get_timestep(1)
+    # the same Readers -- the files were not opened again
+    assert ensemble._readers == readers
+    assert len(readers) == 3
+    m.close()
+    assert not ensemble._readers
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Tests of the I/O instrumentation
+
+Designed to be run with pytest
+"""
+
+import datetime
+from pathlib import Path
+
+import pytest
+import numpy as np
+import nc_particles
+from nc_particles.iostats import IOStats
+
+HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
+
+
+def test_no_stats():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    assert r.stats is None
+    r.get_timestep(0)
+    r.close()
+
+
+def test_reader_stats():
+    r = nc_particles.Reader(HERE / 'sample.nc', lazy=True, stats=True)
+    data = r.get_all_timesteps(['latitude'], mode='rows')
+    stats = r.stats
+    reads = stats.for_method('get_all_timesteps', 'read')
+    # the index, then one read per timestep
+    assert stats.counts[('get_all_timesteps', 'read', 'latitude')].calls == r.num_timesteps
+    assert stats.counts[('get_all_timesteps', 'read', 'particle_count')].calls == 1
+    assert reads.nbytes == sum(arr.nbytes for arr in data['latitude']) + r.num_timesteps * 4
+    assert stats.method_counts['get_all_timesteps'].calls == 1
+    assert stats.method_counts['get_all_timesteps'].seconds >= reads.seconds
+
+    stats.reset()
+    r.get_all_timesteps(['latitude'], mode='flat')
+    assert stats.for_variable('latitude').calls == 1
+    r.times
+    assert stats.counts[('times', 'num2date', 'time')].calls == 1
+    assert 'get_all_timesteps' in str(stats)
+    r.close()
+
+
+def test_reader_stats_generator():
+    r = nc_particles.Reader(HERE / 'sample.nc', stats=True)
+    list(r.iter_timesteps(['latitude'], batch=2, prefetch=False))
+    assert r.stats.for_method('iter_timesteps', 'read').calls == 2
+    r.close()
+
+
+def test_stats_callback():
+    calls = []
+    r = nc_particles.Reader(HERE / 'sample.nc', stats=lambda *args: calls.append(args))
+    r.get_timestep(1, ['id'])
+    assert calls[-1][:3] == ('get_timestep', 'read', 'id')
+    r.close()
+
+
+def test_writer_stats():
+    stats = IOStats()
+    w = nc_particles.Writer(OUTPUT / 'junk_stats.nc', flush_rows=100, stats=stats)
+    for hour in range(3):
+        w.write_timestep(datetime.datetime(2010, 1, 1, hour),
+                         {'id': np.arange(5, dtype=np.int32)})
+    w.close()
+    # everything written in one flush, when the file was closed
+    assert stats.counts[('flush', 'write', 'id')].calls == 1
+    assert stats.counts[('flush', 'write', 'id')].nbytes == 15 * 4
+    assert stats.method_counts['write_timestep'].calls == 3
+
+
+def test_bad_stats():
+    with pytest.raises(TypeError):
+        nc_particles.Reader(HERE / 'sample.nc', stats="yes")
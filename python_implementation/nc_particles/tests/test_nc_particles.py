@@ -40,13 +40,17 @@ def test_netcdf3():
     w = nc_particles.Writer(OUTPUT / 'junk_file.nc', num_timesteps=10, nc_version='3')
     w.close()
     nc = netCDF4.Dataset(OUTPUT / 'junk_file.nc')
-    assert nc.file_format=='NETCDF3_CLASSIC'
+    file_format = nc.file_format
+    nc.close()
+    assert file_format=='NETCDF3_CLASSIC'
 
 def test_netcdf4():
     w = nc_particles.Writer(OUTPUT / 'junk_file.nc', num_timesteps=10, nc_version=4)
     w.close()
     nc = netCDF4.Dataset(OUTPUT / 'junk_file.nc')
-    assert nc.file_format=='NETCDF4'
+    file_format = nc.file_format
+    nc.close()
+    assert file_format=='NETCDF4'
 
 def test_netcdf_wrong():
     with pytest.raises(ValueError):
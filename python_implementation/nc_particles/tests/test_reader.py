@@ -1,4 +1,5 @@
 import os
+import shutil
 import datetime
 from pathlib import Path
 import gc
@@ -10,6 +11,7 @@ import netCDF4
 import nc_particles
 
 HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
 
 
 ## test the Reader
@@ -101,3 +103,475 @@ def test_get_attributes():
                                           'axis' : "z positive down",
                                           }
     r.close()
+
+
+def test_get_all_timesteps_flat():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    data, data_index = r.get_all_timesteps(variables=['id', 'mass'], mode='flat')
+    r.close()
+    assert np.array_equal(data_index, [0, 3, 7, 9])
+    assert np.array_equal(data['id'], [0, 1, 2, 0, 1, 2, 3, 1, 3])
+    assert np.array_equal(data['id'][data_index[2]:data_index[3]], [1, 3])
+
+
+def test_get_all_timesteps_split():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    rows = r.get_all_timesteps(variables=['id', 'mass'])
+    split = r.get_all_timesteps(variables=['id', 'mass'], mode='split')
+    r.close()
+    for var in ('id', 'mass'):
+        assert len(split[var]) == 3
+        for row, view in zip(rows[var], split[var]):
+            assert np.array_equal(row, view)
+
+
+def test_get_all_timesteps_bad_mode():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    with pytest.raises(ValueError):
+        r.get_all_timesteps(mode='columns')
+    r.close()
+
+
+def test_get_individual_trajectory_missing_id():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    path = r.get_individual_trajectory(42)
+    r.close()
+    assert len(path['latitude']) == 0
+
+
+def test_id_index():
+    index = nc_particles.IDIndex.from_ids([0, 1, 2, 0, 1, 2, 3, 1, 3])
+    assert np.array_equal(index.ids, [0, 1, 2, 3])
+    assert np.array_equal(index.positions(1), [1, 4, 7])
+    assert np.array_equal(index.positions(3), [6, 8])
+
+
+def test_id_index_sidecar():
+    shutil.copy(HERE / 'sample.nc', OUTPUT / 'sample_sidecar.nc')
+    sidecar = OUTPUT / ('sample_sidecar.nc' + nc_particles.nc_particles.ID_INDEX_EXTENSION)
+    if sidecar.exists():
+        sidecar.unlink()
+    r = nc_particles.Reader(OUTPUT / 'sample_sidecar.nc')
+    r.get_id_index(save=True)
+    r.close()
+    assert sidecar.exists()
+
+    r = nc_particles.Reader(OUTPUT / 'sample_sidecar.nc')
+    path = r.get_individual_trajectory(1)
+    r.close()
+    assert np.array_equal(path['longitude'], [-88.1, -88.2, -88.3])
+
+
+def test_id_index_sidecar_stale():
+    shutil.copy(HERE / 'sample.nc', OUTPUT / 'sample_sidecar2.nc')
+    r = nc_particles.Reader(OUTPUT / 'sample_sidecar2.nc')
+    r.get_id_index(save=True)
+    r.close()
+    # the same number of rows, but different IDs
+    with netCDF4.Dataset(OUTPUT / 'sample_sidecar2.nc', 'a') as nc:
+        nc.variables['id'][0] = 5
+    r = nc_particles.Reader(OUTPUT / 'sample_sidecar2.nc')
+    path = r.get_individual_trajectory(5, ['id'])
+    r.close()
+    assert np.array_equal(path['id'], [5])
+
+
+def test_add_id_index():
+    shutil.copy(HERE / 'sample.nc', OUTPUT / 'sample_id_index.nc')
+    nc_particles.add_id_index(OUTPUT / 'sample_id_index.nc')
+    r = nc_particles.Reader(OUTPUT / 'sample_id_index.nc')
+    assert 'id_index_order' not in r.variables
+    index = r.get_id_index()
+    path = r.get_individual_trajectory(3)
+    r.close()
+    assert np.array_equal(index.order, [0, 3, 1, 4, 7, 2, 5, 6, 8])
+    assert np.array_equal(path['latitude'], [27.9, 28.0])
+
+
+def write_uncommitted_rows(filename):
+    """
+    a copy of sample.nc with rows after the last timestep -- as when a
+    Writer has written the data of a timestep, but not yet committed it
+    """
+    shutil.copy(HERE / 'sample.nc', filename)
+    with netCDF4.Dataset(filename, 'a') as nc:
+        nc.variables['id'][9:12] = [1, 7, 7]
+        nc.variables['longitude'][9:12] = [-80.0, -80.0, -80.0]
+
+
+@pytest.mark.parametrize("in_file", [False, True])
+def test_id_index_uncommitted_rows(in_file):
+    filename = OUTPUT / 'sample_uncommitted_{}.nc'.format(in_file)
+    write_uncommitted_rows(filename)
+    if in_file:
+        nc_particles.add_id_index(filename)
+    r = nc_particles.Reader(filename)
+    index = r.get_id_index()
+    path = r.get_individual_trajectory(1)
+    paths = r.get_trajectories([1, 7])
+    r.close()
+    assert index.num_data == 9
+    assert np.array_equal(index.ids, [0, 1, 2, 3])
+    assert np.array_equal(path['longitude'], [-88.1, -88.2, -88.3])
+    assert len(paths[7]['longitude']) == 0
+
+
+def test_get_trajectories():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    paths = r.get_trajectories([3, 1, 42], variables=['longitude', 'id'])
+    single = r.get_individual_trajectory(1, variables=['longitude'])
+    r.close()
+    assert set(paths) == {1, 3, 42}
+    assert np.array_equal(paths[1]['longitude'], single['longitude'])
+    assert np.array_equal(paths[1]['timestep'], [0, 1, 2])
+    assert np.array_equal(paths[3]['id'], [3, 3])
+    assert np.array_equal(paths[3]['timestep'], [1, 2])
+    assert len(paths[42]['longitude']) == 0
+
+
+@pytest.mark.parametrize("batch", [1, 2, 10])
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_iter_timesteps(batch, prefetch):
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    steps = list(r.iter_timesteps(['id'], batch=batch, prefetch=prefetch))
+    r.close()
+    assert [step for step, data in steps] == [0, 1, 2]
+    assert np.array_equal(steps[1][1]['id'], [0, 1, 2, 3])
+    assert np.array_equal(steps[2][1]['id'], [1, 3])
+
+
+def test_iter_timesteps_prefetch_other_reader():
+    # the prefetching thread and the other Reader share one lock --
+    # HDF5 isn't safe to use from two threads, even on different files
+    r1 = nc_particles.Reader(HERE / 'sample.nc')
+    r2 = nc_particles.Reader(HERE / 'sample.nc')
+    assert r1._lock is r2._lock is nc_particles.nc_particles.NETCDF_LOCK
+    for step, data in r1.iter_timesteps(['id'], batch=1, prefetch=True):
+        assert np.array_equal(data['id'], r2.get_timestep(step, ['id'])['id'])
+    r1.close()
+    r2.close()
+
+
+def test_iter_timesteps_blocks():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    blocks = list(r.iter_timesteps(['id'], batch=2, blocks=True))
+    r.close()
+    assert [(start, stop) for start, stop, data, index in blocks] == [(0, 2), (2, 3)]
+    start, stop, data, data_index = blocks[0]
+    assert np.array_equal(data_index, [0, 3, 7])
+    assert np.array_equal(data['id'], [0, 1, 2, 0, 1, 2, 3])
+    start, stop, data, data_index = blocks[1]
+    assert np.array_equal(data_index, [0, 2])
+    assert np.array_equal(data['id'], [1, 3])
+
+
+def test_time_index():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    t = datetime.datetime(2010, 11, 3, 12, 50)
+    assert r.time_index(t) == 2
+    assert r.time_index(t, method='before') == 1
+    assert r.time_index(datetime.datetime(2010, 11, 3, 12, 30), method='exact') == 1
+    assert r.time_index(datetime.datetime(2010, 11, 4)) == 2
+    assert r.time_index(datetime.datetime(2010, 11, 1)) == 0
+    with pytest.raises(ValueError):
+        r.time_index(t, method='exact')
+    with pytest.raises(ValueError):
+        r.time_index(datetime.datetime(2010, 11, 1), method='before')
+    r.close()
+
+
+def test_get_at_time():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    data = r.get_at_time(datetime.datetime(2010, 11, 3, 12, 55), variables=['id'])
+    r.close()
+    assert np.array_equal(data['id'], [1, 3])
+
+
+def test_get_time_range():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    start, stop, data, data_index = r.get_time_range(datetime.datetime(2010, 11, 3, 12, 15),
+                                                     datetime.datetime(2010, 11, 3, 13, 0),
+                                                     variables=['id'])
+    empty = r.get_time_range(datetime.datetime(2010, 11, 4),
+                             datetime.datetime(2010, 11, 5),
+                             variables=['id'])
+    r.close()
+    assert (start, stop) == (1, 3)
+    assert np.array_equal(data_index, [0, 4, 6])
+    assert np.array_equal(data['id'], [0, 1, 2, 3, 1, 3])
+    assert empty[:2] == (3, 3)
+    assert len(empty[2]['id']) == 0
+
+
+def test_lazy_open():
+    r = nc_particles.Reader(HERE / 'sample.nc', lazy=True)
+    assert r._times is None
+    assert r._data_index is None
+    assert r.num_timesteps == 3
+    first, last = r.time_span
+    assert (first.hour, first.minute) == (12, 0)
+    assert (last.hour, last.minute) == (13, 0)
+    assert r._times is None
+    assert "timesteps: 3" in str(r)
+    # built when needed
+    data = r.get_timestep(2, variables=['id'])
+    assert np.array_equal(r.data_index, [0, 3, 7, 9])
+    assert len(r.times) == 3
+    r.close()
+    assert np.array_equal(data['id'], [1, 3])
+
+
+def test_query_bbox():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    data = r.query_bbox(-88.15, -88.05, 27.95, 28.05)
+    r.close()
+    assert np.array_equal(data['id'], [1, 3])
+    assert np.array_equal(data['timestep'], [0, 2])
+
+
+def test_add_bbox_index_nan_positions():
+    longitude = np.array([np.nan, -88.0, 1.0, np.nan, np.nan])
+    mins, maxs = nc_particles.nc_particles._row_bounds(longitude, np.array([0, 3, 3, 5]))
+    assert np.allclose(mins[:1], [-88.0])
+    assert np.allclose(maxs[:1], [1.0])
+    assert np.all(np.isnan(mins[1:])) and np.all(np.isnan(maxs[1:]))
+
+
+def test_query_bbox_time_range():
+    shutil.copy(HERE / 'sample.nc', OUTPUT / 'sample_bbox.nc')
+    nc_particles.add_bbox_index(OUTPUT / 'sample_bbox.nc', batch=2)
+    r = nc_particles.Reader(OUTPUT / 'sample_bbox.nc')
+    assert np.allclose(r.nc.variables['longitude_max'][:], [-88.0, -87.9, -88.1])
+    data = r.query_bbox(-88.15, -87.85, 27.85, 28.15,
+                        time_range=(datetime.datetime(2010, 11, 3, 12, 30),
+                                    datetime.datetime(2010, 11, 3, 13, 0)),
+                        variables=['id', 'mass'])
+    nothing = r.query_bbox(0, 1, 0, 1)
+    r.close()
+    assert np.array_equal(data['id'], [0, 2, 3, 3])
+    assert np.array_equal(data['timestep'], [1, 1, 1, 2])
+    assert np.allclose(data['mass'], [0.1, 0.07, 0.06, 0.06])
+    assert len(nothing['id']) == 0
+
+
+GRID = (np.array([-88.4, -88.15, -87.85]), np.array([27.85, 28.025, 28.15]))
+
+
+def test_density_grid():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    counts = r.density_grid(GRID, weights=None, batch=2)
+    mass = r.density_grid(GRID)
+    r.close()
+    assert counts.shape == (3, 2, 2)
+    assert np.array_equal(counts.sum(axis=(1, 2)), [3, 4, 2])
+    # timestep 2: (-88.3, 28.1), (-88.1, 28.0)
+    assert np.array_equal(counts[2], [[0, 1], [1, 0]])
+    assert np.allclose(mass[2], [[0, 0.06], [0.05, 0]])
+
+
+@pytest.mark.parametrize("pool", [{'workers': 2}, {'processes': 2}])
+def test_density_grid_pool(pool):
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    serial = r.density_grid(GRID)
+    parallel = r.density_grid(GRID, batch=1, **pool)
+    r.close()
+    assert np.allclose(serial, parallel)
+
+
+def test_density_grid_file():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    density = r.density_grid(GRID,
+                             times=(datetime.datetime(2010, 11, 3, 12, 30),
+                                    datetime.datetime(2010, 11, 3, 13, 0)),
+                             filename=OUTPUT / 'junk_density.nc')
+    r.close()
+    assert density.shape == (2, 2, 2)
+    nc = netCDF4.Dataset(OUTPUT / 'junk_density.nc')
+    assert np.allclose(nc.variables['density'][:], density)
+    assert np.allclose(nc.variables['lon'][:], [-88.275, -88.0])
+    assert nc.variables['density'].units == 'grams'
+    assert len(nc.variables['time']) == 2
+    nc.close()
+
+
+def test_to_dense():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    dense, ids = r.to_dense('mass')
+    r.close()
+    assert np.array_equal(ids, [0, 1, 2, 3])
+    assert dense.shape == (3, 4)
+    assert np.allclose(dense[:, 1], [0.05, 0.05, 0.05])
+    assert np.allclose(dense[2], [np.nan, 0.05, np.nan, 0.06], equal_nan=True)
+
+
+def test_to_dense_file():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    in_memory, ids = r.to_dense('longitude')
+    on_disk, disk_ids = r.to_dense('longitude', filename=OUTPUT / 'junk_dense.npy', batch=2)
+    int_dense, ids = r.to_dense('id', fill=-1)
+    r.close()
+    assert np.array_equal(ids, disk_ids)
+    assert np.allclose(in_memory, on_disk, equal_nan=True)
+    assert np.allclose(np.load(OUTPUT / 'junk_dense.npy'), in_memory, equal_nan=True)
+    assert np.array_equal(int_dense[2], [-1, 1, -1, 3])
+
+
+def test_to_coo():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    values, timesteps, columns, ids = r.to_coo('id')
+    r.close()
+    assert np.array_equal(ids[columns], values)
+    assert np.array_equal(timesteps, [0, 0, 0, 1, 1, 1, 1, 2, 2])
+
+
+def write_step(writer, hour, ids):
+    writer.write_timestep(datetime.datetime(2010, 11, 3, hour),
+                          {'id': np.array(ids, dtype=np.int32),
+                           'longitude': np.zeros(len(ids))})
+
+
+@pytest.mark.parametrize("reader_class", [nc_particles.Reader, nc_particles.MemmapReader])
+@pytest.mark.parametrize("auto_mask", [True, False])
+def test_refresh(reader_class, auto_mask):
+    filename = OUTPUT / 'junk_refresh.nc'
+    w = nc_particles.Writer(filename, num_timesteps=10, nc_version=3, sync=True)
+    write_step(w, 0, [0, 1])
+    write_step(w, 1, [0, 1, 2])
+
+    r = reader_class(filename, auto_mask=auto_mask)
+    # only the committed timesteps, not the 10 in the file
+    assert r.num_timesteps == 2
+    assert len(r.times) == 2
+    assert np.array_equal(r.data_index, [0, 2, 5])
+
+    write_step(w, 2, [1, 2])
+    write_step(w, 3, [2])
+    assert r.refresh() == 2
+    assert r.num_timesteps == 4
+    assert np.array_equal(r.data_index, [0, 2, 5, 7, 8])
+    assert r.times[3].hour == 3
+    assert r.time_values[3] == 3 * 3600
+    data = r.get_timestep(3, ['id'])
+    assert np.array_equal(data['id'], [2])
+    if not auto_mask:
+        # still off in the re-opened file
+        assert not isinstance(data['id'], np.ma.MaskedArray)
+    assert r.refresh() == 0
+    r.close()
+    w.close()
+
+
+def test_follow():
+    filename = OUTPUT / 'junk_follow.nc'
+    w = nc_particles.Writer(filename, num_timesteps=10, nc_version=3, sync=True)
+    write_step(w, 0, [0, 1])
+
+    r = nc_particles.Reader(filename, lazy=True)
+    follower = r.follow(['id'], start=0, poll_interval=0.01, timeout=0.1)
+    timestep, data = next(follower)
+    assert timestep == 0
+    write_step(w, 1, [0, 1, 2])
+    timestep, data = next(follower)
+    assert timestep == 1
+    assert np.array_equal(data['id'], [0, 1, 2])
+    # times out
+    assert list(follower) == []
+    r.close()
+    w.close()
+
+
+def test_get_timestep_as_records():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    records = r.get_timestep(1, ['latitude', 'id'], as_records=True)
+    assert records.dtype.names == ('latitude', 'id')
+    data = r.get_timestep(1, ['latitude', 'id'])
+    assert np.array_equal(records['latitude'], data['latitude'])
+    assert np.array_equal(records['id'], data['id'])
+    r.close()
+
+
+def test_get_timestep_records_out():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    out = np.zeros((10,), dtype=[('pos', 'f8', (2,)), ('id', 'i4'), ('other', 'f4')])
+    field_map = {'pos': ('longitude', 'latitude'), 'id': 'id'}
+    records = r.get_timestep(2, out=out, field_map=field_map)
+    data = r.get_timestep(2, ['longitude', 'latitude', 'id'])
+    assert len(records) == len(data['id'])
+    assert np.shares_memory(records, out)
+    assert np.array_equal(records['pos'][:, 0], data['longitude'])
+    assert np.array_equal(records['pos'][:, 1], data['latitude'])
+    assert np.array_equal(out['id'][:len(records)], data['id'])
+    with pytest.raises(ValueError):
+        r.get_timestep(2, out=out[:1], field_map=field_map)
+    r.close()
+
+
+def test_max_particle_count():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    assert r.max_particle_count == np.diff(r.data_index).max()
+    r.close()
+
+
+def test_get_timestep_out():
+    r = nc_particles.Reader(HERE / 'sample.nc', auto_mask=False)
+    buffers = r.allocate_buffers(['latitude', 'id'])
+    assert len(buffers['id']) == r.max_particle_count
+    expected = nc_particles.Reader(HERE / 'sample.nc')
+    for timestep in range(r.num_timesteps):
+        data = r.get_timestep(timestep, ['latitude', 'id'], out=buffers)
+        assert np.shares_memory(data['id'], buffers['id'])
+        assert not np.ma.isMaskedArray(data['latitude'])
+        assert np.array_equal(data['id'], expected.get_timestep(timestep, ['id'])['id'])
+    with pytest.raises(ValueError):
+        r.get_timestep(0, ['id'], out={'id': buffers['id'][:0]})
+    expected.close()
+    r.close()
+
+
+@pytest.mark.parametrize("mode", ['rows', 'split'])
+def test_get_all_timesteps_out(mode):
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    out = r.allocate_buffers(['id'], size=r.data_index[-1])
+    data = r.get_all_timesteps(['id'], mode=mode, out=out)
+    expected = r.get_all_timesteps(['id'], mode=mode)
+    assert len(data['id']) == r.num_timesteps
+    for values, expected_values in zip(data['id'], expected['id']):
+        assert np.shares_memory(values, out['id'])
+        assert np.array_equal(values, expected_values)
+    r.close()
+
+
+def test_set_auto_mask():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    assert np.ma.isMaskedArray(r.get_timestep(0, ['id'])['id'])
+    r.set_auto_mask(False)
+    assert not np.ma.isMaskedArray(r.get_timestep(0, ['id'])['id'])
+    r.close()
+
+
+def test_add_lod_levels():
+    filename = OUTPUT / 'junk_lod_levels.nc'
+    shutil.copy(HERE / 'sample.nc', filename)
+    nc_particles.add_id_index(filename)
+    original = nc_particles.Reader(HERE / 'sample.nc')
+    nc_particles.add_lod_levels(filename, [0.5], batch=2)
+    r = nc_particles.Reader(filename)
+    for timestep in range(r.num_timesteps):
+        data = r.get_timestep(timestep, ['id', 'mass'])
+        expected = original.get_timestep(timestep, ['id', 'mass'])
+        assert sorted(zip(data['id'], data['mass'])) == sorted(zip(expected['id'], expected['mass']))
+        rank = nc_particles.nc_particles.lod_rank(data['id'])
+        level = r.get_timestep(timestep, ['id'], level=0)['id']
+        assert np.array_equal(np.sort(level), np.sort(data['id'][rank < 0.5]))
+    # the ID index was rebuilt for the new order
+    trajectory = r.get_individual_trajectory(1, ['id'])
+    assert np.all(trajectory['id'] == 1)
+    r.close()
+    original.close()
+
+
+def test_get_timestep_level_no_lod():
+    r = nc_particles.Reader(HERE / 'sample.nc')
+    with pytest.raises(ValueError):
+        r.get_timestep(0, level=0)
+    r.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Tests of the re-layout of files by particle
+
+Designed to be run with pytest
+"""
+
+import datetime
+import shutil
+from pathlib import Path
+
+import pytest
+import numpy as np
+import netCDF4
+import nc_particles
+from nc_particles.relayout import write_trajectory_file
+
+HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
+
+
+@pytest.fixture
+def sample_copy():
+    filename = OUTPUT / 'junk_relayout.nc'
+    shutil.copy(HERE / 'sample.nc', filename)
+    companion = Path(str(filename) + nc_particles.nc_particles.TRAJECTORY_EXTENSION)
+    if companion.exists():
+        companion.unlink()
+    return filename
+
+
+@pytest.mark.parametrize("batch_rows", [1, 3, 2**20])
+def test_write_trajectory_file(sample_copy, batch_rows):
+    companion = write_trajectory_file(sample_copy, batch_rows=batch_rows)
+    r = nc_particles.Reader(sample_copy)
+    expected = r.get_trajectories([0, 1, 2, 3], ['latitude', 'mass'])
+    with netCDF4.Dataset(companion) as nc:
+        assert nc.featureType == "trajectory"
+        assert nc.variables['rowSize'].sample_dimension == "obs"
+        ids = nc.variables['trajectory_id'][:]
+        row_size = nc.variables['rowSize'][:]
+        assert row_size.sum() == len(nc.dimensions['obs']) == r.data_index[-1]
+        start = 0
+        for particle_id, size in zip(ids, row_size):
+            trajectory = expected[int(particle_id)]
+            assert np.array_equal(nc.variables['timestep'][start:start + size], trajectory['timestep'])
+            assert np.array_equal(nc.variables['latitude'][start:start + size], trajectory['latitude'])
+            assert np.array_equal(nc.variables['time'][start:start + size],
+                                  r.time_values[trajectory['timestep']])
+            start += size
+    r.close()
+
+
+def test_reader_uses_trajectory_file(sample_copy):
+    r = nc_particles.Reader(sample_copy)
+    expected = r.get_trajectories([1, 3, 99], ['longitude', 'latitude'])
+    r.close()
+
+    write_trajectory_file(sample_copy)
+    r = nc_particles.Reader(sample_copy, stats=True)
+    assert r.get_trajectory_file(['longitude']) is not None
+    assert r.get_trajectory_file(['no_such_variable']) is None
+    trajectories = r.get_trajectories([1, 3, 99], ['longitude', 'latitude'])
+    for particle_id in (1, 3, 99):
+        for var in ('timestep', 'longitude', 'latitude'):
+            assert np.array_equal(trajectories[particle_id][var], expected[particle_id][var])
+    trajectory = r.get_individual_trajectory(3, ['latitude'])
+    assert np.array_equal(trajectory['latitude'], expected[3]['latitude'])
+    # one contiguous read, and no ID index needed
+    assert r.stats.for_method('get_individual_trajectory', 'read').calls == 2
+    # one read per variable, however many particles
+    assert r.stats.for_method('get_trajectories', 'read').calls == 3
+    assert r._id_index is None
+    r.close()
+
+
+def test_stale_trajectory_file():
+    filename = OUTPUT / 'junk_relayout_stale.nc'
+    w = nc_particles.Writer(filename, nc_version=4)
+    w.write_timestep(datetime.datetime(2010, 1, 1), {'id': np.array([0, 1], dtype=np.int32)})
+    w.close()
+    write_trajectory_file(filename)
+    w = nc_particles.Writer(filename, mode='a')
+    w.write_timestep(datetime.datetime(2010, 1, 1, 1), {'id': np.array([1], dtype=np.int32)})
+    w.close()
+    r = nc_particles.Reader(filename)
+    assert r.get_trajectory_file() is None
+    assert np.array_equal(r.get_individual_trajectory(1, ['id'])['id'], [1, 1])
+    r.close()
+
+
+def test_trajectory_file_uncommitted_rows(sample_copy):
+    # rows written after the last committed timestep are not in the companion
+    with netCDF4.Dataset(sample_copy, 'a') as nc:
+        nc.variables['id'][9:11] = [1, 1]
+    write_trajectory_file(sample_copy)
+    r = nc_particles.Reader(sample_copy)
+    assert r.get_trajectory_file(['id']) is not None
+    assert np.array_equal(r.get_individual_trajectory(1, ['id'])['id'], [1, 1, 1])
+    r.close()
+
+
+def test_modified_trajectory_file(sample_copy):
+    # same number of rows, but the data have changed
+    write_trajectory_file(sample_copy)
+    with netCDF4.Dataset(sample_copy, 'a') as nc:
+        nc.variables['longitude'][0] = 0.0
+        nc.history = "edited after the companion file was written"
+    r = nc_particles.Reader(sample_copy)
+    assert r.get_trajectory_file(['longitude']) is None
+    assert r.get_individual_trajectory(0, ['longitude'])['longitude'][0] == 0.0
+    r.close()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Tests of the shared Reader cache
+
+Designed to be run with pytest
+"""
+
+import os
+import shutil
+import datetime
+from pathlib import Path
+
+import pytest
+import numpy as np
+import nc_particles
+from nc_particles.shared_cache import SharedCache, CachedReader
+
+HERE = Path(__file__).parent
+OUTPUT = Path(__file__).parent / "output"
+
+
+@pytest.fixture
+def cache():
+    directory = OUTPUT / 'junk_cache'
+    shutil.rmtree(directory, ignore_errors=True)
+    return SharedCache(directory)
+
+
+def test_cached_reader(cache):
+    expected = nc_particles.Reader(HERE / 'sample.nc')
+    for i in range(2):
+        # the second time, everything comes from the cache
+        r = CachedReader(HERE / 'sample.nc', cache, variables=['latitude', 'id'], stats=True)
+        assert np.array_equal(r.data_index, expected.data_index)
+        assert list(r.times) == list(expected.times)
+        for timestep in range(r.num_timesteps):
+            data = r.get_timestep(timestep, ['latitude', 'mass'])
+            assert np.array_equal(data['latitude'], expected.get_timestep(timestep, ['latitude'])['latitude'])
+            assert np.array_equal(data['mass'], expected.get_timestep(timestep, ['mass'])['mass'])
+        trajectory = r.get_individual_trajectory(1, ['latitude'])
+        assert np.array_equal(trajectory['latitude'],
+                              expected.get_individual_trajectory(1, ['latitude'])['latitude'])
+        if i == 1:
+            assert r.stats.for_variable('time', 'read').calls == 0
+            assert r.stats.for_variable('particle_count').calls == 0
+        r.close()
+    assert isinstance(r._data_index, np.memmap)
+    assert len(cache.entries()) == 1
+    expected.close()
+
+
+def test_invalidated_by_change(cache):
+    filename = OUTPUT / 'junk_cached.nc'
+    w = nc_particles.Writer(filename, nc_version=4)
+    w.write_timestep(datetime.datetime(2010, 1, 1), {'id': np.array([0, 1], dtype=np.int32)})
+    w.close()
+    r = CachedReader(filename, cache, variables=['id'])
+    assert np.array_equal(r.get_timestep(0, ['id'])['id'], [0, 1])
+    r.close()
+
+    w = nc_particles.Writer(filename, mode='a')
+    w.write_timestep(datetime.datetime(2010, 1, 1, 1), {'id': np.array([2], dtype=np.int32)})
+    w.close()
+    r = CachedReader(filename, cache, variables=['id'])
+    assert r.num_timesteps == 2
+    assert np.array_equal(r.get_timestep(1, ['id'])['id'], [2])
+    r.close()
+    assert len(cache.entries()) == 2
+    cache.invalidate(filename)
+    assert len(cache.entries()) == 0
+
+
+def test_eviction(cache):
+    for i, filename in enumerate(['a.nc', 'b.nc', 'c.nc']):
+        path = OUTPUT / ('junk_cache_' + filename)
+        path.write_bytes(b'x')
+        cache.get_array(path, 'values', lambda: np.zeros((1000,)))
+    sizes = [size for entry, last_used, size in cache.entries()]
+    cache.max_bytes = sum(sizes) - 1
+    cache.evict()
+    assert len(cache.entries()) == 2
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_evicted_while_loading(cache):
+    # another process clears the cache while this one is loading the array
+    path = OUTPUT / 'junk_cache_evicted.nc'
+    path.write_bytes(b'x')
+
+    def load():
+        cache.clear()
+        return np.arange(10)
+
+    array = cache.get_array(path, 'values', load)
+    assert np.array_equal(array, np.arange(10))
+    assert isinstance(array, np.memmap)
+    assert len(cache.entries()) == 1
+
+
+def test_evicted_after_writing(cache, monkeypatch):
+    # and again, right after the array has been written
+    path = OUTPUT / 'junk_cache_evicted2.nc'
+    path.write_bytes(b'x')
+    monkeypatch.setattr(cache, 'evict', lambda keep=None: cache.clear())
+    array = cache.get_array(path, 'values', lambda: np.arange(10))
+    assert np.array_equal(array, np.arange(10))
@@ -10,8 +10,10 @@ Designed to be run with pytest
 """
 
 import datetime
+import threading
 from pathlib import Path
 import pytest
+import numpy as np
 import netCDF4
 import nc_particles
 
@@ -64,5 +66,487 @@ def test_write_timestep_wrong_size():
 #     w.close()
 #     w.close()
 
+
+def write_sample_file(filename, **kwargs):
+    """
+    writes the same data as in sample.nc
+    """
+    w = nc_particles.Writer(filename, **kwargs)
+    timesteps = [(datetime.datetime(2010, 11, 3, 12, 0),
+                  {'longitude': [-88.0, -88.1, -88.1],
+                   'latitude': [28.0, 28.0, 28.1],
+                   'id': np.array([0, 1, 2], dtype=np.int32)}),
+                 (datetime.datetime(2010, 11, 3, 12, 30),
+                  {'longitude': [-88.0, -88.2, -88.1, -87.9],
+                   'latitude': [28.0, 28.05, 28.1, 27.9],
+                   'id': np.array([0, 1, 2, 3], dtype=np.int32)}),
+                 (datetime.datetime(2010, 11, 3, 13, 0),
+                  {'longitude': [-88.3, -88.1],
+                   'latitude': [28.1, 28.0],
+                   'id': np.array([1, 3], dtype=np.int32)}),
+                 ]
+    for timestamp, data in timesteps:
+        w.write_timestep(timestamp, data)
+    return w
+
+
+@pytest.mark.parametrize("flush", [{},
+                                   {'flush_rows': 5},
+                                   {'flush_bytes': 1000000},
+                                   {'flush_interval': 3600},
+                                   ])
+def test_buffered_write(flush):
+    w = write_sample_file(OUTPUT / 'junk_buffered.nc', num_timesteps=3, **flush)
+    w.close()
+    r = nc_particles.Reader(OUTPUT / 'junk_buffered.nc')
+    data, data_index = r.get_all_timesteps(['id', 'longitude'], mode='flat')
+    times = r.times
+    r.close()
+    assert np.array_equal(data_index, [0, 3, 7, 9])
+    assert np.array_equal(data['id'], [0, 1, 2, 0, 1, 2, 3, 1, 3])
+    assert (times[2].day, times[2].hour, times[2].minute) == (3, 13, 0)
+
+
+def test_buffer_holds_data():
+    w = write_sample_file(OUTPUT / 'junk_buffered2.nc', flush_rows=8)
+    # the third timestep takes the buffer past 8 rows
+    assert w.num_flushed_timesteps == 3
+    assert w.num_flushed_data == 9
+    w.close()
+
+    w = write_sample_file(OUTPUT / 'junk_buffered3.nc', flush_rows=100)
+    assert w.num_flushed_timesteps == 0
+    assert len(w.nc.dimensions['data']) == 0
+    w.flush()
+    assert len(w.nc.dimensions['data']) == 9
+    w.close()
+
+
+def test_write_timestep_changed_variables():
+    w = nc_particles.Writer(OUTPUT / 'junk_file4.nc')
+    w.write_timestep(datetime.datetime(2010, 2, 3, 0), {"id": [1, 2, 3]})
+    with pytest.raises(ValueError):
+        w.write_timestep(datetime.datetime(2010, 2, 3, 1), {"mass": [1., 2., 3.]})
+    w.close()
+
+
+def test_compression():
+    storage = dict(nc_particles.nc_particles.POSITION_QUANTIZATION)
+    storage['longitude'] = {'complevel': 9}
+    w = write_sample_file(OUTPUT / 'junk_compressed.nc',
+                          compression=True,
+                          var_storage=storage,
+                          expected_particles=1000)
+    w.close()
+    nc = netCDF4.Dataset(OUTPUT / 'junk_compressed.nc')
+    lon = nc.variables['longitude']
+    filters = lon.filters()
+    chunking = lon.chunking()
+    id_filters = nc.variables['id'].filters()
+    id_chunking = nc.variables['id'].chunking()
+    lat_lsd = nc.variables['latitude'].least_significant_digit
+    nc.close()
+    assert filters['zlib'] and filters['shuffle']
+    assert filters['complevel'] == 9
+    assert id_filters['complevel'] == 4
+    assert chunking[0] % 1000 == 0
+    assert id_chunking[0] % 1000 == 0
+    assert lat_lsd == 5
+
+
+@pytest.mark.parametrize("expected_particles", [None, 10])
+def test_uncompressed_file_small(expected_particles):
+    # uncompressed chunks take all their space, even when nearly empty
+    filename = OUTPUT / 'junk_small_{}.nc'.format(expected_particles)
+    w = write_sample_file(filename, nc_version=4, expected_particles=expected_particles)
+    w.close()
+    assert filename.stat().st_size < 100000
+    if expected_particles:
+        nc = netCDF4.Dataset(filename)
+        chunking = nc.variables['longitude'].chunking()
+        nc.close()
+        assert chunking == [10 * nc_particles.nc_particles.CHUNK_TIMESTEPS]
+
+
+def test_compression_netcdf3():
+    w = write_sample_file(OUTPUT / 'junk_compressed3.nc',
+                          num_timesteps=3,
+                          nc_version=3,
+                          compression=True,
+                          var_storage=nc_particles.nc_particles.POSITION_QUANTIZATION)
+    w.close()
+    r = nc_particles.Reader(OUTPUT / 'junk_compressed3.nc')
+    data = r.get_timestep(1, ['latitude'])
+    r.close()
+    assert np.allclose(data['latitude'], [28.0, 28.05, 28.1, 27.9])
+
+
+def test_bbox_index():
+    w = write_sample_file(OUTPUT / 'junk_bbox.nc', bbox_index=True, flush_rows=5)
+    w.close()
+    r = nc_particles.Reader(OUTPUT / 'junk_bbox.nc')
+    lon_min = r.nc.variables['longitude_min'][:]
+    lat_max = r.nc.variables['latitude_max'][:]
+    variables = r.variables
+    r.close()
+    assert np.allclose(lon_min, [-88.1, -88.2, -88.3])
+    assert np.allclose(lat_max, [28.1, 28.1, 28.1])
+    assert 'longitude_min' not in variables
+
+
+@pytest.mark.parametrize("flush", [{}, {'flush_rows': 5}])
+def test_bbox_index_nan_positions(flush):
+    # a particle with no position must not hide the others from query_bbox
+    w = nc_particles.Writer(OUTPUT / 'junk_bbox_nan.nc', bbox_index=True, **flush)
+    w.write_timestep(datetime.datetime(2010, 2, 3, 0),
+                     {'longitude': [np.nan, -88.0, -88.5],
+                      'latitude': [np.nan, 28.0, 28.5],
+                      'id': np.array([0, 1, 2], dtype=np.int32)})
+    w.write_timestep(datetime.datetime(2010, 2, 3, 1),
+                     {'longitude': [np.nan, np.nan],
+                      'latitude': [np.nan, np.nan],
+                      'id': np.array([0, 1], dtype=np.int32)})
+    w.close()
+    r = nc_particles.Reader(OUTPUT / 'junk_bbox_nan.nc')
+    lon_min = r.nc.variables['longitude_min'][:]
+    lat_max = r.nc.variables['latitude_max'][:]
+    data = r.query_bbox(-88.1, -87.9, 27.9, 28.1)
+    r.close()
+    assert np.allclose(lon_min[:1], [-88.5])
+    assert np.allclose(lat_max[:1], [28.5])
+    assert np.all(np.ma.getmaskarray(lon_min[1:]) | np.isnan(np.ma.getdata(lon_min[1:])))
+    assert np.array_equal(data['id'], [1])
+    assert np.array_equal(data['timestep'], [0])
+
+
+def test_bbox_index_no_positions():
+    w = nc_particles.Writer(OUTPUT / 'junk_bbox2.nc', bbox_index=True)
+    with pytest.raises(ValueError):
+        w.write_timestep(datetime.datetime(2010, 2, 3, 0), {"id": [1, 2, 3]})
+    w.close()
+
+
+@pytest.mark.parametrize("nc_version", [3, 4])
+def test_write_static(nc_version):
+    filename = OUTPUT / 'junk_static{}.nc'.format(nc_version)
+    w = write_sample_file(filename, num_timesteps=3, nc_version=nc_version)
+    w.write_static(np.array([3, 1, 0], dtype=np.int32),
+                   {'spill_id': np.array([7, 5, 5], dtype=np.int32)})
+    if nc_version == 4:
+        w.write_static(np.array([2], dtype=np.int32),
+                       {'spill_id': np.array([6], dtype=np.int32)})
+    w.close()
+
+    r = nc_particles.Reader(filename)
+    assert r.static_variables == ['spill_id']
+    assert 'spill_id' in r.variables
+    assert 'particle_id' not in r.variables
+    data = r.get_timestep(1, ['id', 'spill_id'])
+    path = r.get_individual_trajectory(3, ['spill_id'])
+    static = r.get_static()
+    r.close()
+    assert np.array_equal(data['id'], [0, 1, 2, 3])
+    if nc_version == 4:
+        assert np.array_equal(data['spill_id'], [5, 5, 6, 7])
+        assert np.array_equal(static['particle_id'], [3, 1, 0, 2])
+    else:
+        assert np.array_equal(data['spill_id'].mask, [False, False, True, False])
+        assert np.array_equal(data['spill_id'][[0, 1, 3]], [5, 5, 7])
+    assert np.array_equal(path['spill_id'], [7, 7])
+
+
+def test_write_static_errors():
+    w = write_sample_file(OUTPUT / 'junk_static_errors.nc')
+    with pytest.raises(ValueError):
+        w.write_static([1, 2], {'spill_id': [1]})
+    with pytest.raises(ValueError):
+        w.write_static([1, 2], {'id': [1, 2]})
+    w.write_static([1, 2], {'spill_id': [1, 1]})
+    with pytest.raises(ValueError):
+        w.write_static([3], {'oil_type': [1]})
+    w.close()
+
+
+def test_async_writer():
+    w = nc_particles.AsyncWriter(OUTPUT / 'junk_async.nc', max_queued=1, flush_rows=4)
+    data = {'id': np.array([0, 1, 2], dtype=np.int32),
+            'mass': np.array([1.0, 2.0, 3.0])}
+    for hour in range(5):
+        w.write_timestep(datetime.datetime(2010, 2, 3, hour), data)
+        # the writer has its own copy
+        data['mass'] += 1.0
+    w.close()
+    w.close()
+    r = nc_particles.Reader(OUTPUT / 'junk_async.nc')
+    mass, data_index = r.get_all_timesteps(['mass'], mode='flat')
+    r.close()
+    assert np.array_equal(data_index, [0, 3, 6, 9, 12, 15])
+    assert np.array_equal(mass['mass'][::3], [1.0, 2.0, 3.0, 4.0, 5.0])
+
+
+def test_async_writer_while_reading():
+    # the writing thread and the Reader share NETCDF_LOCK
+    sample = Path(__file__).parent / 'sample.nc'
+    w = nc_particles.AsyncWriter(OUTPUT / 'junk_async3.nc', nc_version=4)
+    r = nc_particles.Reader(sample)
+    expected = r.get_timestep(1, ['id'])['id']
+    for hour in range(20):
+        w.write_timestep(datetime.datetime(2010, 2, 3, hour), {'id': np.arange(100, dtype=np.int32)})
+        assert np.array_equal(r.get_timestep(1, ['id'])['id'], expected)
+    w.close()
+    r.close()
+    r = nc_particles.Reader(OUTPUT / 'junk_async3.nc')
+    assert r.num_timesteps == 20
+    r.close()
+
+
+def test_async_writer_positional_args():
+    # the same arguments as Writer
+    w = nc_particles.AsyncWriter(OUTPUT / 'junk_async5.nc', 2, nc_version=3)
+    assert w.writer.num_timesteps == 2
+    assert w._queue.maxsize == 16
+    w.close()
+
+
+def test_async_writer_errors():
+    with pytest.raises(ValueError):
+        nc_particles.AsyncWriter(OUTPUT / 'junk_async2.nc', nc_version=3)
+    w = nc_particles.AsyncWriter(OUTPUT / 'junk_async2.nc')
+    with pytest.raises(ValueError):
+        w.write_timestep(datetime.datetime(2010, 2, 3, 0), {'id': [1, 2], 'mass': [1.0]})
+    w.write_timestep(datetime.datetime(2010, 2, 3, 0), {'id': [1, 2]})
+    # error in the writing thread
+    w.write_timestep(datetime.datetime(2010, 2, 3, 1), {'mass': [1.0, 2.0]})
+    with pytest.raises(ValueError):
+        w.flush()
+    with pytest.raises(ValueError):
+        w.write_timestep(datetime.datetime(2010, 2, 3, 2), {'id': [1, 2]})
+    with pytest.raises(ValueError):
+        w.close()
+
+
+def test_async_writer_close_fails():
+    w = nc_particles.AsyncWriter(OUTPUT / 'junk_async4.nc', flush_rows=100)
+    w.write_timestep(datetime.datetime(2010, 2, 3, 0), {'id': [1, 2]})
+
+    def fail(*args):
+        raise OSError("disk full")
+    # the final flush fails
+    w.writer._write = fail
+    errors = []
+
+    def close():
+        try:
+            w.close()
+        except OSError as err:
+            errors.append(err)
+    closing = threading.Thread(target=close)
+    closing.start()
+    closing.join(10)
+    assert not closing.is_alive()
+    assert len(errors) == 1
+
+
+@pytest.mark.parametrize("nc_version", [3, 4])
+def test_resume(nc_version):
+    filename = OUTPUT / 'junk_resume{}.nc'.format(nc_version)
+    num_timesteps = 10 if nc_version == 3 else None
+    w = write_sample_file(filename, num_timesteps=num_timesteps, nc_version=nc_version, bbox_index=True)
+    w.close()
+
+    w = nc_particles.Writer(filename, mode='a')
+    assert w.current_timestep == 3
+    assert w.num_data == 9
+    assert w.ref_time == datetime.datetime(2010, 11, 3, 12, 0)
+    assert w.num_timesteps == num_timesteps
+    w.write_timestep(datetime.datetime(2010, 11, 3, 13, 30),
+                     {'longitude': [-88.4], 'latitude': [28.2],
+                      'id': np.array([3], dtype=np.int32)})
+    w.close()
+
+    r = nc_particles.Reader(filename)
+    data = r.get_timestep(3, ['id', 'longitude'])
+    times = r.time_values
+    lon_min = r.nc.variables['longitude_min'][3]
+    r.close()
+    assert np.array_equal(data['id'], [3])
+    assert times[3] == 5400
+    assert lon_min == -88.4
+
+
+def test_resume_partial_timestep():
+    filename = OUTPUT / 'junk_resume_partial.nc'
+    w = write_sample_file(filename, num_timesteps=10, nc_version=3)
+    # as if the run crashed part way through writing a timestep
+    w.nc.variables['id'][9:11] = [7, 8]
+    w.nc.variables['particle_count'][3] = 2
+    w.close()
+
+    w = nc_particles.Writer(filename, mode='a')
+    assert w.current_timestep == 3
+    assert w.num_data == 9
+    w.close()
+
+
+@pytest.mark.parametrize("mode", ['w', 'a'])
+def test_write_past_num_timesteps(mode):
+    filename = OUTPUT / 'junk_full_{}.nc'.format(mode)
+    w = write_sample_file(filename, num_timesteps=3, nc_version=3, flush_rows=100)
+    if mode == 'a':
+        w.close()
+        w = nc_particles.Writer(filename, mode='a')
+    with pytest.raises(ValueError):
+        w.write_timestep(datetime.datetime(2010, 11, 3, 13, 30), {'longitude': [-88.4],
+                                                                  'latitude': [28.2],
+                                                                  'id': [3]})
+    w.close()
+    r = nc_particles.Reader(filename)
+    assert r.num_timesteps == 3
+    r.close()
+
+
+def test_flush_failure_keeps_buffer():
+    filename = OUTPUT / 'junk_flush_fail.nc'
+    w = write_sample_file(filename, flush_rows=100)
+    write = w._write
+
+    def fail_on_latitude(variable, *args):
+        if variable == 'latitude':
+            raise OSError("disk full")
+        write(variable, *args)
+    w._write = fail_on_latitude
+    with pytest.raises(OSError):
+        w.flush()
+    # nothing was lost -- it is all written next time
+    w._write = write
+    w.close()
+    r = nc_particles.Reader(filename)
+    data = r.get_timestep(2, ['latitude', 'id'])
+    assert r.num_timesteps == 3
+    r.close()
+    assert np.array_equal(data['id'], [1, 3])
+    assert np.allclose(data['latitude'], [28.1, 28.0])
+
+
+def test_resume_bad_mode():
+    with pytest.raises(ValueError):
+        nc_particles.Writer(OUTPUT / 'junk_file1.nc', mode='r')
+
+
+def test_compact():
+    filename = OUTPUT / 'junk_compact.nc'
+    w = write_sample_file(filename, num_timesteps=100, nc_version=3)
+    w.write_static(np.array([0, 1], dtype=np.int32),
+                   {'spill_id': np.array([4, 5], dtype=np.int32)})
+    w.close()
+    nc_particles.compact(filename, OUTPUT / 'junk_compacted.nc', batch_rows=4)
+    nc_particles.compact(filename)
+
+    for name in [filename, OUTPUT / 'junk_compacted.nc']:
+        nc = netCDF4.Dataset(name)
+        assert nc.file_format == 'NETCDF3_CLASSIC'
+        assert len(nc.dimensions['time']) == 3
+        assert len(nc.dimensions['data']) == 9
+        assert nc.variables['longitude'].units == 'degrees_east'
+        nc.close()
+        r = nc_particles.Reader(name)
+        data = r.get_timestep(2, ['id', 'spill_id'])
+        r.close()
+        assert np.array_equal(data['id'], [1, 3])
+        assert np.array_equal(data['spill_id'].mask, [False, True])
+
+
+@pytest.mark.parametrize("nc_version", [3, 4])
+def test_compact_no_timesteps(nc_version):
+    filename = OUTPUT / 'junk_compact_empty{}.nc'.format(nc_version)
+    w = nc_particles.Writer(filename, num_timesteps=10, nc_version=nc_version)
+    w.close()
+    nc_particles.compact(filename)
+    assert not Path(str(filename) + ".compact.tmp").exists()
+    r = nc_particles.Reader(filename)
+    assert r.num_timesteps == 0
+    r.close()
+
+
+def test_compact_failure():
+    filename = OUTPUT / 'junk_compact_bad.nc'
+    write_sample_file(filename, num_timesteps=10, nc_version=3).close()
+    # fails part way through writing the new file
+    with pytest.raises(ValueError):
+        nc_particles.compact(filename, batch_rows=0)
+    assert not Path(str(filename) + ".compact.tmp").exists()
+    r = nc_particles.Reader(filename)
+    assert r.num_timesteps == 3
+    r.close()
+
+
+LETYPE = np.dtype([("long", "f8"), ("lat", "f8"), ("z", "f8"),
+                   ("mass", "f8"), ("flag", "u1"), ("id", "i4")])
+
+
+@pytest.mark.parametrize("flush", [{}, {'flush_rows': 5}])
+def test_write_records(flush):
+    filename = OUTPUT / 'junk_records.nc'
+    w = nc_particles.Writer(filename, nc_version=4, **flush)
+    records = np.array([(-88.0, 28.0, 0.0, 0.1, 2, 0),
+                        (-88.1, 28.0, 0.1, 0.05, 2, 1)], dtype=LETYPE)
+    field_map = {'long': 'longitude', 'lat': 'latitude', 'id': 'id'}
+    w.write_timestep(datetime.datetime(2010, 11, 3, 12), records, field_map)
+    records['long'] += 1.0  # the writer must not hold on to the caller's records
+    w.write_timestep(datetime.datetime(2010, 11, 3, 13), records, field_map)
+    w.close()
+
+    r = nc_particles.Reader(filename)
+    assert set(r.variables) == {'longitude', 'latitude', 'id'}
+    assert np.array_equal(r.get_timestep(0, ['longitude'])['longitude'], [-88.0, -88.1])
+    assert np.array_equal(r.get_timestep(1, ['longitude'])['longitude'], [-87.0, -87.1])
+    assert r.nc.variables['id'].dtype == np.int32
+    r.close()
+
+
+def test_write_records_subarray():
+    dtype = np.dtype([("position", "f8", (3,)), ("id", "i4")])
+    records = np.zeros((3,), dtype=dtype)
+    records['position'][:, 2] = [1, 2, 3]
+    filename = OUTPUT / 'junk_records_position.nc'
+    w = nc_particles.Writer(filename, nc_version=4)
+    w.write_timestep(datetime.datetime(2010, 11, 3, 12), records,
+                     {'position': ('longitude', 'latitude', 'depth'), 'id': 'id'})
+    w.close()
+    r = nc_particles.Reader(filename)
+    assert np.array_equal(r.get_timestep(0, ['depth'])['depth'], [1, 2, 3])
+    r.close()
+
+
+def test_lod_fractions():
+    filename = OUTPUT / 'junk_lod.nc'
+    ids = np.arange(2000, dtype=np.int32)
+    w = nc_particles.Writer(filename, nc_version=4, flush_rows=3000, lod_fractions=[0.1, 0.01])
+    for hour, alive in enumerate([ids, ids[500:]]):
+        w.write_timestep(datetime.datetime(2010, 1, 1, hour),
+                         {'id': alive, 'mass': alive.astype(np.float64)})
+    w.close()
+
+    r = nc_particles.Reader(filename)
+    assert 'lod_count' not in r.variables
+    assert np.array_equal(r.lod_fractions, [0.1, 0.01])
+    level0 = [r.get_timestep(t, ['id', 'mass'], level=0) for t in range(2)]
+    level1 = [r.get_timestep(t, ['id'], level=1) for t in range(2)]
+    assert 100 < len(level0[0]['id']) < 300
+    assert 0 < len(level1[0]['id']) < len(level0[0]['id'])
+    assert np.array_equal(level0[0]['mass'], level0[0]['id'])
+    # the levels are nested, and the same particles at every timestep
+    assert set(level1[0]['id']) <= set(level0[0]['id'])
+    assert set(level0[1]['id']) == set(level0[0]['id']) & set(ids[500:])
+    # all the particles are still there
+    assert set(r.get_timestep(1, ['id'])['id']) == set(ids[500:])
+    r.close()
+
+
+def test_lod_fractions_bad():
+    with pytest.raises(ValueError):
+        nc_particles.Writer(OUTPUT / 'junk_lod_bad.nc', lod_fractions=[0.01, 0.1])
+
+
 if __name__ == "__main__":
     test_multi_close()